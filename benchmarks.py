@@ -0,0 +1,354 @@
+# benchmarks.py
+# Headless benchmarks for the label / PDF / history / print-sequencing hot paths.
+# No display or Android device needed (Kivy is imported but no window is opened).
+#
+#   python benchmarks.py                         # run everything, print a table
+#   python benchmarks.py --quick                 # smaller sizes (no 1M history)
+#   python benchmarks.py --save baseline.json    # store results as the baseline
+#   python benchmarks.py --compare baseline.json [--tolerance 0.25]
+#                                                # exit 1 if anything regressed
+import os
+import sys
+import json
+import time
+import shutil
+import contextlib
+import platform
+import tempfile
+import argparse
+from datetime import datetime
+
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+os.environ.setdefault("KIVY_NO_CONSOLELOG", "1")
+os.environ.setdefault("KIVY_NO_FILELOG", "1")
+
+import main  # noqa: E402
+
+ORDER_ID = "SO-2025-000123"
+CUSTOMER = "Nguyễn Thị Thanh Hương"
+
+def best_of(fn, repeat=5):
+    """Minimum wall time of fn() over `repeat` runs."""
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        dt = time.perf_counter() - t
+        best = dt if best is None else min(best, dt)
+    return best
+
+def result(value, unit, better):
+    return {"value": float(f"{value:.4g}"), "unit": unit, "better": better}
+
+# ---------- ESC/POS ----------
+def bench_escpos(results, quick):
+    n = 2000 if quick else 20000
+    main.escpos_bytes_for_label(ORDER_ID, CUSTOMER, 1, n)  # compile + warm caches
+    def labels():
+        for i in range(n):
+            main.escpos_bytes_for_label(ORDER_ID, CUSTOMER, i + 1, n)
+    results["escpos_label_throughput"] = result(n / best_of(labels, 3), "labels/s", "higher")
+    def cold():
+        main._compile_label_template.cache_clear()
+        main.encode_printer_text.cache_clear()
+        main.escpos_bytes_for_label(ORDER_ID, CUSTOMER, 1, 1)
+    results["escpos_template_compile"] = result(best_of(cold, 20), "s", "lower")
+    results["escpos_job_500_boxes"] = result(
+        best_of(lambda: main.escpos_job_for_order(ORDER_ID, CUSTOMER, 500), 5), "s", "lower")
+    bench_escpos_raster(results)
+
+def bench_escpos_raster(results):
+    if main.raster_backend() is None:
+        return
+    mode = main.ESCPOS_LABEL_MODE
+    main.ESCPOS_LABEL_MODE = "raster"
+    try:
+        def cold():
+            main._compile_raster_template.cache_clear()
+            main.raster_strip.cache_clear()
+            main.escpos_bytes_for_label(ORDER_ID, CUSTOMER, 1, 1)
+        results["escpos_raster_template_compile"] = result(best_of(cold, 5), "s", "lower")
+        def job():
+            main.raster_strip.cache_clear()  # every strip drawn from the glyph cache
+            main.escpos_job_for_order(ORDER_ID, CUSTOMER, 500)
+        results["escpos_raster_job_500_boxes"] = result(best_of(job, 3), "s", "lower")
+        label = main.escpos_bytes_for_label(ORDER_ID, CUSTOMER, 7, 120)
+        results["escpos_raster_label_bytes"] = result(len(label), "bytes", "lower")
+    finally:
+        main.ESCPOS_LABEL_MODE = mode
+
+# ---------- PDF ----------
+def bench_pdf(results, quick, workdir):
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        main.ensure_pdf_backend()
+        for boxes in (1, 50, 500):
+            results[f"pdf_{boxes}_boxes"] = result(
+                best_of(lambda: main.create_pdf_80x50_left(ORDER_ID, CUSTOMER, boxes), 3), "s", "lower")
+        orders = [(f"SO-{i:06d}", CUSTOMER, 3) for i in range(100 if quick else 1000)]
+        results[f"pdf_batch_{len(orders)}_orders_serial"] = result(
+            best_of(lambda: [main.create_pdf_80x50_left(*o) for o in orders], 1), "s", "lower")
+        results[f"pdf_batch_{len(orders)}_orders_merged"] = result(
+            best_of(lambda: main.render_orders_pdf(orders, merged_path="batch.pdf"), 1), "s", "lower")
+    finally:
+        os.chdir(cwd)
+
+# ---------- Render cache ----------
+def bench_reprint(results, quick, workdir):
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    main.RENDER_CACHE.enabled = True
+    try:
+        main.create_pdf_80x50_left(ORDER_ID, CUSTOMER, 500)
+        results["pdf_500_boxes_reprint_cached"] = result(
+            best_of(lambda: main.create_pdf_80x50_left(ORDER_ID, CUSTOMER, 500), 5), "s", "lower")
+        main.escpos_job_labels(ORDER_ID, CUSTOMER, 500)
+        results["escpos_job_500_boxes_reprint_cached"] = result(
+            best_of(lambda: main.escpos_job_labels(ORDER_ID, CUSTOMER, 500), 5), "s", "lower")
+    finally:
+        main.RENDER_CACHE.enabled = False
+        os.chdir(cwd)
+
+# ---------- History ----------
+def _write_journal(path, n):
+    line = '{"order_id": "%s", "customer": "%s", "box_qty": 3, "timestamp": "2025-01-01T00:00:00"}\n'
+    with open(path, "w", encoding="utf-8") as f:
+        buf = []
+        for i in range(n):
+            buf.append(line % (f"SO-{i:07d}", CUSTOMER))
+            if len(buf) >= 10000:
+                f.write("".join(buf))
+                buf = []
+        f.write("".join(buf))
+
+@contextlib.contextmanager
+def history_store(store):
+    """main.HISTORY replaced by store, for functions that use the global history."""
+    saved, main.HISTORY = main.HISTORY, store
+    try:
+        yield store
+    finally:
+        main.HISTORY = saved
+
+def bench_history(results, quick, workdir):
+    sizes = (1000, 100000) if quick else (1000, 100000, 1000000)
+    for n in sizes:
+        journal = os.path.join(workdir, f"history_{n}.jsonl")
+        _write_journal(journal, n)
+        empty_archive = os.path.join(workdir, f"history_{n}_archive")
+        def build():
+            len(main.HistoryStore(journal_path=journal, legacy_path=journal + ".none", archive_dir=empty_archive))
+        results[f"history_{n}_index_build"] = result(best_of(build, 3 if n < 1000000 else 1), "s", "lower")
+        store = main.HistoryStore(journal_path=journal, legacy_path=journal + ".none", archive_dir=empty_archive)
+        len(store)
+        lookups = 10000
+        def lookup():
+            for i in range(lookups):
+                main.has_been_printed(f"SO-{(i * 7919) % n:07d}")
+        with history_store(store):
+            results[f"history_{n}_has_been_printed"] = result(best_of(lookup, 3) / lookups, "s/op", "lower")
+        def search_build():
+            store._search = None
+            store.search("SO-0", archived=False)
+        results[f"history_{n}_search_index_build"] = result(best_of(search_build, 1), "s", "lower")
+        searches = 1000
+        def search():
+            for i in range(searches):
+                # partial order codes (segment prefixes) and a customer word
+                q = f"{(i * 7919) % n:07d}"[:6] if i % 4 else "huong"
+                store.search(q, archived=False)
+        results[f"history_{n}_search"] = result(best_of(search, 3) / searches, "s/op", "lower")
+        adds = 200
+        def add():
+            for i in range(adds):
+                store.add({"order_id": f"NEW-{i}", "customer": CUSTOMER, "box_qty": 1,
+                           "timestamp": "2025-01-01T00:00:00"})
+        results[f"history_{n}_add_entry"] = result(best_of(add, 1) / adds, "s/op", "lower")
+        os.remove(journal)
+
+    # archived segments: duplicate check for an order not in the active month
+    archive = os.path.join(workdir, "archive")
+    per_month = 10000 if quick else 100000
+    os.makedirs(archive, exist_ok=True)
+    for m in range(12):
+        main.SortedCountIndex.write(os.path.join(archive, f"2024-{m + 1:02d}.idx"),
+                                    {f"SO-{m:02d}-{i:07d}": 1 for i in range(per_month)})
+    store = main.HistoryStore(journal_path=os.path.join(workdir, "active.jsonl"),
+                              legacy_path=os.path.join(workdir, "none.json"), archive_dir=archive)
+    lookups = 2000
+    def archived():
+        for i in range(lookups):
+            store.archived_count(f"SO-{i % 12:02d}-{(i * 7919) % per_month:07d}")
+    results["history_archived_lookup_12_segments"] = result(best_of(archived, 3) / lookups, "s/op", "lower")
+    def printed():
+        for i in range(lookups):
+            main.has_been_printed(f"SO-{i % 12:02d}-{(i * 7919) % per_month:07d}")
+    with history_store(store):
+        results["history_archived_has_been_printed_12_segments"] = result(best_of(printed, 3) / lookups,
+                                                                           "s/op", "lower")
+    for m in range(12):
+        main.SortedSearchIndex.write(os.path.join(archive, f"2024-{m + 1:02d}.sidx"),
+                                     ({"order_id": f"SO-{m:02d}-{i:07d}", "customer": f"{CUSTOMER} {i % 500}",
+                                       "box_qty": 1, "timestamp": f"2024-{m + 1:02d}-01T00:00:00"}
+                                      for i in range(per_month)))
+    store.search_archives()
+    def archived_search():
+        for i in range(lookups):
+            store.search(f"{(i * 7919) % per_month:07d}"[:5], limit=20)
+    results["history_archived_search_12_segments"] = result(best_of(archived_search, 3) / lookups, "s/op", "lower")
+
+# ---------- Print sequencing ----------
+# Simulated SPP link: connect handshake + ~115 kbit/s throughput.
+SIM_CONNECT_S = 0.2
+SIM_SEC_PER_KB = 0.09
+
+def bench_print_sequence(results, quick):
+    boxes = 10 if quick else 40
+    # legacy: new connection per box + fixed 0.15 s gap (pre-session behaviour)
+    def legacy():
+        for i in range(min(boxes, 10)):
+            t = main.MemoryTransport(connect_delay=SIM_CONNECT_S, write_delay_per_kb=SIM_SEC_PER_KB)
+            t.connect()
+            t.write(main.escpos_bytes_for_label(ORDER_ID, CUSTOMER, i + 1, boxes))
+            t.close()
+            time.sleep(0.15)
+    per_box_legacy = best_of(legacy, 1) / min(boxes, 10)
+    results["print_legacy_per_box"] = result(per_box_legacy, "s/box", "lower")
+
+    def streamed():
+        t = main.MemoryTransport(connect_delay=SIM_CONNECT_S, write_delay_per_kb=SIM_SEC_PER_KB)
+        session = main.PrinterSession(lambda: t)
+        res = main.stream_label_job(session, main.escpos_job_for_order(ORDER_ID, CUSTOMER, boxes))
+        assert all(ok for ok, _ in res)
+    results["print_streamed_per_box"] = result(best_of(streamed, 3) / boxes, "s/box", "lower")
+
+    def flaky():
+        t = main.MemoryTransport(connect_delay=SIM_CONNECT_S, write_delay_per_kb=SIM_SEC_PER_KB, fail_writes=0)
+        session = main.PrinterSession(lambda: t)
+        session.ensure_connected()
+        t.fail_writes = 1  # link dropped while idle: one reconnect
+        main.stream_label_job(session, main.escpos_job_for_order(ORDER_ID, CUSTOMER, boxes))
+    results["print_streamed_reconnect_per_box"] = result(best_of(flaky, 3) / boxes, "s/box", "lower")
+
+    def status_paced():
+        # printer answering DLE EOT: one status round trip per STATUS_WINDOW_BYTES
+        t = main.MemoryTransport(connect_delay=SIM_CONNECT_S, write_delay_per_kb=SIM_SEC_PER_KB, status=True)
+        session = main.PrinterSession(lambda: t)
+        res = main.stream_label_job(session, main.escpos_job_for_order(ORDER_ID, CUSTOMER, boxes),
+                                    pacer=main.default_pacer(session))
+        assert all(ok for ok, _ in res)
+    results["print_status_paced_per_box"] = result(best_of(status_paced, 3) / boxes, "s/box", "lower")
+
+    def fan_out(printers=3):
+        tpl = main.compile_label_template(ORDER_ID, CUSTOMER)
+        labels = [tpl.label_parts(i + 1, boxes) for i in range(boxes)]
+        sessions = {}
+        for p in range(printers):
+            t = main.MemoryTransport(connect_delay=SIM_CONNECT_S, write_delay_per_kb=SIM_SEC_PER_KB, status=True)
+            sessions[f"SIM-{p}"] = main.PrinterSession(lambda t=t: t)
+        res, _ = main.fan_out_label_job(sessions, tpl.job_header, labels)
+        assert all(ok for ok, _ in res)
+    results["print_fanout_3_printers_per_box"] = result(best_of(fan_out, 3) / boxes, "s/box", "lower")
+
+def _sink_server():
+    """Local TCP stand-in for a 9100 printer: accepts connections and discards data."""
+    import socket
+    import threading
+    srv = socket.socket()
+    srv.bind(("127.0.0.1", 0))
+    srv.listen(4)
+    def drain(c):
+        with c:
+            while c.recv(65536):
+                pass
+    def serve():
+        while True:
+            c, _ = srv.accept()
+            threading.Thread(target=drain, args=(c,), daemon=True).start()
+    threading.Thread(target=serve, daemon=True).start()
+    return srv
+
+def bench_print_tcp(results, quick):
+    boxes = 100 if quick else 1000
+    srv = _sink_server()
+    addr = "127.0.0.1:%d" % srv.getsockname()[1]
+    def streamed():
+        session = main.PrinterSession(lambda: main.TcpTransport(addr))
+        res = main.stream_label_job(session, main.escpos_job_for_order(ORDER_ID, CUSTOMER, boxes))
+        session.close()
+        assert all(ok for ok, _ in res)
+    results["print_tcp_local_per_box"] = result(best_of(streamed, 3) / boxes, "s/box", "lower")
+    main.close_net_printer_pools()
+    srv.close()
+
+BENCHES = ("escpos", "pdf", "history", "print")
+
+def run(selected, quick):
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="orderprinter-bench-")
+    main.METRICS.path = os.path.join(workdir, "print_metrics.jsonl")  # spans stay on, log kept out of cwd
+    main.RENDER_CACHE.path = os.path.join(workdir, "render_cache")
+    main.RENDER_CACHE.enabled = False  # render benchmarks measure rendering; bench_reprint turns it on
+    try:
+        if "escpos" in selected:
+            bench_escpos(results, quick)
+        if "pdf" in selected:
+            bench_pdf(results, quick, workdir)
+            bench_reprint(results, quick, workdir)
+        if "history" in selected:
+            bench_history(results, quick, workdir)
+        if "print" in selected:
+            bench_print_sequence(results, quick)
+            bench_print_tcp(results, quick)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "meta": {"timestamp": datetime.now().isoformat(), "python": platform.python_version(),
+                 "machine": platform.machine(), "system": platform.system(), "quick": quick},
+        "results": results,
+    }
+
+def compare(current, baseline, tolerance):
+    """Return list of (name, base, now, change) for metrics worse than tolerance."""
+    regressions = []
+    for name, base in baseline.get("results", {}).items():
+        now = current["results"].get(name)
+        if now is None or not base["value"]:
+            continue
+        change = (now["value"] - base["value"]) / base["value"]
+        if base["better"] == "higher":
+            change = -change
+        if change > tolerance:
+            regressions.append((name, base["value"], now["value"], change))
+    return regressions
+
+def main_cli(argv=None):
+    ap = argparse.ArgumentParser(description="Order printer benchmarks")
+    ap.add_argument("--quick", action="store_true", help="smaller sizes (skips 1M-entry history)")
+    ap.add_argument("--only", choices=BENCHES, action="append", help="run only these groups")
+    ap.add_argument("--save", metavar="FILE", help="write results as JSON baseline")
+    ap.add_argument("--compare", metavar="FILE", help="compare against a saved baseline")
+    ap.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown (0.25 = 25%%)")
+    args = ap.parse_args(argv)
+
+    current = run(args.only or BENCHES, args.quick)
+    for name, r in current["results"].items():
+        print(f"{name:40s} {r['value']:>14.4g} {r['unit']}")
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2)
+        print("saved", args.save)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.tolerance)
+        for name, base, now, change in regressions:
+            print(f"REGRESSION {name}: {base} -> {now} ({change:+.0%})")
+        if regressions:
+            return 1
+        print("no regressions")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -49,7 +49,7 @@ p4a.branch = develop
 android.allow_backup = True
 
 # --- Giảm kích thước APK ---
-exclude_patterns = tests,docs,*.pyc,*.pyo,*.md,__pycache__,.git
+exclude_patterns = tests,docs,benchmarks.py,*.pyc,*.pyo,*.md,__pycache__,.git
 
 # --- Môi trường ---
 environment = 
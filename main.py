@@ -1,255 +1,3921 @@
 # order_printer_app_kivy.py
 # Full app (PC: create/open PDF) (Android: preview + ESC/POS Bluetooth printing)
 # 2025-09-28
+import time
+_STARTUP_T0 = time.perf_counter()
 import os
+import re
 import sys
+import csv
 import json
-import time
+import queue
+import string
+import bisect
+import functools
+import itertools
+import contextlib
+import threading
+import unicodedata
 import traceback
 import subprocess
+from array import array
 from datetime import datetime
 
+if "--serve" in sys.argv:
+    os.environ.setdefault("KIVY_NO_ARGS", "1")  # Kivy would reject --serve; serve_main() parses argv
+
 from kivy.app import App
 from kivy.uix.screenmanager import ScreenManager, Screen
 from kivy.uix.boxlayout import BoxLayout
-from kivy.uix.gridlayout import GridLayout
 from kivy.uix.scrollview import ScrollView
 from kivy.uix.label import Label
-from kivy.uix.textinput import TextInput
 from kivy.uix.button import Button
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
 from kivy.metrics import dp
-from kivy.core.window import Window
+from kivy.clock import Clock
+from kivy.properties import StringProperty
 from kivy.utils import platform  # <-- accurate platform detection for Kivy
 
+# ---------- STARTUP PROFILE ----------
+# ORDER_PRINTER_PROFILE_STARTUP=1 prints time-to-first-frame split by phase
+# and appends it to STARTUP_PROFILE_FILE (Kivy swallows unknown argv flags).
+STARTUP_PROFILE = os.environ.get("ORDER_PRINTER_PROFILE_STARTUP") == "1"
+STARTUP_PROFILE_FILE = "startup_profile.jsonl"
+_startup_marks = [("start", _STARTUP_T0)]
+
+def mark_startup(phase):
+    if STARTUP_PROFILE:
+        _startup_marks.append((phase, time.perf_counter()))
+
+def report_startup():
+    if not STARTUP_PROFILE:
+        return
+    phases = {name: round((t - _startup_marks[i][1]) * 1000, 1)
+              for i, (name, t) in enumerate(_startup_marks[1:])}
+    total = round((_startup_marks[-1][1] - _STARTUP_T0) * 1000, 1)
+    print("startup (ms):", ", ".join(f"{k}={v}" for k, v in phases.items()), f"| first frame={total}")
+    try:
+        with open(STARTUP_PROFILE_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"timestamp": datetime.now().isoformat(), "platform": platform,
+                                "phases_ms": phases, "first_frame_ms": total}) + "\n")
+    except Exception as e:
+        print("Warning: cannot write startup profile:", e)
+
+mark_startup("imports")
+
 # ---------- CONFIG ----------
-HISTORY_FILE = "print_history.json"
+HISTORY_FILE = "print_history.json"      # legacy whole-file history (migrated once)
+HISTORY_JOURNAL = "print_history.jsonl"  # append-only journal, one JSON entry per line
+HISTORY_ARCHIVE_DIR = "history_archive"  # closed segments: <segment>.jsonl.gz + sorted <segment>.idx
+HISTORY_SEGMENT_FORMAT = "%Y-%m"         # active journal holds one month ("%Y-%m-%d": one day)
+SEARCH_LIMIT = 50       # history search results returned by default
+MAX_BOX_QTY = 9999      # boxes per order accepted from the form, manifests and the job API
+
+# ---------- METRICS ----------
+# Timing spans for the print path, one JSON line per span in a rotating file.
+# Phases: permission, discovery, connect_primary, connect_fallback, write, flush,
+# close, history_write, pdf_render, pdf_batch_render, job. Spans are tagged
+# with the order and printer of the job running on the current thread.
+# Inside a job the per-chunk phases (METRICS_PER_JOB) are summed into one
+# record per job, with n = number of calls and the summed bytes.
+METRICS_FILE = "print_metrics.jsonl"
+METRICS_MAX_BYTES = 1000000
+METRICS_BACKUPS = 3
+METRICS_PER_JOB = ("write", "flush", "status")
+
+class Metrics:
+    def __init__(self, path=METRICS_FILE, max_bytes=METRICS_MAX_BYTES, backups=METRICS_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.enabled = os.environ.get("ORDER_PRINTER_METRICS", "1") != "0"
+        self._local = threading.local()
+        self._logger = None
+
+    def _log(self):
+        if self._logger is None:
+            import logging
+            from logging.handlers import RotatingFileHandler
+            logger = logging.getLogger("orderprinter.metrics")
+            logger.propagate = False  # keep spans out of the Kivy console log
+            logger.setLevel(logging.INFO)
+            handler = RotatingFileHandler(self.path, maxBytes=self.max_bytes,
+                                          backupCount=self.backups, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+            self._logger = logger
+        return self._logger
+
+    @contextlib.contextmanager
+    def tags(self, **tags):
+        """Tag every span recorded on this thread inside the block (order=..., printer=...)."""
+        prev = getattr(self._local, "tags", {})
+        self._local.tags = dict(prev, **tags)
+        try:
+            yield
+        finally:
+            self._local.tags = prev
+
+    @contextlib.contextmanager
+    def per_job(self):
+        """Sum METRICS_PER_JOB spans on this thread inside the block; record them once at its end."""
+        prev = getattr(self._local, "totals", None)
+        self._local.totals = totals = {}
+        try:
+            yield
+        finally:
+            self._local.totals = prev
+            if self.enabled:
+                for phase, (seconds, ok, tags) in totals.items():
+                    self._write(phase, seconds, ok, tags)
+
+    def record(self, phase, seconds, ok=True, **tags):
+        if not self.enabled:
+            return
+        totals = getattr(self._local, "totals", None)
+        if totals is not None and phase in METRICS_PER_JOB:
+            total, all_ok, summed = totals.get(phase, (0.0, True, {"n": 0}))
+            summed["n"] += 1
+            for k, v in tags.items():
+                summed[k] = summed.get(k, 0) + v if isinstance(v, (int, float)) else v
+            totals[phase] = (total + seconds, all_ok and ok, summed)
+            return
+        self._write(phase, seconds, ok, tags)
+
+    def _write(self, phase, seconds, ok, tags):
+        rec = dict(getattr(self._local, "tags", {}), **tags)
+        rec.update(phase=phase, ms=round(seconds * 1000, 3), ok=ok, ts=round(time.time(), 3))
+        try:
+            self._log().info(json.dumps(rec, ensure_ascii=False))
+        except Exception as e:
+            print("Warning: cannot write metrics:", e)
+
+    @contextlib.contextmanager
+    def span(self, phase, **tags):
+        t0 = time.perf_counter()
+        ok = True
+        try:
+            yield
+        except BaseException:
+            ok = False
+            raise
+        finally:
+            self.record(phase, time.perf_counter() - t0, ok, **tags)
+
+    def _files(self):
+        return [f"{self.path}.{i}" for i in range(self.backups, 0, -1)] + [self.path]
+
+    def records(self):
+        """All spans still on disk, oldest first."""
+        for p in self._files():
+            if not os.path.exists(p):
+                continue
+            with open(p, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+
+    def summary(self):
+        """
+        {"phase": {phase: stats}, "printer": {(phase, printer): stats}} where
+        stats = {"n", "p50", "p95", "fail"} in milliseconds.
+        """
+        by_phase = {}
+        by_printer = {}
+        for r in self.records():
+            phase = r.get("phase")
+            by_phase.setdefault(phase, []).append(r)
+            if r.get("printer"):
+                by_printer.setdefault((phase, r["printer"]), []).append(r)
+        def stats(rs):
+            ms = sorted(r.get("ms", 0) for r in rs)
+            return {"n": len(ms), "p50": percentile(ms, 50), "p95": percentile(ms, 95),
+                    "fail": sum(1 for r in rs if not r.get("ok", True))}
+        return {"phase": {k: stats(v) for k, v in by_phase.items()},
+                "printer": {k: stats(v) for k, v in by_printer.items()}}
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, -(-pct * len(sorted_values) // 100) - 1))
+    return sorted_values[k]
+
+METRICS = Metrics()
 
 # ---------- HISTORY UTIL ----------
-def load_history():
-    if os.path.exists(HISTORY_FILE):
+@functools.lru_cache(maxsize=4096)
+def _segment_key(date_prefix, fmt):
+    """Segment name ("2025-01") for a timestamp's date part; None if unparsable."""
+    try:
+        return datetime.strptime(date_prefix, "%Y-%m-%d").strftime(fmt)
+    except ValueError:
+        return None
+
+class SortedCountIndex:
+    """
+    Archived segment's order_id -> count as sorted '"order_id"<TAB>count' lines,
+    looked up by binary search over a read-only mmap (nothing loaded on the heap).
+    """
+    def __init__(self, path):
+        self.path = path
+        self._mm = None
+
+    @staticmethod
+    def key(order_id):
+        return json.dumps(str(order_id), ensure_ascii=False).encode("utf-8")
+
+    @classmethod
+    def write(cls, path, counts):
+        """Write {order_id: count} (merged with an existing index at path)."""
+        merged = {cls.key(k): v for k, v in counts.items()}
+        if os.path.exists(path):
+            for k, v in cls(path):
+                merged[cls.key(k)] = merged.get(cls.key(k), 0) + v
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            for k in sorted(merged):
+                f.write(k + b"\t" + str(merged[k]).encode() + b"\n")
+        os.replace(tmp, path)
+
+    def _map(self):
+        if self._mm is None:
+            import mmap
+            with open(self.path, "rb") as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+        return self._mm
+
+    def get(self, order_id):
+        target = self.key(order_id)
+        mm = self._map()
+        lo, hi = 0, len(mm)
+        while lo < hi:
+            start = mm.rfind(b"\n", 0, (lo + hi) // 2) + 1
+            if start < lo:
+                start = lo
+            end = mm.find(b"\n", start)
+            k, _, v = mm[start:end].partition(b"\t")
+            if k == target:
+                return int(v)
+            if k < target:
+                lo = end + 1
+            else:
+                hi = start
+        return 0
+
+    def __iter__(self):
+        """(order_id, count) in key order."""
+        return self.stream()
+
+    def stream(self):
+        """
+        (order_id, count) in key order, read through a handle opened now: a later
+        rewrite of the index (os.replace) doesn't change what the stream yields.
+        """
+        f = open(self.path, "rb")
+
+        def lines():
+            with f:
+                for line in f:
+                    k, _, v = line.rstrip(b"\n").partition(b"\t")
+                    yield json.loads(k), int(v)
+        return lines()
+
+    def close(self):
+        if self._mm:
+            self._mm.close()
+        self._mm = None
+
+@functools.lru_cache(maxsize=65536)
+def normalize_search(text):
+    """Search form of an order code / name: no diacritics, upper case, single spaces."""
+    text = str(text)
+    if not text.isascii():
+        text = transliterate_ascii(text)
+    return " ".join(text.upper().split())
+
+_SEARCH_TOKEN = re.compile(r"(?<!\w)\w")
+
+def search_keys(*texts):
+    """
+    Prefix-search keys for texts: the normalized text from the start of each word /
+    code segment, so "huong" finds "Nguyễn Thị Hương" and "000123" finds "SO-2025-000123".
+    """
+    keys = set()
+    for text in texts:
+        norm = normalize_search(text)
+        keys.update(norm[m.start():] for m in _SEARCH_TOKEN.finditer(norm))
+    return keys
+
+class PrefixIndex:
+    """
+    Sorted keys with prefix lookup by bisect; each key has a posting list of
+    ascending ints (journal entry numbers). Built incrementally: new keys go to a
+    small sorted side list that is merged into the main one once it outgrows
+    sqrt(n), so add() never re-sorts the whole index.
+    """
+    def __init__(self):
+        self._keys = []
+        self._recent = []
+        self._postings = {}  # key -> int, or array("q") once it has several
+
+    def _post(self, key, value):
+        """Add value to key's postings; True if the key is new."""
+        p = self._postings.get(key)
+        if p is None:
+            self._postings[key] = value
+            return True
+        if isinstance(p, int):
+            if p != value:
+                self._postings[key] = array("q", (p, value))
+        elif p[-1] != value:
+            p.append(value)
+        return False
+
+    def add(self, key, value):
+        if self._post(key, value):
+            bisect.insort(self._recent, key)
+            if len(self._recent) > max(1024, int(len(self._keys) ** 0.5)):
+                self._keys += self._recent
+                self._keys.sort()  # two sorted runs: a linear merge
+                self._recent = []
+
+    def extend(self, pairs):
+        """Bulk add of (key, value) pairs: one sort at the end instead of merges."""
+        for key, value in pairs:
+            self._post(key, value)
+        self._keys = sorted(self._postings)
+        self._recent = []
+
+    def prefixed(self, prefix):
+        """Keys starting with prefix (main run first, then the side list)."""
+        found = []
+        for keys in (self._keys, self._recent):
+            found += keys[bisect.bisect_left(keys, prefix):bisect.bisect_left(keys, prefix + "\U0010ffff")]
+        return found
+
+    def newest(self, keys, limit):
+        """
+        The `limit` largest values posted under any of keys (all of them), largest
+        first. Posting lists ascend, so each is read from its end only while it
+        still beats the current limit-th value.
+        """
+        import heapq
+        if limit <= 0:
+            return []
+        heap = []  # min-heap of the largest values so far
+        seen = set()
+        for k in keys:
+            p = self._postings[k]
+            for v in ((p,) if isinstance(p, int) else reversed(p)):
+                if len(heap) >= limit and v <= heap[0]:
+                    break
+                if v in seen:
+                    continue
+                seen.add(v)
+                if len(heap) < limit:
+                    heapq.heappush(heap, v)
+                else:
+                    heapq.heapreplace(heap, v)
+        return sorted(heap, reverse=True)
+
+    def __len__(self):
+        return len(self._postings)
+
+class SortedSearchIndex:
+    """
+    Archived segment's search keys as sorted 'KEY<TAB>[order_id, customer, prints,
+    last timestamp, box_qty]' lines, one per search key of each order / customer
+    pair; prefix lookups binary-search a read-only mmap like SortedCountIndex.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._mm = None
+
+    @classmethod
+    def write(cls, path, entries):
+        """Index history entries (a whole segment) at path."""
+        rows = {}
+        for it in entries:
+            k = (str(it.get("order_id")), str(it.get("customer")))
+            row = rows.setdefault(k, [k[0], k[1], 0, "", 0])
+            if not it.get("resumed"):
+                row[2] += 1
+            if str(it.get("timestamp") or "") >= row[3]:
+                row[3] = str(it.get("timestamp") or "")
+                row[4] = it.get("box_qty")
+        lines = []
+        for row in rows.values():
+            value = json.dumps(row, ensure_ascii=False)
+            lines.extend(f"{key}\t{value}\n".encode("utf-8") for key in search_keys(row[0], row[1]))
+        lines.sort()
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.writelines(lines)
+        os.replace(tmp, path)
+
+    def _map(self):
+        if self._mm is None:
+            import mmap
+            with open(self.path, "rb") as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+        return self._mm
+
+    def prefixed(self, prefix, limit):
+        """Rows whose keys start with prefix (one per order / customer pair, at most limit)."""
+        target = prefix.encode("utf-8")
+        mm = self._map()
+        lo, hi = 0, len(mm)
+        while lo < hi:  # first line with key >= prefix
+            start = mm.rfind(b"\n", 0, (lo + hi) // 2) + 1
+            if start < lo:
+                start = lo
+            end = mm.find(b"\n", start)
+            if mm[start:mm.find(b"\t", start, end)] < target:
+                lo = end + 1
+            else:
+                hi = start
+        rows = {}
+        pos = lo
+        while pos < len(mm) and len(rows) < limit:
+            end = mm.find(b"\n", pos)
+            key, _, value = mm[pos:end].partition(b"\t")
+            if not key.startswith(target):
+                break
+            rows.setdefault(value, None)
+            pos = end + 1
+        return [json.loads(v) for v in rows]
+
+    def close(self):
+        if self._mm:
+            self._mm.close()
+        self._mm = None
+
+class HistoryStore:
+    """
+    Append-only history journal with an in-memory order_id index.
+    - add() writes one line at the end of the journal (no rewrite).
+    - count()/dupes() answer from counters built on first use and kept up to date.
+    - entries()/iter_newest() read pages by seeking to remembered line offsets,
+      so screens never parse the whole journal.
+    - The legacy print_history.json is imported once, then renamed to *.migrated.
+    - The journal is the active segment only (one month by default): the first
+      entry of a new segment moves it to archive_dir as <segment>.jsonl.gz plus
+      a sorted <segment>.idx, so memory and index time stay bounded by one
+      segment. archived_count()/all_dupes() consult the archives on demand.
+    - search() finds entries by order code / customer prefix: a PrefixIndex over
+      the journal (built on the first search, then kept up to date by add())
+      and a <segment>.sidx SortedSearchIndex per archived segment.
+    """
+    def __init__(self, journal_path=HISTORY_JOURNAL, legacy_path=HISTORY_FILE,
+                 archive_dir=HISTORY_ARCHIVE_DIR, segment_format=HISTORY_SEGMENT_FORMAT):
+        self.journal_path = journal_path
+        self.legacy_path = legacy_path
+        self.archive_dir = archive_dir
+        self.segment_format = segment_format
+        self._lock = threading.RLock()
+        self._counts = None        # order_id -> number of prints (active segment)
+        self._dupes = {}           # order_id -> count, only where count > 1
+        self._offsets = array("q")  # byte offset of entry i in the journal
+        self._segment = None       # segment of the active journal
+        self._archives = None      # segment -> SortedCountIndex
+        self._search = None        # PrefixIndex over the journal, once searched
+        self._search_archives = {}  # segment -> SortedSearchIndex, opened on first search
+        self.version = 0           # bumped on every change (screens refresh incrementally)
+        self.generation = 0        # bumped when entries leave the journal (screens rebuild)
+
+    def segment_of(self, entry):
+        return _segment_key(str(entry.get("timestamp") or "")[:10], self.segment_format)
+
+    def _migrate_legacy(self):
+        if os.path.exists(self.journal_path) or not os.path.exists(self.legacy_path):
+            return
+        try:
+            with open(self.legacy_path, "r", encoding="utf-8") as f:
+                old = json.load(f)
+        except Exception as e:
+            print("Warning: cannot read legacy history:", e)
+            return
+        tmp = self.journal_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for it in old:
+                if isinstance(it, dict):
+                    f.write(json.dumps(it, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.journal_path)
         try:
-            with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
+            os.replace(self.legacy_path, self.legacy_path + ".migrated")
         except Exception:
+            pass
+
+    def _iter_journal(self):
+        """Yield (offset, entry) for every readable line."""
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, "rb") as f:
+            pos = 0
+            for line in f:
+                start = pos
+                pos += len(line)
+                if not line.strip():
+                    continue
+                try:
+                    yield start, json.loads(line)
+                except ValueError:
+                    # torn last line after a crash/power loss: skip it
+                    continue
+
+    def _count(self, entry):
+        if entry.get("resumed"):
+            return  # rest of an interrupted print (see PrintSpool), not a reprint
+        oid = entry.get("order_id")
+        c = self._counts.get(oid, 0) + 1
+        self._counts[oid] = c
+        if c > 1:
+            self._dupes[oid] = c
+
+    def _ensure_index(self):
+        if self._counts is not None:
+            return
+        self._migrate_legacy()
+        self._counts = {}
+        self._dupes = {}
+        self._offsets = array("q")
+        segments = set()
+        for off, it in self._iter_journal():
+            self._offsets.append(off)
+            self._count(it)
+            segments.add(self.segment_of(it))
+        segments.discard(None)
+        self._segment = max(segments) if segments else None
+        if len(segments) > 1:
+            # journal from before segmentation (or a missed rotation): archive older months
+            self._split_journal()
+
+    def _archive_segment(self, segment, lines, counts):
+        """Append raw journal lines to <segment>.jsonl.gz and merge counts into <segment>.idx."""
+        import gzip
+        import shutil
+        os.makedirs(self.archive_dir, exist_ok=True)
+        gz = os.path.join(self.archive_dir, f"{segment}.jsonl.gz")
+        tmp = gz + ".tmp"
+        if os.path.exists(gz):
+            shutil.copyfile(gz, tmp)
+        with gzip.open(tmp, "ab") as f:  # a further gzip member if the archive exists
+            for line in lines:
+                f.write(line)
+        os.replace(tmp, gz)
+        idx = os.path.join(self.archive_dir, f"{segment}.idx")
+        if self._archives and segment in self._archives:
+            self._archives.pop(segment).close()
+        SortedCountIndex.write(idx, counts)
+        if self._archives is not None:
+            self._archives[segment] = SortedCountIndex(idx)
+        if segment in self._search_archives:
+            self._search_archives.pop(segment).close()
+        self._write_search_index(segment)
+
+    def _write_search_index(self, segment):
+        """(Re)build <segment>.sidx from the whole archived segment."""
+        import gzip
+        def entries():
+            with gzip.open(os.path.join(self.archive_dir, f"{segment}.jsonl.gz"), "rb") as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+        path = os.path.join(self.archive_dir, f"{segment}.sidx")
+        SortedSearchIndex.write(path, entries())
+        return path
+
+    def _split_journal(self):
+        """Archive every entry not in the newest segment and keep the rest as the journal."""
+        by_segment = {}
+        keep = []
+        with open(self.journal_path, "rb") as f:
+            for line in f:
+                try:
+                    seg = self.segment_of(json.loads(line))
+                except ValueError:
+                    continue
+                if seg is None or seg == self._segment:
+                    keep.append(line)
+                else:
+                    by_segment.setdefault(seg, []).append(line)
+        for seg, lines in sorted(by_segment.items()):
+            counts = {}
+            for line in lines:
+                it = json.loads(line)
+                if not it.get("resumed"):
+                    counts[it.get("order_id")] = counts.get(it.get("order_id"), 0) + 1
+            self._archive_segment(seg, lines, counts)
+        tmp = self.journal_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.writelines(keep)
+        os.replace(tmp, self.journal_path)
+        self._counts = None
+        self._search = None
+        self.generation += 1
+        self.version += 1
+        self._ensure_index()
+
+    def _rotate(self):
+        """Active segment is over: archive the journal and start an empty one."""
+        with open(self.journal_path, "rb") as f:
+            self._archive_segment(self._segment, f, self._counts)
+        os.remove(self.journal_path)
+        self._counts = {}
+        self._dupes = {}
+        self._offsets = array("q")
+        self._search = None
+        self._segment = None
+        self.generation += 1
+
+    def archives(self):
+        """Archived segments (oldest first) -> SortedCountIndex."""
+        with self._lock:
+            if self._archives is None:
+                self._archives = {}
+                if os.path.isdir(self.archive_dir):
+                    for name in sorted(os.listdir(self.archive_dir)):
+                        if name.endswith(".idx"):
+                            self._archives[name[:-4]] = SortedCountIndex(os.path.join(self.archive_dir, name))
+            return dict(self._archives)
+
+    def archived_count(self, order_id):
+        """Prints of order_id in archived segments (binary search per segment index)."""
+        with self._lock:
+            return sum(ix.get(order_id) for ix in self.archives().values())
+
+    def total_count(self, order_id):
+        """Prints of order_id across the active segment and the archives."""
+        with self._lock:
+            return self.count(order_id) + self.archived_count(order_id)
+
+    def all_dupes(self):
+        """order_id -> total prints across archives and the journal, where > 1 (streams the indexes)."""
+        import heapq
+        with self._lock:
+            self._ensure_index()
+            active = sorted((SortedCountIndex.key(k), k, v) for k, v in self._counts.items())
+            # opened under the lock: rotation rewrites the index files, not these handles
+            streams = [((SortedCountIndex.key(k), k, v) for k, v in ix.stream()) for ix in self.archives().values()]
+        out = {}
+        cur_key, cur_oid, total = None, None, 0
+        for key, oid, n in heapq.merge(active, *streams):
+            if key != cur_key:
+                if total > 1:
+                    out[cur_oid] = total
+                cur_key, cur_oid, total = key, oid, 0
+            total += n
+        if total > 1:
+            out[cur_oid] = total
+        return out
+
+    def _ensure_search(self):
+        if self._search is not None:
+            return
+        self._ensure_index()
+        self._search = PrefixIndex()
+        self._search.extend((key, i) for i, (_, it) in enumerate(self._iter_journal())
+                            for key in search_keys(it.get("order_id", ""), it.get("customer", "")))
+
+    def _index_entry(self, i, entry):
+        for key in search_keys(entry.get("order_id", ""), entry.get("customer", "")):
+            self._search.add(key, i)
+
+    def search_archives(self):
+        """Archived segments (newest first) -> SortedSearchIndex, built for archives that predate it."""
+        archives = self.archives()
+        with self._lock:
+            for segment in sorted(archives, reverse=True):
+                if segment not in self._search_archives:
+                    path = os.path.join(self.archive_dir, f"{segment}.sidx")
+                    if not os.path.exists(path):
+                        try:
+                            self._write_search_index(segment)
+                        except OSError as e:
+                            print("Warning: cannot index archived history", segment, ":", e)
+                            continue
+                    self._search_archives[segment] = SortedSearchIndex(path)
+            return {seg: self._search_archives[seg] for seg in sorted(self._search_archives, reverse=True)}
+
+    def search(self, query, limit=SEARCH_LIMIT, archived=True):
+        """
+        Entries whose order code or customer has a word / segment starting with query
+        (diacritics and case ignored), newest first: journal entries, then one row per
+        order / customer pair of each archived segment (with "archived": segment); every
+        row has "count", the order's prints across the journal and all archives.
+        """
+        q = normalize_search(query)
+        if not q:
             return []
-    return []
+        with self._lock:
+            self._ensure_search()
+            found = self._search.newest(self._search.prefixed(q), limit)
+            out = []
+            if found:
+                with open(self.journal_path, "rb") as f:
+                    for i in found:
+                        f.seek(self._offsets[i])
+                        it = json.loads(f.readline())
+                        it["count"] = self.total_count(it.get("order_id"))
+                        out.append(it)
+        if archived:
+            for segment, ix in self.search_archives().items():
+                if len(out) >= limit:
+                    break
+                with self._lock:  # rotation closes and rewrites the mapped index
+                    rows = ix.prefixed(q, limit - len(out))
+                    rows = [(oid, cust, self.total_count(oid), ts, box) for oid, cust, _, ts, box in rows]
+                rows.sort(key=lambda r: r[3], reverse=True)
+                out.extend({"order_id": oid, "customer": cust, "count": n, "timestamp": ts, "box_qty": box,
+                            "archived": segment} for oid, cust, n, ts, box in rows)
+        return out
+
+    def __len__(self):
+        with self._lock:
+            self._ensure_index()
+            return len(self._offsets)
+
+    def load(self):
+        with self._lock:
+            self._ensure_index()
+            return [it for _, it in self._iter_journal()]
+
+    def entries(self, start, stop):
+        """Entries [start, stop) in journal (oldest first) order."""
+        with self._lock:
+            self._ensure_index()
+            start = max(0, start)
+            stop = min(stop, len(self._offsets))
+            out = []
+            if start >= stop:
+                return out
+            with open(self.journal_path, "rb") as f:
+                f.seek(self._offsets[start])
+                while len(out) < stop - start:
+                    line = f.readline()
+                    if not line:
+                        break
+                    try:
+                        out.append(json.loads(line))
+                    except ValueError:
+                        continue
+            return out
+
+    def iter_newest(self, before=None, page=200):
+        """Yield (index, entry) newest first, starting below index `before`."""
+        i = len(self) if before is None else before
+        while i > 0:
+            start = max(0, i - page)
+            chunk = self.entries(start, i)
+            for k in range(len(chunk) - 1, -1, -1):
+                yield start + k, chunk[k]
+            i = start
+
+    def replace_all(self, entries):
+        """Rewrite the journal with `entries` (rarely needed; add() never rewrites)."""
+        with self._lock:
+            tmp = self.journal_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                for it in entries:
+                    f.write(json.dumps(it, ensure_ascii=False) + "\n")
+            os.replace(tmp, self.journal_path)
+            self._counts = None
+            self._search = None
+            self.generation += 1
+            self.version += 1
+
+    def add(self, entry):
+        with self._lock:
+            self._ensure_index()
+            seg = self.segment_of(entry)
+            if seg is not None:
+                if self._segment is not None and seg > self._segment and self._offsets:
+                    self._rotate()
+                if self._segment is None or seg > self._segment:
+                    self._segment = seg
+            line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+            with open(self.journal_path, "ab") as f:
+                off = f.seek(0, os.SEEK_END)
+                f.write(line)
+            self._offsets.append(off)
+            self._count(entry)
+            if self._search is not None:
+                self._index_entry(len(self._offsets) - 1, entry)
+            self.version += 1
+
+    def count(self, order_id):
+        with self._lock:
+            self._ensure_index()
+            return self._counts.get(str(order_id), 0)
+
+    def counts(self):
+        """Snapshot of order_id -> print count."""
+        with self._lock:
+            self._ensure_index()
+            return dict(self._counts)
+
+    def dupes(self):
+        """Snapshot of order_id -> print count for orders printed more than once."""
+        with self._lock:
+            self._ensure_index()
+            return dict(self._dupes)
+
+HISTORY = HistoryStore()
+
+def load_history():
+    try:
+        return HISTORY.load()
+    except Exception:
+        return []
+
+def save_history(h):
+    try:
+        HISTORY.replace_all(h)
+    except Exception as e:
+        print("Warning: cannot save history:", e)
+
+def add_history_entry(order_id, customer, box_qty, boxes=None, resumed=False):
+    """
+    boxes: box numbers actually printed (stored as ranges, e.g. "1-16,18-40");
+    resumed: the rest of an earlier, interrupted print of this order.
+    """
+    entry = {
+        "order_id": str(order_id),
+        "customer": str(customer),
+        "box_qty": int(box_qty),
+        "timestamp": datetime.now().isoformat()
+    }
+    if boxes is not None:
+        entry["boxes"] = format_box_ranges(boxes)
+    if resumed:
+        entry["resumed"] = True
+    try:
+        with METRICS.span("history_write"):
+            HISTORY.add(entry)
+    except Exception as e:
+        print("Warning: cannot save history:", e)
+
+def has_been_printed(order_id):
+    """Printed in the active segment, or (looked up on demand) in an archived one."""
+    return HISTORY.count(order_id) > 0 or HISTORY.archived_count(order_id) > 0
+
+def search_history(query, limit=SEARCH_LIMIT):
+    """Printed orders matching a partial order code or customer name (see HistoryStore.search)."""
+    try:
+        return HISTORY.search(query, limit)
+    except Exception as e:
+        print("Warning: cannot search history:", e)
+        return []
+
+# ---------- PRINT SPOOL ----------
+# Durable per-box state of printer jobs: an interrupted order (dropped link,
+# app killed) resumes at its first unprinted box instead of being reprinted.
+SPOOL_FILE = "print_spool.jsonl"
+SPOOL_RETRIES = 3               # extra passes over failed boxes before a job gives up
+SPOOL_BACKOFF = 1.0             # seconds before the first retry pass, doubled each pass
+SPOOL_FSYNC = True              # fsync on every flush (a box is only "sent" once it is on disk)
+SPOOL_COMPACT_BYTES = 256 * 1024
+
+def format_box_ranges(boxes):
+    """[1, 2, 3, 5, 7, 8] -> "1-3,5,7-8"."""
+    out = []
+    run = None
+    for b in sorted(set(int(b) for b in boxes)):
+        if run and b == run[1] + 1:
+            run[1] = b
+        else:
+            run = [b, b]
+            out.append(run)
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in out)
+
+def parse_box_ranges(text):
+    """"1-3,5" -> [1, 2, 3, 5]."""
+    boxes = []
+    for part in str(text or "").split(","):
+        a, _, b = part.strip().partition("-")
+        if a.isdigit():
+            boxes.extend(range(int(a), int(b if b.isdigit() else a) + 1))
+    return boxes
+
+class PrintSpool:
+    """
+    Append-only journal of printer jobs, one JSON line per event:
+      {"job", "order_id", "customer", "box_qty", "printer", "boxes", "ts"}  job opened
+      {"job", "box", "ok", "error"}                                       box sent / failed
+      {"job", "closed": true}                                             finished or abandoned
+    Open jobs are rebuilt from the journal on first use, so they survive restarts.
+    Box marks made with sync=False are buffered until flush(), so a job pays one
+    fsync per printer write rather than one per box.
+    The file is rewritten with only the open jobs once it grows past SPOOL_COMPACT_BYTES.
+    """
+    def __init__(self, path=SPOOL_FILE):
+        self.path = path
+        self._lock = threading.RLock()
+        self._jobs = None  # key -> {"order_id", ..., "boxes": [...], "sent": set, "failed": {box: error}}
+        self._unsynced = []  # records applied to _jobs but not written yet
+        self._seq = 0
+
+    def _apply(self, jobs, rec):
+        key = rec.get("job")
+        if "order_id" in rec:
+            jobs[key] = {"key": key, "order_id": rec["order_id"], "customer": rec.get("customer", ""),
+                         "box_qty": int(rec.get("box_qty", 0)), "printer": rec.get("printer"),
+                         "boxes": parse_box_ranges(rec.get("boxes")), "ts": rec.get("ts"),
+                         "sent": set(), "failed": {}}
+        elif rec.get("closed"):
+            jobs.pop(key, None)
+        elif key in jobs and "box" in rec:
+            job = jobs[key]
+            if rec.get("ok"):
+                job["sent"].add(rec["box"])
+                job["failed"].pop(rec["box"], None)
+            else:
+                job["failed"][rec["box"]] = rec.get("error")
+
+    def _load(self):
+        if self._jobs is not None:
+            return
+        jobs = {}
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                for line in f:
+                    try:
+                        self._apply(jobs, json.loads(line))
+                    except ValueError:
+                        continue  # torn last line after a crash
+        self._jobs = jobs
+
+    def _write(self, f, rec):
+        f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+    def _append(self, rec, sync=True):
+        with self._lock:
+            self._load()
+            self._apply(self._jobs, rec)
+            self._unsynced.append(rec)
+            if sync:
+                self.flush()
+
+    def flush(self):
+        """Write (and fsync) the buffered records."""
+        with self._lock:
+            if not self._unsynced:
+                return
+            recs, self._unsynced = self._unsynced, []
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    for rec in recs:
+                        self._write(f, rec)
+                    if SPOOL_FSYNC:
+                        f.flush()
+                        os.fsync(f.fileno())
+            except Exception as e:
+                print("Warning: cannot write print spool:", e)
+
+    def open(self, order_id, customer, box_qty, printer, boxes):
+        """Record a new job; returns its key."""
+        with self._lock:
+            self._seq += 1
+            key = f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{os.getpid()}-{self._seq}"
+            self._append({"job": key, "order_id": str(order_id), "customer": str(customer),
+                          "box_qty": int(box_qty), "printer": printer,
+                          "boxes": format_box_ranges(boxes), "ts": datetime.now().isoformat()})
+            return key
+
+    def mark(self, key, box, ok, error=None, sync=True):
+        """Record one box; with sync=False it is written by the next flush()."""
+        rec = {"job": key, "box": int(box), "ok": bool(ok)}
+        if not ok:
+            rec["error"] = error
+        self._append(rec, sync)
+
+    def close(self, key):
+        """Job finished (or abandoned by the operator): drop it from the open set."""
+        self._append({"job": key, "closed": True})
+        with self._lock:
+            try:
+                if os.path.getsize(self.path) > SPOOL_COMPACT_BYTES:
+                    self._compact()
+            except OSError:
+                pass
+
+    def _compact(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for key, job in self._jobs.items():
+                self._write(f, {"job": key, "order_id": job["order_id"], "customer": job["customer"],
+                                "box_qty": job["box_qty"], "printer": job["printer"],
+                                "boxes": format_box_ranges(job["boxes"]), "ts": job["ts"]})
+                for box in sorted(job["sent"]):
+                    self._write(f, {"job": key, "box": box, "ok": True})
+                for box, err in sorted(job["failed"].items()):
+                    self._write(f, {"job": key, "box": box, "ok": False, "error": err})
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def job(self, key):
+        """Snapshot of one open job (with "pending" = boxes not yet sent), or None."""
+        with self._lock:
+            self._load()
+            job = self._jobs.get(key)
+            if job is None:
+                return None
+            snap = dict(job, sent=sorted(job["sent"]), failed=dict(job["failed"]))
+            snap["pending"] = [b for b in job["boxes"] if b not in job["sent"]]
+            return snap
+
+    def unfinished(self):
+        """Snapshots of every open job, oldest first."""
+        with self._lock:
+            self._load()
+            return [self.job(key) for key in list(self._jobs)]
+
+SPOOL = PrintSpool()
+
+# ---------- RENDER CACHE ----------
+# Finished outputs (ORDER_<id>.pdf files, ESC/POS label streams) stored under a
+# hash of everything that shapes them: order id, customer, box count and the
+# layout/settings fingerprint. Reprints copy the file back instead of rendering.
+RENDER_CACHE_DIR = "render_cache"
+RENDER_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RENDER_CACHE_MAX_AGE = 14 * 24 * 3600   # seconds since last use
+RENDER_CACHE_VERSION = 2                 # bump when drawing / encoding code changes output
+
+class RenderCache:
+    """
+    Content-addressed files in `path`, named <sha256>.<ext>. get() refreshes the
+    file's mtime, so eviction drops the least recently used entries once the
+    cache is over max_bytes. Sizes and use times are tracked in memory after one
+    directory scan on first use (which also drops anything unused for max_age),
+    so a put() does not list the directory.
+    """
+    def __init__(self, path=RENDER_CACHE_DIR, max_bytes=RENDER_CACHE_MAX_BYTES, max_age=RENDER_CACHE_MAX_AGE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._files = None  # path -> [last use, size], after _scan()
+        self._total = 0
+
+    @staticmethod
+    def key(*parts):
+        import hashlib
+        raw = json.dumps([RENDER_CACHE_VERSION] + list(parts), ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _file(self, key, ext):
+        return os.path.join(self.path, f"{key}.{ext}")
+
+    def get(self, key, ext):
+        """Path of the cached file, or None."""
+        if not self.enabled:
+            return None
+        p = self._file(key, ext)
+        try:
+            os.utime(p)
+        except OSError:
+            return None
+        with self._lock:
+            if self._files is not None and p in self._files:
+                self._files[p][0] = time.time()
+        return p
+
+    def put_bytes(self, key, ext, data):
+        def write(tmp):
+            with open(tmp, "wb") as f:
+                f.write(data)
+        self._put(key, ext, write)
+
+    def put_file(self, key, ext, src):
+        import shutil
+        self._put(key, ext, lambda tmp: shutil.copyfile(src, tmp))
+
+    def _put(self, key, ext, write):
+        if not self.enabled:
+            return
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            dst = self._file(key, ext)
+            tmp = f"{dst}.{threading.get_ident()}.tmp"
+            write(tmp)
+            size = os.path.getsize(tmp)
+            os.replace(tmp, dst)
+            with self._lock:
+                self._scan()
+                old = self._files.get(dst)
+                self._total += size - (old[1] if old else 0)
+                self._files[dst] = [time.time(), size]
+            if self._total > self.max_bytes:
+                self.evict()
+        except Exception as e:
+            print("Warning: cannot write render cache:", e)
+
+    def _scan(self):
+        """Load sizes / use times from the directory once, dropping entries older than max_age."""
+        if self._files is not None:
+            return
+        self._files = {}
+        self._total = 0
+        cutoff = time.time() - self.max_age
+        if not os.path.isdir(self.path):
+            return
+        with os.scandir(self.path) as it:
+            for e in it:
+                if e.name.endswith(".tmp"):
+                    continue
+                st = e.stat()
+                if st.st_mtime < cutoff:
+                    try:
+                        os.remove(e.path)
+                        continue
+                    except OSError:
+                        pass
+                self._files[e.path] = [st.st_mtime, st.st_size]
+                self._total += st.st_size
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits max_bytes."""
+        with self._lock:
+            self._scan()
+            for p, (_, size) in sorted(self._files.items(), key=lambda kv: kv[1][0]):
+                if self._total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(p)
+                except FileNotFoundError:
+                    pass  # removed by another process
+                except OSError:
+                    continue
+                del self._files[p]
+                self._total -= size
+
+    def clear(self):
+        with self._lock:
+            if os.path.isdir(self.path):
+                for name in os.listdir(self.path):
+                    try:
+                        os.remove(os.path.join(self.path, name))
+                    except OSError:
+                        pass
+            self._files = None
+
+RENDER_CACHE = RenderCache()
+
+# ---------- PDF CREATE (Desktop) ----------
+# Using reportlab to generate 70x50 mm pages (one per BOX).
+# reportlab and the font are loaded by ensure_pdf_backend() on first PDF use,
+# so startup (and Android, which never renders PDFs) doesn't pay for them.
+mm = 72.0 / 25.4  # reportlab.lib.units.mm
+
+PAGE_W_MM = 70
+PAGE_H_MM = 50
+MARGIN_MM = 5
+FONT_TTF = "arial.ttf"  # optional bundled font
+FONT_NAME = "Helvetica"
+FONT_NAME1 = "Helvetica-Bold"
+canvas = pdfmetrics = None
+_pdf_backend_lock = threading.Lock()
+
+def font_path():
+    """FONT_TTF from the cwd or next to this file (None when not bundled)."""
+    for path in (FONT_TTF, os.path.join(os.path.dirname(os.path.abspath(__file__)), FONT_TTF)):
+        if os.path.exists(path):
+            return path
+    return None
+
+def ensure_pdf_backend():
+    """Import reportlab and register the bundled font (once)."""
+    global canvas, pdfmetrics, FONT_NAME
+    if canvas is not None:
+        return
+    with _pdf_backend_lock:
+        if canvas is not None:
+            return
+        from reportlab.pdfgen import canvas as rl_canvas
+        from reportlab.pdfbase import pdfmetrics as rl_pdfmetrics
+        from reportlab.pdfbase.ttfonts import TTFont
+        # registration is deferred, so don't depend on the cwd at that moment
+        path = font_path()
+        if path:
+            try:
+                rl_pdfmetrics.registerFont(TTFont("AppFont", path))
+                FONT_NAME = "AppFont"
+            except:
+                FONT_NAME = "Helvetica"
+        pdfmetrics = rl_pdfmetrics
+        canvas = rl_canvas
+
+PDF_USE_FORMS = True  # draw the static order/customer block once per order as a Form XObject
+PDF_BARCODE = "code128"  # order id as a vector "code128" / "qr" on every label, None = text only
+
+@functools.lru_cache(maxsize=8192)
+def text_width(text, font_name, size):
+    """Width in points from the font's real metrics (cached)."""
+    ensure_pdf_backend()
+    return pdfmetrics.stringWidth(text, font_name, size)
+
+@functools.lru_cache(maxsize=4096)
+def fit_text(text, font_name, size, max_width):
+    """Longest prefix of text whose rendered width fits max_width."""
+    if text_width(text, font_name, size) <= max_width:
+        return text
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if text_width(text[:mid], font_name, size) <= max_width:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo]
+
+def fit_font_size(text, font_name, size, max_width):
+    """size, or the smaller size at which the whole text fits max_width (for text that must not be cut)."""
+    w = text_width(text, font_name, size)
+    return size if w <= max_width else size * max_width / w
+
+@functools.lru_cache(maxsize=8)
+def label_geometry(pagesize, barcode=None):
+    """
+    Font sizes and baselines of the three label lines (same for every page), plus
+    the barcode box: "code128" gets a full-width row above the BOX line, "qr" a
+    square in the top right corner beside the order id / customer lines.
+    """
+    margin = MARGIN_MM * mm
+    width, height = pagesize
+    usable_h = height - 2 * margin
+    if barcode == "code128":
+        order_h, cust_h, bar_h, box_h = (usable_h * f for f in (0.26, 0.2, 0.34, 0.2))
+        return {
+            "left_x": margin,
+            "max_w": width - 2.5 * margin,
+            "order_font": max(10, min(int(order_h * 0.8), 48)),
+            "other_font": max(8, min(int(cust_h * 0.75), 30)),
+            "y1": height - margin - order_h * 0.85,
+            "y2": height - margin - order_h - cust_h * 0.85,
+            "y3": margin + box_h * 0.2,
+            "barcode": barcode,
+            "bar_x": margin, "bar_y": margin + box_h + bar_h * 0.1,
+            "bar_w": width - 2 * margin, "bar_h": bar_h * 0.85,
+        }
+    part_h = usable_h / 3.0
+    g = {
+        "left_x": margin,
+        "max_w": width - 2.5 * margin,
+        "order_font": max(10, min(int(part_h * 0.8), 48)),
+        "other_font": max(8, min(int(part_h * 0.45), 30)),
+        "y1": height - margin - (part_h * 0.3),
+        "y2": height - margin - part_h - (part_h * 0.3),
+        "y3": height - margin - part_h * 2.5 - (part_h * 0.3),
+    }
+    if barcode == "qr":
+        side = min(part_h * 2, width * 0.4)
+        g.update(barcode=barcode, bar_x=width - margin - side, bar_y=height - margin - side,
+                 bar_w=side, bar_h=side, max_w=width - 3.5 * margin - side)
+    return g
+
+def _draw_barcode(c, g, order_id):
+    """Vector Code 128 / QR of the order id into the geometry's barcode box."""
+    data = str(order_id)
+    if g["barcode"] == "qr":
+        from reportlab.graphics.barcode.qr import QrCodeWidget
+        from reportlab.graphics.shapes import Drawing
+        from reportlab.graphics import renderPDF
+        w = QrCodeWidget(data, barLevel="M", barBorder=0)
+        x0, y0, x1, y1 = w.getBounds()
+        side = g["bar_w"]
+        d = Drawing(side, side, transform=[side / (x1 - x0), 0, 0, side / (y1 - y0), 0, 0])
+        d.add(w)
+        renderPDF.draw(d, c, g["bar_x"], g["bar_y"])
+        return
+    from reportlab.graphics.barcode.code128 import Code128
+    data = transliterate_ascii(data)
+    modules = Code128(data, barWidth=1, humanReadable=0, quiet=0).width
+    bar_width = min(g["bar_w"] / modules, 0.5 * mm)  # wider bars only make the symbol longer
+    b = Code128(data, barWidth=bar_width, barHeight=g["bar_h"], humanReadable=0, quiet=0)
+    b.drawOn(c, g["bar_x"] + (g["bar_w"] - b.width) / 2, g["bar_y"])
+
+def _draw_static_block(c, g, order_id, customer):
+    # the order id is shrunk rather than cut (long ids beside a QR code)
+    c.setFont(FONT_NAME1, fit_font_size(str(order_id), FONT_NAME1, g["order_font"], g["max_w"]))
+    c.drawString(g["left_x"], g["y1"], str(order_id))
+    c.setFont(FONT_NAME, g["other_font"])
+    c.drawString(g["left_x"], g["y2"], fit_text(str(customer), FONT_NAME, g["other_font"], g["max_w"]))
+    if g.get("barcode"):
+        _draw_barcode(c, g, order_id)
+
+def draw_order_pages(c, order_id, customer, box_qty, pagesize):
+    """
+    Draw box_qty label pages for one order onto canvas c. With PDF_USE_FORMS the
+    order id / customer block (and the PDF_BARCODE symbol) is a Form XObject
+    defined once and referenced on every page, so only the BOX line is drawn per page.
+    """
+    g = label_geometry(tuple(pagesize), PDF_BARCODE)
+    form = None
+    if PDF_USE_FORMS:
+        n = getattr(c, "_label_forms", 0)
+        c._label_forms = n + 1
+        form = f"label{n}"
+        c.beginForm(form)
+        _draw_static_block(c, g, order_id, customer)
+        c.endForm()
+    for i in range(int(box_qty)):
+        if form:
+            c.doForm(form)
+        else:
+            _draw_static_block(c, g, order_id, customer)
+        c.setFont(FONT_NAME, g["other_font"])
+        c.drawString(g["left_x"], g["y3"], f"BOX: # {i + 1} / {box_qty}")
+        c.showPage()
+
+def create_pdf_80x50_left(order_id, customer, box_qty):
+    """
+    Create PDF file ORDER_<order_id>.pdf with box_qty pages (copied from
+    RENDER_CACHE when the same order was rendered with the same settings before).
+    """
+    filename = f"ORDER_{order_id}.pdf"
+    key = RENDER_CACHE.key("pdf", str(order_id), str(customer), int(box_qty), PAGE_W_MM, PAGE_H_MM,
+                           MARGIN_MM, FONT_TTF, PDF_BARCODE, PDF_USE_FORMS)
+    cached = RENDER_CACHE.get(key, "pdf")
+    if cached:
+        import shutil
+        shutil.copyfile(cached, filename)
+        return filename
+    ensure_pdf_backend()
+    pagesize = (PAGE_W_MM * mm, PAGE_H_MM * mm)
+    try:
+        with METRICS.span("pdf_render", order=str(order_id), boxes=int(box_qty)):
+            c = canvas.Canvas(filename, pagesize=pagesize)
+            draw_order_pages(c, order_id, customer, box_qty, pagesize)
+            c.save()
+        RENDER_CACHE.put_file(key, "pdf", filename)
+        return filename
+    except Exception:
+        try:
+            if os.path.exists(filename):
+                os.remove(filename)
+        except:
+            pass
+        raise
+
+# ---------- Parallel PDF rendering (Desktop batches) ----------
+PDF_WORKERS = None        # processes for batch rendering (None = CPU count)
+PDF_CHUNK_ORDERS = 25     # max orders per worker task
+
+def _render_pdf_chunk(task):
+    """Worker: render orders into one PDF at out_path, or ORDER_<id>.pdf each when out_path is None."""
+    orders, out_path = task
+    ensure_pdf_backend()
+    if out_path is None:
+        return [create_pdf_80x50_left(*o) for o in orders]
+    pagesize = (PAGE_W_MM * mm, PAGE_H_MM * mm)
+    c = canvas.Canvas(out_path, pagesize=pagesize)
+    for oid, cust, box in orders:
+        draw_order_pages(c, oid, cust, box, pagesize)
+    c.save()
+    return [out_path]
+
+def pdf_process_pool(workers=None):
+    """
+    Process pool for PDF rendering. Workers re-import this module, so Kivy must
+    not parse their argv; fork is used on Linux where it is safe and fast.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    os.environ.setdefault("KIVY_NO_ARGS", "1")
+    ctx = multiprocessing.get_context("fork" if sys.platform.startswith("linux") else "spawn")
+    return ProcessPoolExecutor(max_workers=workers or PDF_WORKERS or os.cpu_count() or 1, mp_context=ctx)
+
+def merge_pdfs(parts, out_path):
+    """Concatenate PDFs in order (needs pypdf)."""
+    from pypdf import PdfWriter
+    writer = PdfWriter()
+    for p in parts:
+        writer.append(p)
+    tmp = out_path + ".tmp"
+    with open(tmp, "wb") as f:
+        writer.write(f)
+    os.replace(tmp, out_path)
+
+def render_orders_pdf(orders, merged_path=None, executor=None, workers=None):
+    """
+    Render many (order_id, customer, box_qty) orders, spread across processes.
+    - merged_path None: ORDER_<id>.pdf per order, paths returned in input order.
+    - merged_path set: one print-ready PDF with every order's pages in input
+      order (workers render consecutive runs; the runs are merged with pypdf,
+      or drawn serially into one canvas when pypdf is not installed).
+    """
+    orders = [(str(o), str(c), int(b)) for o, c, b in orders]
+    if not orders:
+        return []
+    n_workers = workers or PDF_WORKERS or os.cpu_count() or 1
+    if merged_path:
+        try:
+            import pypdf  # noqa: F401
+        except ImportError:
+            return _render_pdf_chunk((orders, merged_path))
+    size = max(1, min(PDF_CHUNK_ORDERS, -(-len(orders) // n_workers)))
+    chunks = [orders[i:i + size] for i in range(0, len(orders), size)]
+    if merged_path:
+        outs = [f"{merged_path}.part{k:05d}" for k in range(len(chunks))]
+    else:
+        outs = [None] * len(chunks)
+    tasks = list(zip(chunks, outs))
+    if len(tasks) == 1 or (executor is None and n_workers <= 1):
+        results = [_render_pdf_chunk(t) for t in tasks]
+    elif executor is not None:
+        results = list(executor.map(_render_pdf_chunk, tasks))
+    else:
+        with pdf_process_pool(n_workers) as ex:
+            results = list(ex.map(_render_pdf_chunk, tasks))
+    if not merged_path:
+        return [p for r in results for p in r]
+    try:
+        if len(outs) == 1:
+            os.replace(outs[0], merged_path)
+        else:
+            merge_pdfs(outs, merged_path)
+    finally:
+        for p in outs:
+            try:
+                if os.path.exists(p):
+                    os.remove(p)
+            except OSError:
+                pass
+    return [merged_path]
+
+# ---------- OPEN PDF (Desktop) ----------
+def open_pdf_by_platform(path):
+    """Open PDF using OS default application (desktop only)."""
+    abs_path = os.path.abspath(path)
+    try:
+        if platform == "win":
+            os.startfile(abs_path)
+        elif platform == "macosx":
+            subprocess.call(["open", abs_path])
+        else:
+            # linux
+            subprocess.call(["xdg-open", abs_path])
+    except Exception as e:
+        print("open_pdf error:", e)
+
+# ---------- Platform helper ----------
+def is_android():
+    """Return True when running on Android (Kivy/p4a)."""
+    return platform == "android"
+
+# ---------- ESC/POS bytes builder ----------
+ESC_RESET = b'\x1b\x40'
+ESC_CUT = b'\x1d\x56\x00'
+DLE_EOT = b'\x10\x04'  # + n: real-time status (1 printer, 2 offline cause, 4 paper sensor)
+
+# Text encoding sent to the printer. "cp1258" prints Vietnamese natively on most
+# thermal printers (selected with ESC t 52 - check your printer's self-test page
+# and adjust ESCPOS_CODEPAGES if its table differs). "ascii" strips diacritics.
+ESCPOS_CODEPAGE = "cp1258"
+ESCPOS_CODEPAGES = {"cp1258": 52, "cp1252": 16, "cp437": 0, "ascii": None, "utf-8": None}
+LABEL_LAYOUT_FILE = "label_layout.json"  # optional user layout (same format as DEFAULT_LABEL_LAYOUT)
+
+# One entry per printed line. "text" is a format string over order_id, customer,
+# box, total and the extra fields (date, station and LABEL_EXTRA_FIELDS; unknown
+# names print empty); "size" is (width, height) 1..8; "align" is
+# left/center/right; "bold" True/False. {"feed": n} adds n blank lines;
+# {"barcode": fmt} / {"qr": fmt} print a Code 128 / QR symbol (see Barcodes / QR).
+# The cut is appended after the last line. A layout file that does not follow
+# this format is ignored (with a warning) in favour of DEFAULT_LABEL_LAYOUT.
+DEFAULT_LABEL_LAYOUT = [
+    {"text": "{order_id}", "size": [2, 2]},
+    {"text": "{customer}"},
+    {"barcode": "{order_id}", "height": 60},
+    {"text": "BOX: #{box}/{total}"},
+    {"feed": 2},
+]
+LABEL_EXTRA_FIELDS = {}  # site-wide extra layout fields, e.g. {"warehouse": "Kho HCM"}
+LABEL_DATE_FORMAT = "%d/%m/%Y"  # {date} on the label
+
+_VN_TONE_MARKS = "\u0300\u0301\u0303\u0309\u0323"  # the combining marks CP1258 carries
+
+def transliterate_ascii(text):
+    """Vietnamese (and other Latin) text without diacritics: 'Nguyễn Đức' -> 'Nguyen Duc'."""
+    text = text.replace("đ", "d").replace("Đ", "D")
+    out = unicodedata.normalize("NFD", text)
+    return "".join(ch for ch in out if not unicodedata.combining(ch))
+
+def _cp1258_form(text):
+    """
+    CP1258 has precomposed â ê ô ơ ư ă but tones only as combining marks,
+    so split each letter into (base with vowel mark) + tone mark.
+    """
+    out = []
+    for ch in unicodedata.normalize("NFC", text):
+        d = unicodedata.normalize("NFD", ch)
+        tones = "".join(c for c in d if c in _VN_TONE_MARKS)
+        if not tones:
+            out.append(ch)
+            continue
+        base = unicodedata.normalize("NFC", "".join(c for c in d if c not in _VN_TONE_MARKS))
+        out.append(base + tones)
+    return "".join(out)
+
+@functools.lru_cache(maxsize=4096)
+def encode_printer_text(text, codepage=None):
+    """Encode text for the printer's code page (memoized). Unmappable characters are transliterated."""
+    codepage = codepage or ESCPOS_CODEPAGE
+    if codepage == "utf-8":
+        return text.encode("utf-8", errors="replace")
+    if codepage == "ascii":
+        return transliterate_ascii(text).encode("ascii", errors="replace")
+    if codepage == "cp1258":
+        text = _cp1258_form(text)
+    try:
+        return text.encode(codepage)
+    except UnicodeEncodeError:
+        b = bytearray()
+        for ch in text:
+            try:
+                b += ch.encode(codepage)
+            except UnicodeEncodeError:
+                b += transliterate_ascii(ch).encode("ascii", errors="replace")
+        return bytes(b)
+
+def escpos_codepage_select(codepage=None):
+    """ESC t n for codepage ('' when the printer default is used)."""
+    n = ESCPOS_CODEPAGES.get(codepage or ESCPOS_CODEPAGE)
+    return b'' if n is None else b'\x1b\x74' + bytes([n])
+
+class LabelFields(dict):
+    """Fields of a layout line; a placeholder with no value prints empty instead of failing the job."""
+    def __missing__(self, key):
+        return ""
+
+def label_extra_fields(extra=None, layout=None):
+    """
+    Extra layout fields: {date}, {station}, LABEL_EXTRA_FIELDS, then extra; with a
+    layout only the ones it uses (so {date} does not change the cache key of
+    layouts that don't print it).
+    """
+    used = None if layout is None else _layout_field_names(layout)
+    if used is not None and not used:
+        return {}
+    fields = {"station": STATION_ID}
+    if used is None or "date" in used:
+        fields["date"] = datetime.now().strftime(LABEL_DATE_FORMAT)
+    fields.update(LABEL_EXTRA_FIELDS)
+    fields.update(extra or {})
+    return {str(k): str(v) for k, v in fields.items() if used is None or str(k) in used}
+
+_layout_names_memo = (None, None)  # (layout, names) of the last layout asked about
+
+def _layout_field_names(layout):
+    """Field names a layout's format strings use, beyond order_id/customer/box/total."""
+    global _layout_names_memo
+    last, names = _layout_names_memo
+    if layout is not last:
+        formatter = string.Formatter()
+        names = {re.split(r"[.\[]", name)[0]
+                 for line in layout if isinstance(line, dict)
+                 for key in ("text", "barcode", "qr") if isinstance(line.get(key), str)
+                 for _, name, _, _ in formatter.parse(line[key]) if name}
+        names = frozenset(names - {"order_id", "customer", "box", "total"})
+        _layout_names_memo = (layout, names)
+    return names
+
+_LAYOUT_INT_KEYS = ("feed", "height", "module")
+
+def validate_label_layout(layout):
+    """Raise ValueError describing the first malformed entry of a layout."""
+    if not isinstance(layout, list) or not layout:
+        raise ValueError("layout must be a non-empty list")
+    sample = LabelFields(order_id="SO-1", customer="A", box=1, total=1, **label_extra_fields())
+    for n, line in enumerate(layout, 1):
+        if not isinstance(line, dict):
+            raise ValueError(f"line {n}: not an object")
+        for key in _LAYOUT_INT_KEYS:
+            if key in line and (type(line[key]) is not int or line[key] < 0):
+                raise ValueError(f"line {n}: {key} must be a whole number")
+        if "feed" in line:
+            continue
+        size = line.get("size", [1, 1])
+        if not isinstance(size, (list, tuple)) or len(size) != 2 or any(type(v) is not int for v in size):
+            raise ValueError(f"line {n}: size must be [width, height]")
+        if line.get("align", "left") not in ("left", "center", "right"):
+            raise ValueError(f"line {n}: align must be left, center or right")
+        fmt = line.get("barcode", line.get("qr", line.get("text")))
+        if not isinstance(fmt, str):
+            raise ValueError(f"line {n}: needs a text, barcode or qr format string")
+        try:
+            fmt.format_map(sample)
+        except (ValueError, KeyError, IndexError, AttributeError, TypeError) as e:
+            raise ValueError(f"line {n}: bad format {fmt!r}: {e}")
+
+def load_label_layout():
+    """User layout from LABEL_LAYOUT_FILE if it is valid, else DEFAULT_LABEL_LAYOUT."""
+    if os.path.exists(LABEL_LAYOUT_FILE):
+        try:
+            with open(LABEL_LAYOUT_FILE, "r", encoding="utf-8") as f:
+                layout = json.load(f)
+            validate_label_layout(layout)
+            return layout
+        except Exception as e:
+            print("Warning: cannot load label layout, using the default:", e)
+    return DEFAULT_LABEL_LAYOUT
+
+def _escpos_line_style(line):
+    w, h = line.get("size", (1, 1))
+    w = max(1, min(int(w), 8))
+    h = max(1, min(int(h), 8))
+    align = {"left": 0, "center": 1, "right": 2}.get(line.get("align", "left"), 0)
+    return (b'\x1b\x61' + bytes([align]) +
+            b'\x1d\x21' + bytes([((w - 1) << 4) | (h - 1)]) +
+            b'\x1b\x45' + (b'\x01' if line.get("bold") else b'\x00'))
+
+class LabelTemplate:
+    """
+    Label compiled once per order: everything except lines that use {box}/{total} is
+    encoded up front, so a box costs one small encoded line plus shared bytes.
+    label_parts() returns a tuple of bytes segments (static ones are the same
+    objects for every box) that the streamer writes without joining per box.
+    """
+    def __init__(self, job_header, segments, fields, codepage):
+        self.job_header = job_header  # reset + code page, sent once per job
+        self.segments = segments      # list of bytes (static) or (style, fmt, code_line) (per box)
+        self.fields = fields
+        self.codepage = codepage
+
+    def label_parts(self, box_index, box_total):
+        parts = []
+        for seg in self.segments:
+            if isinstance(seg, bytes):
+                parts.append(seg)
+            else:
+                style, fmt, code_line = seg
+                text = fmt.format_map(LabelFields(self.fields, box=box_index, total=box_total))
+                if code_line is not None:
+                    parts.append(escpos_barcode_line(code_line, text))
+                else:
+                    parts.append(style + encode_printer_text(text, self.codepage) + b'\n')
+        return tuple(parts)
+
+    def label_bytes(self, box_index, box_total):
+        """Standalone label: header + label."""
+        return self.job_header + b"".join(self.label_parts(box_index, box_total))
+
+    def job_parts(self, box_total):
+        """Whole order: one header, then every label (first label carries the header)."""
+        labels = [self.label_parts(i + 1, box_total) for i in range(int(box_total))]
+        if labels:
+            labels[0] = (self.job_header,) + labels[0]
+        return labels
+
+def compile_label_template(order_id, customer, layout=None, codepage=None, extra=None):
+    """LabelTemplate for an order; extra fields default to label_extra_fields()."""
+    if ESCPOS_LABEL_MODE == "raster":
+        tpl = compile_raster_template(order_id, customer)
+        if tpl is not None:
+            return tpl
+    layout = layout or load_label_layout()
+    codepage = codepage or ESCPOS_CODEPAGE
+    extra = label_extra_fields(layout=layout) if extra is None else extra
+    key = json.dumps([str(order_id), str(customer), layout, codepage, extra],
+                     sort_keys=True, ensure_ascii=False)
+    return _compile_label_template(key)
+
+@functools.lru_cache(maxsize=64)
+def _compile_label_template(key):
+    order_id, customer, layout, codepage, extra = json.loads(key)
+    fields = LabelFields(extra)
+    fields.update(order_id=order_id, customer=customer)
+    formatter = string.Formatter()
+    segments = []
+    static = bytearray()
+    for line in layout:
+        if "feed" in line:
+            static += b'\n' * int(line["feed"])
+            continue
+        code_line = line if "barcode" in line or "qr" in line else None
+        fmt = str(line.get("barcode") or line.get("qr") or "") if code_line else str(line.get("text", ""))
+        names = {name for _, name, _, _ in formatter.parse(fmt) if name}
+        style = _escpos_line_style(line)
+        if names & {"box", "total"}:
+            if static:
+                segments.append(bytes(static))
+                static = bytearray()
+            segments.append((style, fmt, code_line))
+        elif code_line is not None:
+            static += escpos_barcode_line(code_line, fmt.format_map(fields))
+        else:
+            text = fmt.format_map(fields)
+            static += style + encode_printer_text(text, codepage) + b'\n'
+    static += ESC_CUT
+    segments.append(bytes(static))
+    header = ESC_RESET + escpos_codepage_select(codepage)
+    return LabelTemplate(header, segments, fields, codepage)
+
+def escpos_bytes_for_label(order_id, customer, box_index, box_total, encoding=None, extra=None):
+    """
+    Build ESC/POS bytes for a single label (reset + code page + label + cut).
+    Layout comes from load_label_layout(); encoding overrides ESCPOS_CODEPAGE;
+    extra adds layout fields (label_extra_fields).
+    NOTE: Each printer differs; adjust sequences to your printer manual.
+    """
+    layout = load_label_layout()
+    tpl = compile_label_template(order_id, customer, layout=layout, codepage=encoding,
+                                 extra=label_extra_fields(extra, layout))
+    return tpl.label_bytes(box_index, box_total)
+
+def escpos_job_for_order(order_id, customer, box_total, encoding=None, layout=None, extra=None):
+    """
+    Whole order as one job: a single reset/code page, then every label with its
+    own feed+cut. Returned per label (tuples of byte segments) so the streamer
+    can report progress per label.
+    """
+    layout = layout or load_label_layout()
+    tpl = compile_label_template(order_id, customer, layout=layout, codepage=encoding,
+                                 extra=label_extra_fields(extra, layout))
+    return tpl.job_parts(box_total)
+
+def _pack_records(records):
+    return b"".join(len(r).to_bytes(4, "big") + r for r in records)
+
+def _unpack_records(data):
+    out = []
+    pos = 0
+    while pos + 4 <= len(data):
+        n = int.from_bytes(data[pos:pos + 4], "big")
+        out.append(data[pos + 4:pos + 4 + n])
+        pos += 4 + n
+    return out
+
+ESCPOS_LABELS_MEMO_BYTES = 8 * 1024 * 1024  # label lists of recent orders kept in memory
+_escpos_labels_memo = {}  # cache key -> ((header, labels), bytes), least recently used first
+_escpos_labels_memo_lock = threading.Lock()
+_escpos_labels_memo_bytes = 0
+
+def _memo_labels(key, value=None):
+    """Get (value None) or store the label list of an order in the in-memory LRU."""
+    global _escpos_labels_memo_bytes
+    with _escpos_labels_memo_lock:
+        entry = _escpos_labels_memo.pop(key, None)
+        if value is None:
+            if entry is None:
+                return None
+        else:
+            if entry is not None:
+                _escpos_labels_memo_bytes -= entry[1]
+            entry = (value, len(value[0]) + sum(map(len, value[1])))
+            _escpos_labels_memo_bytes += entry[1]
+        _escpos_labels_memo[key] = entry
+        for k in list(_escpos_labels_memo):
+            if _escpos_labels_memo_bytes <= ESCPOS_LABELS_MEMO_BYTES or k == key:
+                break
+            _escpos_labels_memo_bytes -= _escpos_labels_memo.pop(k)[1]
+        return entry[0]
+
+def escpos_job_labels(order_id, customer, box_total, extra=None):
+    """
+    (job_header, [label bytes for box 1..box_total]) for the current layout
+    (extra adds layout fields, see label_extra_fields).
+    Reprints / repeated orders reuse the list itself while it is in memory,
+    and are read back from RENDER_CACHE after that (or a restart).
+    """
+    box_total = int(box_total)
+    layout = load_label_layout()
+    extra = label_extra_fields(extra, layout)
+    raster = (PAGE_W_MM, PAGE_H_MM, MARGIN_MM, FONT_TTF, PDF_BARCODE, ESCPOS_DOTS_PER_MM, RASTER_BAND_ROWS) \
+        if ESCPOS_LABEL_MODE == "raster" else None
+    key = RENDER_CACHE.key("escpos", str(order_id), str(customer), box_total, layout, extra,
+                           ESCPOS_CODEPAGE, ESCPOS_BARCODE_MODE, ESCPOS_RASTER_MAX_DOTS, ESCPOS_LABEL_MODE, raster)
+    if RENDER_CACHE.enabled:
+        memo = _memo_labels(key)
+        if memo is not None:
+            return memo
+    cached = RENDER_CACHE.get(key, "escpos")
+    if cached:
+        try:
+            with open(cached, "rb") as f:
+                records = _unpack_records(f.read())
+            if len(records) == box_total + 1:
+                return _memo_labels(key, (records[0], records[1:]))
+        except OSError:
+            pass
+    tpl = compile_label_template(order_id, customer, layout=layout, extra=extra)
+    labels = [b"".join(tpl.label_parts(b, box_total)) for b in range(1, box_total + 1)]
+    RENDER_CACHE.put_bytes(key, "escpos", _pack_records([tpl.job_header] + labels))
+    if RENDER_CACHE.enabled:
+        _memo_labels(key, (tpl.job_header, labels))
+    return tpl.job_header, labels
+
+# ---------- Barcodes / QR ----------
+# A layout line {"barcode": "{order_id}"} prints a Code 128, {"qr": "{order_id}"} a
+# QR code. Optional keys: "height" (dots, Code 128), "module" (dots per bar / cell),
+# "hri" (print the text under a Code 128), "align", "raster" (force a bitmap).
+# Native GS k / GS ( k commands cost a few dozen bytes on the link. Printers without
+# them (ESCPOS_BARCODE_MODE = "raster", or "raster": true on the line) get a GS v 0
+# bitmap, built once per data string (escpos_barcode_bytes is cached) and shared by
+# every box of the order.
+ESCPOS_BARCODE_MODE = "native"     # "native" / "raster"
+ESCPOS_RASTER_MAX_DOTS = 576       # printable width in dots (80 mm head at 203 dpi; 58 mm: 384)
+
+# Code 128 bar/space widths for values 0..105, then the stop pattern.
+_CODE128_PATTERNS = (
+    "212222 222122 222221 121223 121322 131222 122213 122312 132212 221213 "
+    "221312 231212 112232 122132 122231 113222 123122 123221 223211 221132 "
+    "221231 213212 223112 312131 311222 321122 321221 312212 322112 322211 "
+    "212123 212321 232121 111323 131123 131321 112313 132113 132311 211313 "
+    "231113 231311 112133 112331 132131 113123 113321 133121 313121 211331 "
+    "231131 213113 213311 213131 311123 311321 331121 312113 312311 332111 "
+    "314111 221411 431111 111224 111422 121124 121421 141122 141221 112214 "
+    "112412 122114 122411 142112 142211 241211 221114 413111 241112 134111 "
+    "111242 121142 121241 114212 124112 124211 411212 421112 421211 212141 "
+    "214121 412121 111143 111341 131141 114113 114311 411113 411311 113141 "
+    "114131 311141 411131 211412 211214 211232"
+).split()
+_CODE128_STOP = "2331112"
+
+def code128_values(data):
+    """Code 128 symbol values (start, data, checksum; no stop). All-digit data of even length uses code C."""
+    if len(data) >= 4 and len(data) % 2 == 0 and data.isdigit():
+        values = [105] + [int(data[i:i + 2]) for i in range(0, len(data), 2)]
+    else:
+        values = [104] + [ord(ch) - 32 for ch in data if 32 <= ord(ch) < 128]
+    values.append((values[0] + sum(i * v for i, v in enumerate(values[1:], 1))) % 103)
+    return values
+
+def code128_widths(data):
+    """Module widths, alternating bar / space, starting with a bar."""
+    return [int(w) for v in code128_values(data) for w in _CODE128_PATTERNS[v]] + \
+           [int(w) for w in _CODE128_STOP]
+
+def qr_matrix(data):
+    """QR modules as rows of booleans (error correction M), or None without an encoder."""
+    try:
+        import qrcode
+        q = qrcode.QRCode(border=0, error_correction=qrcode.constants.ERROR_CORRECT_M)
+        q.add_data(data)
+        q.make(fit=True)
+        return q.get_matrix()
+    except ImportError:
+        pass
+    try:
+        from reportlab.graphics.barcode.qrencoder import QRCode, QRErrorCorrectLevel
+    except ImportError:
+        return None
+    q = QRCode(None, QRErrorCorrectLevel.M)
+    q.addData(data)
+    q.make()
+    n = q.getModuleCount()
+    return [[q.isDark(r, c) for c in range(n)] for r in range(n)]
+
+def _gs_v0(nbytes, nrows, data, mode=0):
+    """GS v 0 m: nrows rows of nbytes packed bytes (mode 2 prints every row twice)."""
+    return (b'\x1d\x76\x30' + bytes([mode, nbytes & 0xFF, nbytes >> 8, nrows & 0xFF, nrows >> 8])
+            + bytes(data))
+
+def escpos_raster(rows):
+    """GS v 0 raster image from rows of 0/1 pixels (all rows the same width)."""
+    width = len(rows[0])
+    nbytes = (width + 7) // 8
+    data = bytearray()
+    for row in rows:
+        bits = "".join("1" if px else "0" for px in row).ljust(nbytes * 8, "0")
+        data += int(bits, 2).to_bytes(nbytes, "big")
+    return _gs_v0(nbytes, len(rows), data)
+
+def _code128_native(data, height, module, hri):
+    values = code128_values(data)
+    if values[0] == 105:
+        payload = b"{C" + bytes(values[1:-1])
+    else:
+        payload = b"{B" + data.encode("ascii", "ignore").replace(b"{", b"{{")
+    return (b'\x1d\x68' + bytes([max(1, min(height, 255))]) +
+            b'\x1d\x77' + bytes([max(2, min(module, 6))]) +
+            b'\x1d\x48' + (b'\x02' if hri else b'\x00') +
+            b'\x1d\x6b\x49' + bytes([len(payload)]) + payload + b'\n')
+
+def _qr_native(data, module):
+    raw = data.encode("utf-8")
+    n = len(raw) + 3
+    return (b'\x1d\x28\x6b\x04\x00\x31\x41\x32\x00' +                    # model 2
+            b'\x1d\x28\x6b\x03\x00\x31\x43' + bytes([max(1, min(module, 16))]) +
+            b'\x1d\x28\x6b\x03\x00\x31\x45\x31' +                          # error correction M
+            b'\x1d\x28\x6b' + bytes([n & 0xFF, n >> 8]) + b'\x31\x50\x30' + raw +
+            b'\x1d\x28\x6b\x03\x00\x31\x51\x30\n')
+
+def _code128_raster(data, height, module):
+    widths = code128_widths(data)
+    quiet = 10
+    while module > 1 and (sum(widths) + 2 * quiet) * module > ESCPOS_RASTER_MAX_DOTS:
+        module -= 1
+    row = [0] * (quiet * module)
+    bar = True
+    for w in widths:
+        row += [1 if bar else 0] * (w * module)
+        bar = not bar
+    row += [0] * (quiet * module)
+    return escpos_raster([row] * height) + b'\n'
+
+def _qr_raster(data, module):
+    matrix = qr_matrix(data)
+    if matrix is None:
+        return None
+    size = len(matrix) + 8  # 4-module quiet zone
+    module = max(1, min(module, ESCPOS_RASTER_MAX_DOTS // size))
+    rows = []
+    for r in range(-4, len(matrix) + 4):
+        src = matrix[r] if 0 <= r < len(matrix) else []
+        row = []
+        for c in range(-4, len(matrix) + 4):
+            row += [1 if 0 <= c < len(src) and src[c] else 0] * module
+        rows.extend([row] * module)
+    return escpos_raster(rows) + b'\n'
+
+@functools.lru_cache(maxsize=256)
+def escpos_barcode_bytes(kind, data, height=60, module=3, hri=False, raster=False):
+    """
+    ESC/POS bytes for one Code 128 ("barcode") or QR ("qr") symbol. Cached, so
+    every box of an order (and reprints) reuse the encoded / rasterized symbol.
+    """
+    if kind == "qr":
+        if raster:
+            img = _qr_raster(data, module)
+            if img is not None:
+                return img
+            print("Warning: no QR encoder for raster mode (install qrcode); printing a Code 128 instead")
+            kind = "barcode"
+        else:
+            return _qr_native(data, module)
+    data = transliterate_ascii(data)  # Code 128 carries ASCII only
+    if raster:
+        return _code128_raster(data, height, module)
+    return _code128_native(data, height, module, hri)
+
+def escpos_barcode_line(line, data):
+    """Bytes for a layout line with a "barcode" or "qr" key (alignment applied)."""
+    kind = "qr" if "qr" in line else "barcode"
+    raster = bool(line.get("raster", ESCPOS_BARCODE_MODE == "raster"))
+    align = {"left": 0, "center": 1, "right": 2}.get(line.get("align", "left"), 0)
+    return (b'\x1b\x61' + bytes([align]) +
+            escpos_barcode_bytes(kind, data, int(line.get("height", 60)),
+                                 int(line.get("module", 6 if kind == "qr" else 2)),
+                                 bool(line.get("hri")), raster))
+
+# ---------- Raster labels (GS v 0, bundled font) ----------
+# ESCPOS_LABEL_MODE = "raster" prints the PDF label (label_geometry: PAGE_W_MM x
+# PAGE_H_MM, order id / customer / PDF_BARCODE / BOX line) as bitmaps drawn with
+# FONT_TTF, so any Vietnamese name prints exactly as on the PDF whatever code pages
+# the printer has (label_layout.json does not apply in this mode). Needs Pillow.
+# The order id / customer / barcode block is rasterized once per order; per box only
+# the BOX strip is composed from cached glyph bitmaps (strips are cached too, so
+# "BOX: # 3 / 10" is drawn once for every 10-box order). Images go out in bands:
+# blank bands become a paper feed, each band is cut after its last inked byte and
+# bands of duplicated rows (barcode bars) are sent at half height. With
+# ESCPOS_BARCODE_MODE = "native" a Code 128 stays a GS k command between the bands.
+ESCPOS_LABEL_MODE = "text"   # "text" (printer fonts + code page) / "raster"
+ESCPOS_DOTS_PER_MM = 8       # 203 dpi head
+RASTER_BAND_ROWS = 24        # rows per GS v 0 band
+
+@functools.lru_cache(maxsize=1)
+def raster_backend():
+    """Font file for raster labels, or None (warned once) without Pillow or FONT_TTF."""
+    try:
+        import PIL.ImageFont  # noqa: F401
+    except ImportError:
+        print("Warning: raster labels need Pillow; printing text labels instead")
+        return None
+    path = font_path()
+    if path is None:
+        print("Warning: raster labels need", FONT_TTF, "; printing text labels instead")
+    return path
+
+@functools.lru_cache(maxsize=32)
+def raster_font(size_px):
+    from PIL import ImageFont
+    return ImageFont.truetype(raster_backend(), size_px)
+
+@functools.lru_cache(maxsize=2048)
+def raster_glyph(ch, size_px):
+    """(mask image or None, x offset, y offset from the baseline, advance) of one character."""
+    from PIL import Image, ImageDraw
+    font = raster_font(size_px)
+    x0, y0, x1, y1 = font.getbbox(ch, anchor="ls")
+    advance = font.getlength(ch)
+    if x1 <= x0 or y1 <= y0:
+        return None, 0, 0, advance
+    mask = Image.new("1", (x1 - x0, y1 - y0), 0)
+    ImageDraw.Draw(mask).text((-x0, -y0), ch, font=font, fill=1, anchor="ls")
+    return mask, x0, y0, advance
+
+def raster_fit(text, size_px, max_w):
+    """Longest prefix of text that fits max_w dots at size_px."""
+    font = raster_font(size_px)
+    if font.getlength(text) <= max_w:
+        return text
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if font.getlength(text[:mid]) <= max_w:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo]
+
+def raster_fit_size(text, size_px, max_w):
+    """size_px, or the largest smaller size at which the whole text fits max_w dots."""
+    while size_px > 1 and raster_font(size_px).getlength(text) > max_w:
+        size_px = min(size_px - 1, int(size_px * max_w / raster_font(size_px).getlength(text)))
+    return max(1, size_px)
+
+def _feed_dots(n):
+    """ESC J: feed n dots (split into <= 255 per command)."""
+    out = bytearray()
+    while n > 0:
+        out += b'\x1b\x4a' + bytes([min(n, 255)])
+        n -= 255
+    return bytes(out)
+
+def escpos_raster_bands(img, band_rows=None):
+    """
+    GS v 0 bytes for a mode "1" image (set pixels print) in bands of band_rows:
+    blank bands become ESC J feeds, every band is trimmed after its last inked
+    byte, and a band whose rows repeat in pairs goes out at half height (m=2).
+    """
+    band_rows = band_rows or RASTER_BAND_ROWS
+    width, height = img.size
+    stride = (width + 7) // 8
+    data = img.tobytes()
+    out = bytearray()
+    feed = 0
+    for top in range(0, height, band_rows):
+        rows = [data[r * stride:(r + 1) * stride] for r in range(top, min(top + band_rows, height))]
+        nbytes = max(len(r.rstrip(b"\0")) for r in rows)
+        if nbytes == 0:
+            feed += len(rows)
+            continue
+        out += _feed_dots(feed)
+        feed = 0
+        rows = [r[:nbytes] for r in rows]
+        if len(rows) % 2 == 0 and rows[0::2] == rows[1::2]:
+            out += _gs_v0(nbytes, len(rows) // 2, b"".join(rows[0::2]), mode=2)
+        else:
+            out += _gs_v0(nbytes, len(rows), b"".join(rows))
+    return bytes(out + _feed_dots(feed))
+
+def _draw_raster_glyphs(img, text, size_px, x, baseline):
+    for ch in text:
+        mask, dx, dy, advance = raster_glyph(ch, size_px)
+        if mask is not None:
+            img.paste(1, (int(round(x)) + dx, baseline + dy), mask)
+        x += advance
+
+@functools.lru_cache(maxsize=8)
+def raster_geometry(page_w_mm, page_h_mm, barcode, dots_per_mm):
+    """
+    label_geometry() in printer dots (y measured from the top). "split" is the
+    first row of the per-box strip: below the barcode, or just above the BOX line.
+    """
+    g = dict(label_geometry((page_w_mm * mm, page_h_mm * mm), barcode))
+    scale = dots_per_mm / mm  # dots per point
+    height = page_h_mm * mm
+    r = {
+        "width": int(page_w_mm * dots_per_mm), "height": int(page_h_mm * dots_per_mm),
+        "x": int(g["left_x"] * scale), "max_w": int(g["max_w"] * scale),
+        "order_px": int(round(g["order_font"] * scale)), "other_px": int(round(g["other_font"] * scale)),
+        "y1": int((height - g["y1"]) * scale), "y2": int((height - g["y2"]) * scale),
+        "y3": int((height - g["y3"]) * scale), "barcode": g.get("barcode"),
+    }
+    if r["barcode"]:
+        r.update(bar_x=int(g["bar_x"] * scale), bar_w=int(g["bar_w"] * scale),
+                 bar_top=int((height - g["bar_y"] - g["bar_h"]) * scale),
+                 bar_bottom=int((height - g["bar_y"]) * scale))
+    if r["barcode"] == "code128":
+        r["split"] = r["bar_bottom"]
+    else:
+        r["split"] = r["y3"] - int(r["other_px"] * 0.9)
+    return r
+
+def _raster_barcode(img, r, data):
+    """Code 128 / QR of data into the geometry's barcode box."""
+    from PIL import ImageDraw
+    d = ImageDraw.Draw(img)
+    if r["barcode"] == "qr":
+        matrix = qr_matrix(data)
+        if matrix is None:
+            print("Warning: no QR encoder for raster labels (install qrcode); label printed without it")
+            return
+        module = max(1, r["bar_w"] // len(matrix))
+        for y, row in enumerate(matrix):
+            for x, dark in enumerate(row):
+                if dark:
+                    d.rectangle((r["bar_x"] + x * module, r["bar_top"] + y * module,
+                                 r["bar_x"] + (x + 1) * module - 1, r["bar_top"] + (y + 1) * module - 1), fill=1)
+        return
+    widths = code128_widths(transliterate_ascii(data))
+    module = max(1, min(r["bar_w"] // sum(widths), ESCPOS_DOTS_PER_MM // 2))  # PDF caps bars at 0.5 mm
+    x = r["bar_x"] + (r["bar_w"] - sum(widths) * module) // 2
+    for i, w in enumerate(widths):
+        if i % 2 == 0:
+            d.rectangle((x, r["bar_top"], x + w * module - 1, r["bar_bottom"] - 1), fill=1)
+        x += w * module
+
+class RasterLabelTemplate(LabelTemplate):
+    """
+    Label rasterized with FONT_TTF (ESCPOS_LABEL_MODE = "raster"): one static
+    segment per order (order id, customer, barcode) and a BOX strip per box.
+    """
+    def __init__(self, job_header, static, strip):
+        super().__init__(job_header, [static], {}, None)
+        self.static = static
+        self.strip = strip  # raster_strip() arguments after the text
+
+    def label_parts(self, box_index, box_total):
+        return (self.static, raster_strip(f"BOX: # {box_index} / {box_total}", *self.strip))
+
+@functools.lru_cache(maxsize=1024)
+def raster_strip(text, width, height, x, baseline, size_px, max_w):
+    """Per-box strip (rows from the split to the label end) + cut."""
+    from PIL import Image
+    img = Image.new("1", (width, height), 0)
+    _draw_raster_glyphs(img, raster_fit(text, size_px, max_w), size_px, x, baseline)
+    return escpos_raster_bands(img) + ESC_CUT
+
+def compile_raster_template(order_id, customer):
+    """RasterLabelTemplate for the current page / font settings, or None without Pillow / font."""
+    if raster_backend() is None:
+        return None
+    return _compile_raster_template(str(order_id), str(customer), PAGE_W_MM, PAGE_H_MM, MARGIN_MM,
+                                    FONT_TTF, PDF_BARCODE, ESCPOS_DOTS_PER_MM, ESCPOS_BARCODE_MODE)
+
+@functools.lru_cache(maxsize=64)
+def _compile_raster_template(order_id, customer, page_w_mm, page_h_mm, margin_mm, font, barcode,
+                             dots_per_mm, barcode_mode):
+    from PIL import Image, ImageDraw
+    r = raster_geometry(page_w_mm, page_h_mm, barcode, dots_per_mm)
+    native_bar = r["barcode"] == "code128" and barcode_mode == "native"
+    img = Image.new("1", (r["width"], r["split"]), 0)
+    d = ImageDraw.Draw(img)
+    # order id in bold like the PDF (FONT_NAME1): the regular face with a 1-dot stroke;
+    # shrunk rather than cut like the PDF
+    order_px = raster_fit_size(order_id, r["order_px"], r["max_w"] - 2)
+    d.text((r["x"], r["y1"]), order_id, font=raster_font(order_px), fill=1, anchor="ls", stroke_width=1, stroke_fill=1)
+    d.text((r["x"], r["y2"]), raster_fit(customer, r["other_px"], r["max_w"]), font=raster_font(r["other_px"]),
+           fill=1, anchor="ls")
+    if r["barcode"] and not native_bar:
+        _raster_barcode(img, r, order_id)
+    if native_bar:
+        data = transliterate_ascii(order_id)
+        module = r["bar_w"] // sum(code128_widths(data))
+        # GS k prints at once; drop the line feed escpos_barcode_bytes ends with
+        bar = escpos_barcode_bytes("barcode", data, r["bar_bottom"] - r["bar_top"],
+                                   min(module, ESCPOS_DOTS_PER_MM // 2))[:-1]
+        static = (escpos_raster_bands(img.crop((0, 0, r["width"], r["bar_top"]))) +
+                  b'\x1b\x61\x01' + bar + b'\x1b\x61\x00')
+    else:
+        static = escpos_raster_bands(img)
+    # the PDF does not fit the BOX line either: it may use the full width beside the QR
+    strip = (r["width"], r["height"] - r["split"], r["x"], r["y3"] - r["split"], r["other_px"], r["width"] - 2 * r["x"])
+    return RasterLabelTemplate(ESC_RESET, static, strip)
+
+# ---------- pyjnius Bluetooth helpers (Android) ----------
+PAIRED_CACHE_TTL = 300.0                 # seconds the bonded-device list is reused
+PRINTER_PREFS_FILE = "printer_prefs.json"
+STATION_ID = os.environ.get("ORDER_PRINTER_STATION", "default")  # several stations may share one prefs file
+PRINTER_PRECONNECT = True                # open the remembered printer's link right after startup
+
+@functools.lru_cache(maxsize=None)
+def jclass(name):
+    """autoclass() once per Java class (each lookup is a JNI reflection round-trip)."""
+    from jnius import autoclass
+    return autoclass(name)
+
+_bt_adapter = None
+
+def bluetooth_adapter():
+    """Default BluetoothAdapter, cached once available (None while Bluetooth is unavailable)."""
+    global _bt_adapter
+    if _bt_adapter is None:
+        _bt_adapter = jclass('android.bluetooth.BluetoothAdapter').getDefaultAdapter()
+    return _bt_adapter
+
+def _bonded_devices_pyjnius():
+    adapter = bluetooth_adapter()
+    if adapter is None:
+        return []
+    paired = adapter.getBondedDevices()
+    devices = []
+    # paired could be a Java Set - try toArray then iterate
+    try:
+        arr = paired.toArray()
+        for dev in arr:
+            try:
+                devices.append((dev.getName(), dev.getAddress()))
+            except:
+                continue
+    except:
+        try:
+            it = paired.iterator()
+            while it.hasNext():
+                dev = it.next()
+                try:
+                    devices.append((dev.getName(), dev.getAddress()))
+                except:
+                    continue
+        except Exception:
+            pass
+    return devices
+
+class PrinterRegistry:
+    """
+    Printer discovery cache and remembered default printer.
+    - paired(): bonded devices, cached for `ttl` seconds; invalidate() drops the
+      cache (done when a print fails: the printer may have been re-paired).
+    - default()/remember(): last printer that printed successfully at this
+      station, persisted in PRINTER_PREFS_FILE so the next print skips discovery;
+      forget() drops it when a job finds it unreachable, so discovery runs again.
+    """
+    def __init__(self, prefs_path=PRINTER_PREFS_FILE, station=STATION_ID, ttl=PAIRED_CACHE_TTL):
+        self.prefs_path = prefs_path
+        self.station = station
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._paired = None
+        self._paired_at = 0.0
+        self._prefs = None
+
+    def paired(self):
+        with self._lock:
+            if self._paired is not None and time.monotonic() - self._paired_at < self.ttl:
+                return list(self._paired)
+        with METRICS.span("discovery"):
+            devices = _bonded_devices_pyjnius()
+        with self._lock:
+            if devices:
+                self._paired = list(devices)
+                self._paired_at = time.monotonic()
+        return devices
+
+    def invalidate(self):
+        with self._lock:
+            self._paired = None
+
+    def _load_prefs(self):
+        if self._prefs is None:
+            try:
+                with open(self.prefs_path, "r", encoding="utf-8") as f:
+                    self._prefs = json.load(f)
+            except Exception:
+                self._prefs = {}
+        return self._prefs
+
+    def default(self):
+        """(name, mac) of this station's remembered printer, or None."""
+        with self._lock:
+            p = self._load_prefs().get(self.station)
+        if p and p.get("mac"):
+            return p.get("name") or "", p["mac"]
+        return None
+
+    def remember(self, mac, name=None):
+        with self._lock:
+            prefs = self._load_prefs()
+            if name is None:
+                name = next((n for n, m in (self._paired or []) if m == mac), None)
+            cur = prefs.get(self.station) or {}
+            if cur.get("mac") == mac and (name is None or cur.get("name") == name):
+                return
+            if not name and cur.get("mac") == mac:
+                name = cur.get("name")
+            prefs[self.station] = {"mac": mac, "name": name or ""}
+            self._save_prefs(prefs)
+
+    def forget(self, mac=None):
+        """Drop this station's remembered printer (only if it is mac, when given). True if dropped."""
+        with self._lock:
+            prefs = self._load_prefs()
+            cur = prefs.get(self.station)
+            if cur is None or (mac is not None and cur.get("mac") != mac):
+                return False
+            del prefs[self.station]
+            self._save_prefs(prefs)
+            return True
+
+    def _save_prefs(self, prefs):
+        # temp file + os.replace: a crash mid-write never leaves a truncated prefs file
+        try:
+            tmp = self.prefs_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(prefs, f, ensure_ascii=False)
+            os.replace(tmp, self.prefs_path)
+        except Exception as e:
+            print("Warning: cannot save printer prefs:", e)
+
+    def preconnect(self):
+        """Open the remembered printer's session in the background (best-effort)."""
+        d = self.default()
+        if not d:
+            return
+        def run():
+            try:
+                get_printer_session(d[1]).ensure_connected()
+            except Exception as e:
+                print("preconnect failed:", e)
+        threading.Thread(target=run, name="printer-preconnect", daemon=True).start()
+
+PRINTERS = PrinterRegistry()
+
+def find_paired_printers_pyjnius():
+    """Return list of (name, mac) for bonded devices (cached, see PrinterRegistry). Best-effort."""
+    try:
+        return PRINTERS.paired()
+    except Exception as e:
+        print("find_paired_printers_pyjnius error:", e)
+        return []
+
+# ---------- Printer transports / sessions ----------
+SPP_UUID = "00001101-0000-1000-8000-00805F9B34FB"
+PRINTER_STATUS_TIMEOUT = 1.0  # s to wait for a DLE EOT answer before treating the printer as silent
+
+class PrinterTransport:
+    """
+    Byte stream to one printer. PrinterSession only needs these methods,
+    so a fake (see MemoryTransport) can stand in for a real socket.
+    read_byte() / discard_input() give the bytes the printer sends back
+    (status replies); transports without an input side never answer.
+    """
+    def connect(self):
+        raise NotImplementedError
+
+    def write(self, data):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def read_byte(self, timeout):
+        """Next byte from the printer, or None after timeout seconds."""
+        return None
+
+    def discard_input(self):
+        pass
+
+    def close(self):
+        pass
+
+    def is_connected(self):
+        return False
+
+class BluetoothSppTransport(PrinterTransport):
+    """RFCOMM SPP socket via pyjnius, with the createRfcommSocket reflection fallback."""
+    def __init__(self, mac_addr):
+        self.mac_addr = mac_addr
+        self.connect_method = None  # "primary" / "fallback" once connected
+        self._sock = None
+        self._out = None
+        self._in = None
+
+    def connect(self):
+        adapter = bluetooth_adapter()
+        if adapter is None:
+            raise IOError("Bluetooth adapter not available")
+        device = adapter.getRemoteDevice(self.mac_addr)
+        try:
+            if adapter.isDiscovering():
+                adapter.cancelDiscovery()
+        except:
+            pass
+        try:
+            with METRICS.span("connect_primary", printer=self.mac_addr):
+                UUID = jclass('java.util.UUID')
+                sock = device.createRfcommSocketToServiceRecord(UUID.fromString(SPP_UUID))
+                sock.connect()
+            self.connect_method = "primary"
+        except Exception as e:
+            # fallback reflection trick for some devices
+            try:
+                with METRICS.span("connect_fallback", printer=self.mac_addr):
+                    Integer = jclass('java.lang.Integer')
+                    m = device.getClass().getMethod("createRfcommSocket", [Integer.TYPE])
+                    sock = m.invoke(device, 1)
+                    sock.connect()
+                self.connect_method = "fallback"
+            except Exception as e2:
+                raise IOError(f"{e} ; fallback: {e2}")
+        self._sock = sock
+        self._out = sock.getOutputStream()
+        self._in = sock.getInputStream()
+
+    def write(self, data):
+        self._out.write(data)
+
+    def flush(self):
+        self._out.flush()
+
+    def read_byte(self, timeout):
+        # InputStream.read() blocks without a timeout: poll available() instead
+        deadline = time.monotonic() + timeout
+        while True:
+            if self._in.available() > 0:
+                return self._in.read() & 0xFF
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(0.01)
+
+    def discard_input(self):
+        n = self._in.available()
+        if n > 0:
+            self._in.skip(n)
+
+    def close(self):
+        for obj in (self._in, self._out, self._sock):
+            try:
+                if obj is not None:
+                    obj.close()
+            except:
+                pass
+        self._sock = self._out = self._in = None
+
+    def is_connected(self):
+        try:
+            return self._sock is not None and bool(self._sock.isConnected())
+        except Exception:
+            return False
+
+class MemoryTransport(PrinterTransport):
+    """
+    Local stand-in for a printer socket (desktop tests / benchmarks).
+    connect_delay / write_delay_per_kb simulate a slow SPP link;
+    fail_writes makes the next N writes raise like a dropped link.
+    With status=True it answers DLE EOT queries from the paper_out /
+    cover_open / offline flags, which can be flipped while a job runs.
+    """
+    def __init__(self, connect_delay=0.0, write_delay_per_kb=0.0, fail_writes=0, status=False):
+        self.connect_delay = connect_delay
+        self.write_delay_per_kb = write_delay_per_kb
+        self.fail_writes = fail_writes
+        self.status = status
+        self.paper_out = self.cover_open = self.offline = False
+        self.connect_count = 0
+        self.data = bytearray()
+        self._input = bytearray()
+        self._connected = False
+
+    def connect(self):
+        if self.connect_delay:
+            time.sleep(self.connect_delay)
+        self.connect_count += 1
+        self._connected = True
+
+    def write(self, data):
+        if not self._connected:
+            raise IOError("not connected")
+        if self.fail_writes > 0:
+            self.fail_writes -= 1
+            self._connected = False
+            raise IOError("broken pipe")
+        if self.write_delay_per_kb:
+            time.sleep(self.write_delay_per_kb * len(data) / 1024.0)
+        self.data += data
+        if self.status and bytes(data[:2]) == DLE_EOT and len(data) == 3:
+            self._input.append(self._status_byte(data[2]))
+
+    def _status_byte(self, n):
+        stopped = self.paper_out or self.cover_open or self.offline
+        b = 0x12  # fixed bits of every status reply
+        if n == 1 and stopped:
+            b |= 0x08
+        elif n == 2:
+            b |= (0x04 if self.cover_open else 0) | (0x20 if self.paper_out else 0)
+        elif n == 4 and self.paper_out:
+            b |= 0x60
+        return b
+
+    def read_byte(self, timeout):
+        if self._input:
+            return self._input.pop(0)
+        return None
+
+    def discard_input(self):
+        self._input.clear()
+
+    def close(self):
+        self._connected = False
+
+    def is_connected(self):
+        return self._connected
+
+# ---------- Network printer transport (TCP/9100) ----------
+# Raw ESC/POS over TCP (port 9100) for LAN printers, desktop and Android alike.
+# One asyncio loop on a daemon thread owns every network socket; each printer
+# has a small pool of open connections that sessions borrow and hand back.
+# Writes are queued on the loop without waiting (pipelined); flush() waits for
+# the socket buffer to drain, so errors and timeouts surface per chunk.
+NET_PRINTER_PORT = 9100
+NET_CONNECT_TIMEOUT = 5.0
+NET_WRITE_TIMEOUT = 10.0
+NET_POOL_SIZE = 1           # most LAN thermal printers serve one raw connection at a time
+NET_POOL_IDLE_TIMEOUT = 60.0
+NET_PRINTER = os.environ.get("ORDER_PRINTER_NET", "")  # desktop: "host[:port]" -> print raw instead of PDF
+
+def is_bluetooth_mac(addr):
+    parts = str(addr).split(":")
+    return len(parts) == 6 and all(len(p) == 2 and all(c in string.hexdigits for c in p) for p in parts)
+
+def parse_net_printer(addr):
+    """'tcp://host[:port]' / 'host:port' / 'a.b.c.d' -> (host, port); None for a Bluetooth MAC."""
+    addr = str(addr).strip()
+    explicit = addr.startswith("tcp://")
+    if explicit:
+        addr = addr[len("tcp://"):]
+    elif is_bluetooth_mac(addr):
+        return None
+    host, sep, port = addr.rpartition(":")
+    if sep and port.isdigit():
+        return host.strip("[]"), int(port)
+    if explicit or "." in addr:
+        return addr, NET_PRINTER_PORT
+    return None
+
+_net_loop = None
+_net_loop_lock = threading.Lock()
+
+def net_loop():
+    """The shared network event loop (started on first use)."""
+    global _net_loop
+    with _net_loop_lock:
+        if _net_loop is None:
+            import asyncio
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="net-printer-loop", daemon=True).start()
+            _net_loop = loop
+        return _net_loop
+
+def net_run(coro, timeout):
+    """Run coro on the network loop from any other thread; timeouts raise IOError."""
+    import asyncio
+    import concurrent.futures
+    fut = asyncio.run_coroutine_threadsafe(coro, net_loop())
+    try:
+        return fut.result(timeout)
+    except (concurrent.futures.TimeoutError, asyncio.TimeoutError):
+        fut.cancel()
+        raise IOError(f"network printer timed out after {timeout:g}s")
+
+class TcpPrinterPool:
+    """Open connections to one host:port, reused across sessions and jobs (loop thread only)."""
+    def __init__(self, host, port, size=NET_POOL_SIZE, connect_timeout=NET_CONNECT_TIMEOUT,
+                 idle_timeout=NET_POOL_IDLE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.idle_timeout = idle_timeout
+        self._idle = []  # (reader, writer, released_at)
+        self._slots = None
+
+    @staticmethod
+    def _usable(reader, writer):
+        return not writer.is_closing() and not reader.at_eof()
+
+    async def acquire(self):
+        import asyncio
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.size)
+        await asyncio.wait_for(self._slots.acquire(), NET_WRITE_TIMEOUT)
+        try:
+            while self._idle:
+                reader, writer, at = self._idle.pop()
+                if self._usable(reader, writer) and time.monotonic() - at < self.idle_timeout:
+                    return reader, writer
+                writer.close()
+            return await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.connect_timeout)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    async def release(self, conn, reuse=True):
+        reader, writer = conn
+        if reuse and self._usable(reader, writer):
+            self._idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+        self._slots.release()
+
+    async def close(self):
+        while self._idle:
+            self._idle.pop()[1].close()
+
+_net_pools = {}
+_net_pools_lock = threading.Lock()
+
+def net_printer_pool(host, port):
+    with _net_pools_lock:
+        pool = _net_pools.get((host, port))
+        if pool is None:
+            pool = _net_pools[(host, port)] = TcpPrinterPool(host, port)
+        return pool
+
+def close_net_printer_pools():
+    with _net_pools_lock:
+        pools = list(_net_pools.values())
+        _net_pools.clear()
+    if pools and _net_loop is not None:
+        for pool in pools:
+            try:
+                net_run(pool.close(), NET_CONNECT_TIMEOUT)
+            except Exception as e:
+                print("Warning: cannot close network printer:", e)
+
+class TcpTransport(PrinterTransport):
+    """Raw TCP (9100) printer connection borrowed from its TcpPrinterPool."""
+    def __init__(self, addr, pool=None):
+        target = parse_net_printer(addr)
+        if target is None:
+            raise ValueError(f"not a network printer address: {addr!r}")
+        self.addr = addr
+        self.pool = pool or net_printer_pool(*target)
+        self._conn = None
+        self._broken = False
+
+    def connect(self):
+        with METRICS.span("connect_tcp", printer=self.addr):
+            self._conn = net_run(self.pool.acquire(), NET_CONNECT_TIMEOUT + NET_WRITE_TIMEOUT)
+        self._broken = False
+
+    def write(self, data):
+        if not self.is_connected():
+            raise IOError("not connected")
+        net_loop().call_soon_threadsafe(self._conn[1].write, bytes(data))
+
+    async def _drain(self):
+        await self._conn[1].drain()
+
+    async def _read_byte(self, timeout):
+        import asyncio
+        try:
+            data = await asyncio.wait_for(self._conn[0].read(1), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if not data:
+            raise IOError("connection closed by printer")
+        return data[0]
+
+    async def _discard_input(self):
+        import asyncio
+        reader = self._conn[0]
+        while not reader.at_eof():
+            try:
+                if not await asyncio.wait_for(reader.read(256), 0.005):
+                    break
+            except asyncio.TimeoutError:
+                break
+
+    def flush(self):
+        if self._conn is None:
+            raise IOError("not connected")
+        try:
+            net_run(self._drain(), NET_WRITE_TIMEOUT)
+        except Exception:
+            self._broken = True
+            raise
+
+    def read_byte(self, timeout):
+        if self._conn is None:
+            raise IOError("not connected")
+        return net_run(self._read_byte(timeout), timeout + NET_WRITE_TIMEOUT)
+
+    def discard_input(self):
+        if self._conn is not None:
+            net_run(self._discard_input(), NET_WRITE_TIMEOUT)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            net_run(self.pool.release(conn, reuse=not self._broken), NET_CONNECT_TIMEOUT)
+
+    def is_connected(self):
+        return self._conn is not None and not self._broken and TcpPrinterPool._usable(*self._conn)
+
+def printer_transport(addr):
+    """Transport for a printer address: network (see parse_net_printer) or Bluetooth MAC."""
+    if parse_net_printer(addr) is not None:
+        return TcpTransport(addr)
+    return BluetoothSppTransport(addr)
+
+class PrinterSession:
+    """
+    Long-lived connection to one printer, reused across boxes and orders.
+    - connects lazily on first send()
+    - drops the link after idle_timeout seconds without traffic (reap_idle)
+    - health-checks before each send and reconnects a dead socket
+    - if a write on a reused socket fails, reconnects once and resends
+    - printer_status() asks the printer itself (DLE EOT) whether it can print
+    """
+    def __init__(self, transport_factory, idle_timeout=60.0):
+        self.transport_factory = transport_factory
+        self.idle_timeout = idle_timeout
+        self.transport = None
+        self.last_used = 0.0
+        self.status_supported = None  # True/False once a status query was (not) answered
+        self.unreachable = False  # the last connect attempt failed
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        self.close()
+        t = self.transport_factory()
+        try:
+            t.connect()
+        except Exception:
+            self.unreachable = True
+            raise
+        self.unreachable = False
+        self.transport = t
+        self.last_used = time.monotonic()
+
+    def _write(self, payload_bytes):
+        with METRICS.span("write", bytes=len(payload_bytes)):
+            self.transport.write(payload_bytes)
+        with METRICS.span("flush"):
+            self.transport.flush()
+
+    def ensure_connected(self):
+        with self._lock:
+            stale = self.transport is not None and time.monotonic() - self.last_used > self.idle_timeout
+            if self.transport is None or stale or not self.transport.is_connected():
+                self._connect()
+                return True
+            return False
+
+    def send(self, payload_bytes, retry_stale=True):
+        """
+        Write payload on the shared connection. Raises on failure.
+        Returns True when the link had gone stale and the payload was resent on
+        a new one. retry_stale=False for writes that must not be resent: the
+        middle of a label (would print half a label) or several labels (the
+        printer may already have taken the first ones).
+        """
+        with self._lock:
+            fresh = self.ensure_connected()
+            resent = False
+            try:
+                self._write(payload_bytes)
+            except Exception:
+                self.close()
+                if fresh or not retry_stale:
+                    raise
+                # socket went stale between jobs (printer slept): one reconnect
+                self._connect()
+                self._write(payload_bytes)
+                resent = True
+            self.last_used = time.monotonic()
+            return resent
+
+    def query_status(self, n, timeout=None):
+        """DLE EOT n: the printer's status byte, or None when it does not answer."""
+        with self._lock, METRICS.span("status"):
+            self.ensure_connected()
+            t = self.transport
+            t.discard_input()  # late replies to an earlier query
+            t.write(DLE_EOT + bytes((n,)))
+            t.flush()
+            b = t.read_byte(PRINTER_STATUS_TIMEOUT if timeout is None else timeout)
+            self.last_used = time.monotonic()
+        # every reply has bits 1 and 4 set and bits 0 and 7 clear
+        return b if b is not None and b & 0x93 == 0x12 else None
+
+    def printer_status(self):
+        """
+        "ok", "paper_out", "cover_open", "error" or "offline" from the printer's
+        real-time status, or None if it does not answer status queries.
+        """
+        s1 = self.query_status(1)
+        if s1 is None:
+            return None
+        if not s1 & 0x08:
+            return "ok"
+        s2 = self.query_status(2)
+        if s2 is None:
+            return "offline"
+        if s2 & 0x04:
+            return "cover_open"
+        if s2 & 0x20:
+            return "paper_out"
+        if s2 & 0x40:
+            return "error"
+        return "offline"
+
+    def reap_idle(self):
+        with self._lock:
+            if self.transport is not None and time.monotonic() - self.last_used > self.idle_timeout:
+                self.close()
+
+    def close(self):
+        with self._lock:
+            if self.transport is not None:
+                try:
+                    with METRICS.span("close"):
+                        self.transport.close()
+                except:
+                    pass
+            self.transport = None
+
+PRINTER_IDLE_TIMEOUT = 60.0
+_printer_sessions = {}
+_printer_sessions_lock = threading.Lock()
+
+def get_printer_session(mac_addr, transport_factory=None):
+    """Return the shared PrinterSession for mac_addr (created on first use)."""
+    with _printer_sessions_lock:
+        session = _printer_sessions.get(mac_addr)
+        if session is None:
+            factory = transport_factory or (lambda: printer_transport(mac_addr))
+            session = PrinterSession(factory, idle_timeout=PRINTER_IDLE_TIMEOUT)
+            _printer_sessions[mac_addr] = session
+        return session
+
+def reap_idle_printer_sessions(*_):
+    with _printer_sessions_lock:
+        sessions = list(_printer_sessions.values())
+    for s in sessions:
+        s.reap_idle()
+
+def close_printer_sessions():
+    with _printer_sessions_lock:
+        sessions = list(_printer_sessions.values())
+        _printer_sessions.clear()
+    for s in sessions:
+        s.close()
+    close_net_printer_pools()
+
+def print_via_bluetooth_pyjnius(mac_addr, payload_bytes, timeout=10):
+    """Send bytes over the shared SPP session for mac_addr. Returns (True, None) or (False, error)."""
+    try:
+        get_printer_session(mac_addr).send(payload_bytes)
+        return True, None
+    except Exception as e:
+        return False, str(e)
+
+# ---------- ESC/POS job streaming ----------
+ESCPOS_CHUNK_SIZE = 512     # bytes per write(); one RFCOMM frame on most SPP printers
+PRINTER_BUFFER_BYTES = 0    # >0 only for printers without flow control (see BufferPacer)
+PRINTER_DRAIN_BPS = 4096    # bytes/s such a printer consumes from its buffer
+PRINTER_STATUS_PACING = True  # pace by DLE EOT replies where the printer answers them (see StatusPacer)
+STATUS_WINDOW_BYTES = 1024    # bytes sent before the next label boundary status check
+STATUS_POLL_INTERVAL = 1.0    # s between status checks while the printer is stopped
+STATUS_PAUSE_TIMEOUT = 300.0  # s a stopped printer may hold the job; then it stops, boxes stay spooled
+
+class BufferPacer:
+    """
+    Tracks the estimated fill level of the printer's input buffer and sleeps
+    only when the next chunk would overflow it (instead of a fixed gap per box).
+    RFCOMM already has credit-based flow control, so this is off by default.
+    """
+    def __init__(self, buffer_bytes, drain_bps):
+        self.buffer_bytes = buffer_bytes
+        self.drain_bps = float(drain_bps)
+        self.level = 0.0
+        self.t = time.monotonic()
+
+    def before_write(self, n, boundary=True):
+        now = time.monotonic()
+        self.level = max(0.0, self.level - (now - self.t) * self.drain_bps)
+        self.t = now
+        overflow = self.level + n - self.buffer_bytes
+        if overflow > 0:
+            time.sleep(overflow / self.drain_bps)
+            self.level -= overflow
+            self.t = time.monotonic()
+        self.level += n
+
+class PrinterStopped(IOError):
+    """The printer stayed stopped (paper out, cover open, ...) past STATUS_PAUSE_TIMEOUT."""
+
+class StatusPacer:
+    """
+    Paces writes by the printer's real-time status instead of an estimate:
+    at the first label boundary after `window` bytes it sends DLE EOT and waits
+    for the reply, which comes back once the printer has taken in everything
+    before it (never inside a label, where it could land in image data). While the printer
+    reports paper out / cover open / offline the stream is held and polled
+    until it recovers, so boxes wait instead of failing; if it is still stopped
+    after STATUS_PAUSE_TIMEOUT, PrinterStopped aborts the stream (`stopped` keeps
+    the status).
+    on_status(status) fires on every change ("ok" when printing resumes).
+    Printers that never answer are remembered on the session and paced by
+    `fallback` (a BufferPacer or None) from then on.
+    """
+    def __init__(self, session, window=STATUS_WINDOW_BYTES, on_status=None, cancel=None, fallback=None):
+        self.session = session
+        self.window = window
+        self.on_status = on_status
+        self.cancel = cancel
+        self.fallback = fallback
+        self.status = "ok"
+        self.stopped = None  # status the printer timed out in
+        self.unacked = None  # bytes since the last reply; None = check before the first write
+
+    def before_write(self, n, boundary=True):
+        if self.session.status_supported is False:
+            if self.fallback:
+                self.fallback.before_write(n, boundary)
+            return
+        if boundary and (self.unacked is None or self.unacked + n > self.window):
+            self.unacked = None  # until a reply: a failed check is repeated before the next write
+            self.wait_ready()
+            self.unacked = 0
+        self.unacked += n
+
+    def _set_status(self, status):
+        if status != self.status:
+            self.status = status
+            if self.on_status:
+                self.on_status(status)
+
+    def wait_ready(self):
+        """Block until the printer reports ready. Raises on cancel, PrinterStopped on STATUS_PAUSE_TIMEOUT."""
+        deadline = time.monotonic() + STATUS_PAUSE_TIMEOUT
+        while True:
+            status = self.session.printer_status()
+            if status is None:
+                if not self.session.status_supported:
+                    self.session.status_supported = False
+                    print("Warning: printer does not answer status queries, pacing without them")
+                    return
+                status = "no_reply"
+            self.session.status_supported = True
+            self._set_status(status)
+            if status == "ok":
+                return
+            if self.cancel is not None and self.cancel():
+                raise IOError("cancelled")
+            if time.monotonic() >= deadline:
+                self.stopped = status
+                raise PrinterStopped(f"printer stopped: {status}")
+            time.sleep(STATUS_POLL_INTERVAL)
+
+def default_pacer(session=None, on_status=None, cancel=None):
+    fallback = BufferPacer(PRINTER_BUFFER_BYTES, PRINTER_DRAIN_BPS) if PRINTER_BUFFER_BYTES > 0 else None
+    if PRINTER_STATUS_PACING and session is not None:
+        return StatusPacer(session, on_status=on_status, cancel=cancel, fallback=fallback)
+    return fallback
+
+def stream_label_job(session, labels, chunk_size=ESCPOS_CHUNK_SIZE, pacer=None, on_label=None, cancel=None,
+                     on_chunk=None):
+    """
+    Write a coalesced job as one stream in writes of up to chunk_size, cut at label
+    boundaries where one falls inside. Each label is bytes or a tuple of byte
+    segments (as built by LabelTemplate).
+    Returns [(ok, err), ...] per label; on_label(index, ok, err) fires as each label
+    is fully written or fails. A failed chunk fails the labels it overlaps; streaming
+    resumes at the next label boundary with a fresh ESC @ on the reconnected link.
+    The first write and every write after a reconnect carry a single label, so
+    a dropped link can cost (or duplicate) at most the label in flight.
+    cancel() is polled at label boundaries; once it returns True the remaining
+    labels are reported as (False, "cancelled"). PrinterStopped from the pacer fails
+    all remaining labels at once. on_chunk() fires after the labels
+    settled by each write were reported (to commit them in one go).
+    """
+    n = len(labels)
+    starts = []
+    pos = 0
+    for lb in labels:
+        starts.append(pos)
+        pos += len(lb) if isinstance(lb, (bytes, bytearray)) else sum(len(p) for p in lb)
+    ends = starts[1:] + [pos]
+    stream = b"".join(p for lb in labels for p in ((lb,) if isinstance(lb, (bytes, bytearray)) else lb))
+    results = [None] * n
+    boundaries = set(starts)
+    done = 0
+    off = 0
+    need_reset = False
+    one_label = True  # until the link has taken a write; again for good after a reconnect
+    reconnected = False
+
+    def report(i, ok, err):
+        results[i] = (ok, err)
+        if on_label:
+            on_label(i, ok, err)
+
+    while off < len(stream):
+        if cancel is not None and done < n and off == starts[done] and cancel():
+            while done < n:
+                report(done, False, "cancelled")
+                done += 1
+            break
+        end = min(off + chunk_size, len(stream))
+        # end the write at the last label start inside it, so the next one starts a label
+        k = bisect.bisect_right(starts, end) - 1
+        if end < len(stream) and starts[k] > off:
+            end = starts[k]
+        if one_label:
+            end = min(end, ends[done])
+        try:
+            if need_reset:
+                session.send(ESC_RESET)
+                need_reset = False
+            if pacer:
+                pacer.before_write(end - off, off in boundaries)
+            # only a write holding one label start may be resent on a new link
+            reconnected |= session.send(stream[off:end], retry_stale=off in boundaries and end <= ends[done])
+            one_label = reconnected
+        except Exception as e:
+            err = str(e)
+            # a printer that stayed stopped would hold every remaining label for the full timeout
+            last = n if isinstance(e, PrinterStopped) else bisect.bisect_left(starts, end)
+            while done < last:
+                report(done, False, err)
+                done += 1
+            off = starts[done] if done < n else len(stream)
+            need_reset = True
+            one_label = reconnected = True
+            if on_chunk:
+                on_chunk()
+            continue
+        settled = done
+        while done < n and ends[done] <= end:
+            report(done, True, None)
+            done += 1
+        if on_chunk and done > settled:
+            on_chunk()
+        off = end
+    return results
+
+def fan_out_label_job(sessions, header, labels, pacer_factory=None, on_label=None, cancel=None):
+    """
+    Spread one order's labels over several printers at once: {mac: session}.
+    Each printer has its own worker thread that takes the next unprinted box,
+    so faster printers print more boxes. Every label carries its own box number,
+    so numbering stays correct whichever printer prints it.
+    A printer whose label fails is dropped for the rest of the job and the label
+    goes back to the front of the queue for the remaining printers (it may come
+    out half-printed on the failed one). Labels left when every printer failed
+    are reported with the last error.
+    on_label(index, ok, err, mac) fires from the worker threads; pacer_factory(mac, session)
+    makes each printer's pacer (default_pacer by default).
+    Returns ([(ok, err), ...] per label, {mac: labels printed}).
+    """
+    n = len(labels)
+    pending = list(range(n - 1, -1, -1))  # stack: pop() -> lowest box first
+    results = [None] * n
+    printed = {mac: 0 for mac in sessions}
+    errors = []
+    lock = threading.Lock()
+
+    def report(i, ok, err, mac):
+        results[i] = (ok, err)
+        if on_label:
+            on_label(i, ok, err, mac)
+
+    def worker(mac, session):
+        first = True
+        pacer = pacer_factory(mac, session) if pacer_factory else default_pacer(session, cancel=cancel)
+        with METRICS.tags(printer=mac), METRICS.per_job():
+            while True:
+                if cancel is not None and cancel():
+                    return
+                with lock:
+                    if not pending:
+                        return
+                    i = pending.pop()
+                lb = labels[i] if isinstance(labels[i], tuple) else (labels[i],)
+                if first:
+                    lb = (header,) + lb  # reset + code page once per printer
+                (ok, err), = stream_label_job(session, [lb], pacer=pacer)
+                if not ok:
+                    with lock:
+                        pending.append(i)
+                        errors.append(f"{mac}: {err}")
+                    print("Warning: printer", mac, "failed, rerouting its boxes:", err)
+                    return
+                first = False
+                with lock:
+                    printed[mac] += 1
+                report(i, True, None, mac)
+
+    threads = [threading.Thread(target=worker, args=(mac, s), name=f"print-fanout-{mac}", daemon=True)
+               for mac, s in sessions.items()]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    cancelled = cancel is not None and cancel()
+    for i in range(n):
+        if results[i] is None:
+            report(i, False, "cancelled" if cancelled else (errors[-1] if errors else "no printer"), None)
+    return results, printed
+
+# ---------- Background print queue ----------
+class PrintJob:
+    """
+    One order queued for the print worker. Callbacks run on the Kivy main
+    thread (via Clock.schedule_once):
+      on_progress(job, index, ok, err) after each label (index = box number - 1)
+      on_status(job, status) when the printer stops (paper_out, cover_open, ...)
+        and the job waits for it, and with "ok" once it prints again
+      on_done(job) when the job finished, failed or was cancelled
+    Every box is tracked in SPOOL: failed boxes get SPOOL_RETRIES more passes
+    with backoff, and whatever is still unprinted stays in the spool so the
+    operator can resume() later (also after a restart).
+    """
+    _ids = itertools.count(1)  # next() is atomic under the GIL: ids stay unique across server threads
+
+    def __init__(self, order_id, customer, box_qty, mac, on_progress=None, on_done=None,
+                 boxes=None, spool_key=None, on_status=None):
+        self.id = next(PrintJob._ids)
+        self.order_id = str(order_id)
+        self.customer = str(customer)
+        self.box_qty = int(box_qty)
+        self.mac = mac
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.on_status = on_status
+        self.printer_status = None  # last status reported by a StatusPacer
+        self.boxes = sorted(boxes) if boxes is not None else list(range(1, self.box_qty + 1))
+        self.spool_key = spool_key
+        self.state = "queued"  # queued / printing / done / failed / cancelled
+        self.results = []
+        self.box_results = {}  # box number -> (ok, err), latest attempt
+        self.error = None
+        self._cancel = threading.Event()
+        self._pacers = []
+
+    @classmethod
+    def resume(cls, spooled, mac=None, on_progress=None, on_done=None, on_status=None):
+        """Job for the unsent boxes of a SPOOL.job()/unfinished() snapshot."""
+        return cls(spooled["order_id"], spooled["customer"], spooled["box_qty"], mac or spooled["printer"],
+                   on_progress=on_progress, on_done=on_done, boxes=spooled["pending"], spool_key=spooled["key"],
+                   on_status=on_status)
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def success_count(self):
+        return sum(1 for ok, _ in self.results if ok)
+
+    @property
+    def fail_count(self):
+        return sum(1 for ok, _ in self.results if not ok)
+
+    @property
+    def unprinted(self):
+        """Box numbers of this job not printed (yet)."""
+        return [b for b in self.boxes if not self.box_results.get(b, (False,))[0]]
+
+    def _start_spool(self):
+        """Open the spool entry; True when earlier runs already printed boxes of it."""
+        if self.spool_key is None:
+            self.spool_key = SPOOL.open(self.order_id, self.customer, self.box_qty, self.mac, self.boxes)
+            return False
+        spooled = SPOOL.job(self.spool_key)
+        return bool(spooled and spooled["sent"])
+
+    def _on_box(self, box, ok, err):
+        self.box_results[box] = (ok, err)
+        self.results.append((ok, err))
+        if err != "cancelled":
+            SPOOL.mark(self.spool_key, box, ok, err, sync=False)  # flushed per write
+        _on_ui(self.on_progress, self, box - 1, ok, err)
+
+    def _on_printer_status(self, status, mac=None):
+        self.printer_status = None if status == "ok" else status
+        if status != "ok":
+            print("Warning: printer", mac or self.mac, "stopped:", status)
+        _on_ui(self.on_status, self, status)
+
+    def _pacer(self, session, mac=None):
+        pacer = default_pacer(session, cancel=lambda: self.cancelled,
+                              on_status=lambda status: self._on_printer_status(status, mac))
+        self._pacers.append(pacer)  # this pass's pacers (_retry_passes)
+        return pacer
+
+    def _finish_spool(self, resumed, remember=None, macs=None):
+        SPOOL.flush()
+        printed = [b for b in self.boxes if self.box_results.get(b, (False,))[0]]
+        self.results = [self.box_results[b] for b in self.boxes if b in self.box_results]
+        if printed:
+            add_history_entry(self.order_id, self.customer, self.box_qty, boxes=printed, resumed=resumed)
+            if remember or self.mac:
+                PRINTERS.remember(remember or self.mac)
+        elif self.results:
+            PRINTERS.invalidate()
+            # a remembered printer that can't be reached (off, replaced) must not stay the default
+            for mac in macs or [self.mac]:
+                with _printer_sessions_lock:
+                    session = _printer_sessions.get(mac)
+                if session is not None and session.unreachable and PRINTERS.forget(mac):
+                    print("Warning: default printer", mac, "unreachable, it will be chosen again")
+        spooled = SPOOL.job(self.spool_key)
+        if spooled is not None and not spooled["pending"]:
+            SPOOL.close(self.spool_key)
+
+    def _retry_passes(self, print_pass):
+        """
+        Call print_pass(boxes) for the unprinted boxes, then SPOOL_RETRIES more
+        times over the ones that failed, with doubling backoff. No retries when
+        every printer of the pass stayed stopped: the boxes wait in the spool.
+        """
+        todo = list(self.boxes)
+        delay = SPOOL_BACKOFF
+        for attempt in range(SPOOL_RETRIES + 1):
+            if not todo:
+                break
+            if attempt:
+                if self._cancel.wait(delay):
+                    break
+                delay *= 2
+                # progress counts the final state of each box once
+                self.results = [self.box_results[b] for b in self.boxes
+                                if b in self.box_results and b not in todo]
+            self._pacers = []
+            print_pass(todo)
+            todo = [b for b in todo if self.box_results[b] != (False, "cancelled")
+                    and not self.box_results[b][0]]
+            if self.cancelled:
+                break
+            if todo and self._pacers and all(getattr(p, "stopped", None) for p in self._pacers):
+                print("Warning: printer stopped, leaving", len(todo), "boxes of", self.order_id, "in the spool")
+                break
+
+    def run(self):
+        """Print the order (called on the print worker thread)."""
+        resumed = self._start_spool()
+        header, box_labels = escpos_job_labels(self.order_id, self.customer, self.box_qty)
+
+        def print_pass(todo):
+            labels = [box_labels[b - 1] for b in todo]
+            labels[0] = (header, labels[0])
+            stream_label_job(session, labels, pacer=self._pacer(session),
+                             on_label=lambda i, ok, err: self._on_box(todo[i], ok, err),
+                             cancel=lambda: self.cancelled, on_chunk=SPOOL.flush)
+        try:
+            with METRICS.tags(order=self.order_id, printer=self.mac), METRICS.per_job(), \
+                    METRICS.span("job", boxes=len(self.boxes)):
+                session = get_printer_session(self.mac)
+                self._retry_passes(print_pass)
+        finally:
+            self._finish_spool(resumed)
+
+class FanOutPrintJob(PrintJob):
+    """
+    One order spread across several printers paired to this station
+    (fan_out_label_job). Spooled like a single-printer job; history gets one
+    entry for the order with the boxes actually printed.
+    """
+    def __init__(self, order_id, customer, box_qty, macs, on_progress=None, on_done=None,
+                 boxes=None, spool_key=None, on_status=None):
+        macs = list(dict.fromkeys(macs))
+        super().__init__(order_id, customer, box_qty, macs[0] if macs else None,
+                         on_progress=on_progress, on_done=on_done, boxes=boxes, spool_key=spool_key,
+                         on_status=on_status)
+        self.macs = macs
+        self.printed = {}  # mac -> labels printed
+
+    def _on_fanout_box(self, box, ok, err):
+        with self._box_lock:  # worker threads
+            self._on_box(box, ok, err)
+            SPOOL.flush()
+
+    def run(self):
+        resumed = self._start_spool()
+        header, box_labels = escpos_job_labels(self.order_id, self.customer, self.box_qty)
+        self._box_lock = threading.Lock()
+
+        def print_pass(todo):
+            # every pass starts on all printers again, so one that dropped out on a
+            # transient error gets back in after the backoff
+            _, printed = fan_out_label_job(
+                sessions, header, [box_labels[b - 1] for b in todo], cancel=lambda: self.cancelled,
+                pacer_factory=lambda mac, session: self._pacer(session, mac),
+                on_label=lambda i, ok, err, mac: self._on_fanout_box(todo[i], ok, err))
+            for mac, count in printed.items():
+                self.printed[mac] = self.printed.get(mac, 0) + count
+        try:
+            if not self.boxes:
+                return
+            with METRICS.tags(order=self.order_id), \
+                    METRICS.span("job", boxes=len(self.boxes), printers=len(self.macs)):
+                sessions = {mac: get_printer_session(mac) for mac in self.macs}
+                self._retry_passes(print_pass)
+        finally:
+            self._finish_spool(resumed, remember=max(self.printed, key=self.printed.get, default=None),
+                               macs=self.macs)
+
+HEADLESS = False  # set by serve(): no Kivy event loop, callbacks run on the calling thread
+
+def _on_ui(fn, *args):
+    """Run fn(*args) on the Kivy main thread (directly in headless server mode)."""
+    if fn is None:
+        return
+    if HEADLESS:
+        fn(*args)
+    else:
+        Clock.schedule_once(lambda dt: fn(*args))
+
+class PrintQueue:
+    """
+    Single worker thread that owns all printer I/O, so the UI thread never
+    blocks on connects or writes. Jobs (anything with PrintJob's interface and
+    a run() method) execute in submission order; operators can queue the next
+    order while the current one prints.
+    """
+    def __init__(self):
+        self._q = queue.Queue()
+        self._jobs = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self.listeners = []  # fn(print_queue) on any job state change, main thread
+
+    def submit(self, job):
+        with self._lock:
+            self._jobs.append(job)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="print-worker", daemon=True)
+                self._thread.start()
+        self._q.put(job)
+        self._notify()
+        return job
+
+    def active_jobs(self):
+        with self._lock:
+            return [j for j in self._jobs if j.state in ("queued", "printing")]
+
+    def _notify(self):
+        for fn in list(self.listeners):
+            _on_ui(fn, self)
+
+    def _finish(self, job, state):
+        job.state = state
+        with self._lock:
+            if job in self._jobs:
+                self._jobs.remove(job)
+        _on_ui(job.on_done, job)
+        self._notify()
+
+    def _run(self):
+        while True:
+            job = self._q.get()
+            if job.cancelled:
+                self._finish(job, "cancelled")
+                continue
+            job.state = "printing"
+            self._notify()
+            try:
+                job.run()
+            except Exception as e:
+                traceback.print_exc()
+                job.error = str(e)
+            if job.error and not job.results:
+                self._finish(job, "failed")
+            elif job.cancelled:
+                self._finish(job, "cancelled")
+            else:
+                self._finish(job, "done" if job.success_count or not job.fail_count else "failed")
+
+PRINT_QUEUE = PrintQueue()
+
+# ---------- Batch import (CSV/XLSX manifests) ----------
+# Header names accepted for each manifest column (compared lower-cased).
+MANIFEST_HEADERS = {
+    "order_id": ("order_id", "order", "order id", "ma_don", "mã đơn", "mã đơn hàng"),
+    "customer": ("customer", "customer_name", "customer name", "khach", "tên khách", "khách hàng"),
+    "box_qty": ("box_qty", "boxes", "box", "so_box", "số box", "số lượng box"),
+}
+
+def _manifest_key(header):
+    h = str(header or "").strip().lower()
+    for key, names in MANIFEST_HEADERS.items():
+        if h in names:
+            return key
+    return None
+
+def _iter_csv_rows(path):
+    with open(path, "r", newline="", encoding="utf-8-sig") as f:
+        sample = f.read(4096)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        for n, row in enumerate(csv.reader(f, dialect), 1):
+            yield n, row
+
+def _iter_xlsx_rows(path):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise RuntimeError("XLSX manifests need openpyxl (pip install openpyxl); or save the sheet as CSV")
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        for n, row in enumerate(wb.active.iter_rows(values_only=True), 1):
+            yield n, list(row)
+    finally:
+        wb.close()
+
+def read_manifest(path):
+    """Yield (row_number, {column: value}) from a CSV or XLSX manifest, one row at a time."""
+    if os.path.splitext(path)[1].lower() in (".xlsx", ".xlsm"):
+        rows = _iter_xlsx_rows(path)
+    else:
+        rows = _iter_csv_rows(path)
+    header = None
+    for n, row in rows:
+        if header is None:
+            header = [_manifest_key(c) for c in row]
+            if "order_id" not in header:
+                raise ValueError("manifest has no order id column (expected one of: %s)"
+                                 % ", ".join(MANIFEST_HEADERS["order_id"]))
+            continue
+        rec = {k: v for k, v in zip(header, row) if k}
+        if any(str(v if v is not None else "").strip() for v in rec.values()):
+            yield n, rec
+
+class BatchReport:
+    """
+    Outcome of a batch run: (row, order_id, detail) per printed / skipped / failed
+    order. `partial` holds orders with some boxes printed; the rest stay in SPOOL.
+    """
+    def __init__(self, source=""):
+        self.source = source
+        self.printed = []
+        self.partial = []
+        self.skipped = []
+        self.failed = []
+
+    def summary(self):
+        return (f"Đã in: {len(self.printed)}, in dở: {len(self.partial)}, "
+                f"bỏ qua (trùng): {len(self.skipped)}, lỗi: {len(self.failed)}")
+
+    def write_csv(self, path):
+        with open(path, "w", newline="", encoding="utf-8-sig") as f:
+            w = csv.writer(f)
+            w.writerow(["row", "order_id", "status", "detail"])
+            for status, items in (("printed", self.printed), ("partial", self.partial),
+                                  ("skipped_duplicate", self.skipped), ("failed", self.failed)):
+                for row, oid, detail in items:
+                    w.writerow([row, oid, status, detail])
+        return path
+
+def parse_box_qty(value):
+    """Whole box count in 1..MAX_BOX_QTY from a form / manifest / JSON value, else None."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, float):  # XLSX numbers arrive as floats
+        box = int(value) if value.is_integer() else None
+    elif isinstance(value, int):
+        box = value
+    else:
+        m = re.fullmatch(r"([0-9]+)(?:\.0*)?", str(value if value is not None else "").strip())
+        box = int(m.group(1)) if m else None
+    return box if box is not None and 1 <= box <= MAX_BOX_QTY else None
+
+def validate_orders(records, report):
+    """Stage: keep rows with order id, customer and a box count in 1..MAX_BOX_QTY."""
+    for n, rec in records:
+        oid = str(rec.get("order_id") if rec.get("order_id") is not None else "").strip()
+        cust = str(rec.get("customer") if rec.get("customer") is not None else "").strip()
+        if not oid or not cust or rec.get("box_qty") in (None, ""):
+            report.failed.append((n, oid, "thiếu mã đơn / tên khách / số BOX"))
+            continue
+        box = parse_box_qty(rec.get("box_qty"))
+        if box is None:
+            report.failed.append((n, oid, f"số BOX phải là số nguyên từ 1 đến {MAX_BOX_QTY}"))
+            continue
+        yield n, oid, cust, box
+
+def skip_printed(orders, report, printed=None):
+    """
+    Stage: drop orders already in history or printed earlier in this batch.
+    `printed` is the caller's set of order ids printed so far; ids go in only
+    once their labels are out, so a row whose order failed is retried later.
+    """
+    printed = set() if printed is None else printed
+    for n, oid, cust, box in orders:
+        if oid in printed or has_been_printed(oid):
+            report.skipped.append((n, oid, "đã in trước đó"))
+            continue
+        yield n, oid, cust, box
+
+def pdf_batch_sink(oid, cust, box):
+    """Render one order to ORDER_<id>.pdf (desktop). Returns a detail string."""
+    return create_pdf_80x50_left(oid, cust, box)
+
+PDF_BATCH_WINDOW = 200  # orders handed to the process pool at a time
+BATCH_MERGED_PDF = True  # desktop batches: one merged PDF instead of ORDER_<id>.pdf each
+
+class PdfBatchRenderer:
+    """
+    Bulk sink for run_batch: renders windows of orders on a process pool.
+    With merged_path, every window becomes a part and finish() merges the
+    parts (input order) into one print-ready PDF; otherwise ORDER_<id>.pdf each.
+    """
+    def __init__(self, merged_path=None, workers=None):
+        self.merged_path = merged_path
+        self.workers = workers
+        self.parts = []
+        self._pool = None
+        self._serial = None
+
+    def __call__(self, orders):
+        if self._pool is None and (self.workers or PDF_WORKERS or os.cpu_count() or 1) > 1:
+            self._pool = pdf_process_pool(self.workers)
+        if self.merged_path is None:
+            return render_orders_pdf(orders, executor=self._pool, workers=self.workers)
+        try:
+            import pypdf  # noqa: F401
+        except ImportError:
+            # no merger available: draw every window into one canvas in order
+            ensure_pdf_backend()
+            if self._serial is None:
+                self._serial = canvas.Canvas(self.merged_path, pagesize=(PAGE_W_MM * mm, PAGE_H_MM * mm))
+            for oid, cust, box in orders:
+                draw_order_pages(self._serial, oid, cust, box, (PAGE_W_MM * mm, PAGE_H_MM * mm))
+            return [self.merged_path] * len(orders)
+        part = f"{self.merged_path}.w{len(self.parts):05d}"
+        with METRICS.span("pdf_batch_render", orders=len(orders)):
+            render_orders_pdf(orders, merged_path=part, executor=self._pool, workers=self.workers)
+        self.parts.append(part)
+        return [self.merged_path] * len(orders)
+
+    def finish(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        if self._serial is not None:
+            self._serial.save()
+            self._serial = None
+        if self.parts:
+            try:
+                if len(self.parts) == 1:
+                    os.replace(self.parts[0], self.merged_path)
+                else:
+                    merge_pdfs(self.parts, self.merged_path)
+            finally:
+                for p in self.parts:
+                    if os.path.exists(p):
+                        os.remove(p)
+                self.parts = []
+
+def escpos_batch_sink(mac, parent=None):
+    """
+    Sink that prints each order as a PrintJob on the printer at mac, so batch
+    orders are spooled, retried and written to history box by box like single
+    prints. Returns the finished job. parent (the BatchJob) lends its cancel
+    flag and printer status callback.
+    """
+    def sink(oid, cust, box):
+        job = PrintJob(oid, cust, box, mac)
+        if parent is not None:
+            job._cancel = parent._cancel
+            job._on_printer_status = parent._on_printer_status
+        job.run()
+        return job
+    return sink
+
+def run_batch(path, sink=None, skip_duplicates=True, cancel=None, on_order=None,
+              bulk_sink=None, window=PDF_BATCH_WINDOW):
+    """
+    Stream a manifest through validate -> duplicate check -> render/print.
+    Rows are read lazily, so memory stays flat for any file size. History is
+    written right after each order (or window), so repeats inside the file are
+    skipped too.
+    sink(oid, cust, box) handles one order and returns a detail string, or a
+    finished PrintJob that already wrote its printed boxes to history (and left
+    the rest in SPOOL); bulk_sink(list of (oid, cust, box)) handles `window`
+    orders at once and returns one detail per order.
+    on_order(report) fires after each order/window. Returns a BatchReport.
+    """
+    report = BatchReport(path)
+    orders = validate_orders(read_manifest(path), report)
+    printed = set()
+    if skip_duplicates:
+        orders = skip_printed(orders, report, printed)
+    pending = []
+
+    def flush():
+        try:
+            details = bulk_sink([(oid, cust, box) for _, oid, cust, box in pending])
+        except Exception as e:
+            details = [e] * len(pending)
+        for (n, oid, cust, box), detail in zip(pending, details):
+            if isinstance(detail, Exception):
+                report.failed.append((n, oid, str(detail)))
+            else:
+                add_history_entry(oid, cust, box)
+                report.printed.append((n, oid, detail or ""))
+                printed.add(oid)
+        del pending[:]
+        if on_order:
+            on_order(report)
+
+    def record_job(n, job):
+        missing = job.unprinted
+        done = len(job.boxes) - len(missing)
+        if not missing:
+            report.printed.append((n, job.order_id, f"{done}/{job.box_qty} nhãn"))
+            printed.add(job.order_id)
+        elif done:
+            report.partial.append((n, job.order_id, f"{done}/{job.box_qty} nhãn, "
+                                   f"chưa in BOX {format_box_ranges(missing)}"))
+        else:
+            # nothing printed: a rerun of the manifest retries it, no spool entry needed
+            SPOOL.close(job.spool_key)
+            err = next((e for ok, e in job.box_results.values() if not ok), None)
+            report.failed.append((n, job.order_id, err or job.error or "no label printed"))
+
+    for n, oid, cust, box in orders:
+        if cancel is not None and cancel():
+            break
+        if bulk_sink is not None:
+            if skip_duplicates and any(p[1] == oid for p in pending):
+                flush()  # a repeat inside the window: settle the first one before checking
+                if oid in printed:
+                    report.skipped.append((n, oid, "đã in trước đó"))
+                    continue
+            pending.append((n, oid, cust, box))
+            if len(pending) >= window:
+                flush()
+            continue
+        try:
+            result = sink(oid, cust, box)
+            if isinstance(result, PrintJob):
+                record_job(n, result)
+            else:
+                add_history_entry(oid, cust, box)
+                report.printed.append((n, oid, result or ""))
+                printed.add(oid)
+        except Exception as e:
+            report.failed.append((n, oid, str(e)))
+        if on_order:
+            on_order(report)
+    if pending:
+        flush()
+    return report
+
+class BatchJob(PrintJob):
+    """
+    A whole manifest run as one job on PRINT_QUEUE. With a mac it prints
+    ESC/POS; without one it renders PDFs on a process pool, merged into
+    <manifest>_labels.pdf when BATCH_MERGED_PDF is set.
+    """
+    def __init__(self, path, mac=None, skip_duplicates=True, on_progress=None, on_done=None, on_status=None):
+        super().__init__(os.path.basename(path), "", 0, mac, on_progress=on_progress, on_done=on_done,
+                         on_status=on_status)
+        self.path = path
+        self.skip_duplicates = skip_duplicates
+        self.report = None
+        self.output = None  # merged PDF path (desktop)
+
+    def run(self):
+        def on_order(report):
+            self.report = report
+            _on_ui(self.on_progress, self, report)
+        base = os.path.splitext(self.path)[0]
+        if self.mac:
+            sink = escpos_batch_sink(self.mac, parent=self)
+            with METRICS.tags(printer=self.mac):
+                self.report = run_batch(self.path, sink, self.skip_duplicates,
+                                        cancel=lambda: self.cancelled, on_order=on_order)
+        else:
+            renderer = PdfBatchRenderer(base + "_labels.pdf" if BATCH_MERGED_PDF else None)
+            try:
+                self.report = run_batch(self.path, skip_duplicates=self.skip_duplicates,
+                                        cancel=lambda: self.cancelled, on_order=on_order,
+                                        bulk_sink=renderer)
+            finally:
+                renderer.finish()
+            if renderer.merged_path and self.report.printed:
+                self.output = renderer.merged_path
+        if self.mac and self.report.printed:
+            PRINTERS.remember(self.mac)
+        self.results = [(True, None)] * len(self.report.printed) + \
+                       [(False, d) for _, _, d in self.report.partial + self.report.failed]
+        try:
+            self.report.write_csv(base + "_report.csv")
+        except Exception as e:
+            print("Warning: cannot write batch report:", e)
+
+# ---------- Headless print server ----------
+# python main.py --serve [host:port] [--printer ADDR]
+# Local HTTP job API for the WMS; no window or ScreenManager is created.
+#   POST /jobs        {"order_id", "customer", "box_qty"[, "printer"][, "reprint"]} or a list
+#                     of them -> 202; 409 when every order was printed before (and
+#                     "reprint": true was not given), 400 when none is valid
+#   GET  /jobs        queued / printing jobs
+#   GET  /jobs/<id>   status of one job
+#   DELETE /jobs/<id> cancel
+#   GET  /health
+# Jobs go through PRINT_QUEUE like UI jobs (one worker, printer session kept open
+# across consecutive orders). Without a printer, orders are rendered to PDF.
+SERVER_ADDR = "127.0.0.1:8765"
+SERVER_MAX_JOBS = 10000      # finished jobs kept for status queries
+SERVER_MAX_BODY = 10 * 1024 * 1024
+
+class PdfJob(PrintJob):
+    """One order rendered to ORDER_<id>.pdf on the print worker (server without a printer)."""
+    output = None
+
+    def run(self):
+        self.output = create_pdf_80x50_left(self.order_id, self.customer, self.box_qty)
+        self.results = [(True, None)] * self.box_qty
+        add_history_entry(self.order_id, self.customer, self.box_qty)
+
+def job_status(job):
+    status = {"id": job.id, "order_id": job.order_id, "customer": job.customer, "box_qty": job.box_qty,
+              "printer": job.mac, "state": job.state, "printed": job.success_count,
+              "failed": job.fail_count, "error": job.error, "printer_status": job.printer_status}
+    if getattr(job, "output", None):
+        status["output"] = job.output
+    return status
 
-def save_history(h):
-    try:
-        with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-            json.dump(h, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print("Warning: cannot save history:", e)
+class PrintServer:
+    """Job intake and status for the HTTP API; printing itself is PRINT_QUEUE's."""
+    def __init__(self, printer=None, print_queue=None, max_jobs=SERVER_MAX_JOBS):
+        self.printer = printer
+        self.print_queue = print_queue or PRINT_QUEUE
+        self.max_jobs = max_jobs
+        self.jobs = {}  # id -> job, oldest first
+        self._lock = threading.RLock()
 
-def add_history_entry(order_id, customer, box_qty):
-    h = load_history()
-    h.append({
-        "order_id": str(order_id),
-        "customer": str(customer),
-        "box_qty": int(box_qty),
-        "timestamp": datetime.now().isoformat()
-    })
-    save_history(h)
+    def submit(self, payload):
+        """
+        Queue one order dict or a list of them. Returns (statuses, errors).
+        Orders already printed, queued or earlier in the payload are refused as
+        duplicates (errors with "duplicate": true) unless the record has "reprint": true.
+        The check and the enqueue run under one lock, so concurrent requests for
+        the same order queue it once.
+        """
+        records = payload if isinstance(payload, list) else [payload]
+        report = BatchReport("api")
+        statuses = []
+        with self._lock:
+            self._submit(records, report, statuses)
+        errors = [{"row": n, "order_id": oid, "error": detail} for n, oid, detail in report.failed]
+        errors += [{"row": n, "order_id": oid, "error": detail, "duplicate": True}
+                   for n, oid, detail in report.skipped]
+        errors.sort(key=lambda e: e["row"])
+        return statuses, errors
 
-def has_been_printed(order_id):
-    h = load_history()
-    return any(item.get("order_id") == str(order_id) for item in h)
+    def _submit(self, records, report, statuses):
+        queued = {j.order_id for j in self.print_queue.active_jobs()}
+        for n, rec in enumerate(records, 1):
+            if not isinstance(rec, dict):
+                report.failed.append((n, "", "not a JSON object"))
+                continue
+            for _, oid, cust, box in validate_orders([(n, rec)], report):
+                if rec.get("reprint") is not True and (oid in queued or has_been_printed(oid)):
+                    report.skipped.append((n, oid, "already printed"))
+                    continue
+                queued.add(oid)
+                printer = rec.get("printer") or self.printer
+                if printer:
+                    job = PrintJob(oid, cust, box, printer)
+                else:
+                    job = PdfJob(oid, cust, box, None)
+                self._track(job)
+                self.print_queue.submit(job)
+                statuses.append(job_status(job))
 
-# ---------- PDF CREATE (Desktop) ----------
-# Using reportlab to generate 70x50 mm pages (one per BOX)
-from reportlab.pdfgen import canvas
-from reportlab.lib.units import mm
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
+    def _track(self, job):
+        with self._lock:
+            self.jobs[job.id] = job
+            if len(self.jobs) > self.max_jobs:
+                for jid in [j.id for j in self.jobs.values() if j.state not in ("queued", "printing")]:
+                    del self.jobs[jid]
+                    if len(self.jobs) <= self.max_jobs:
+                        break
 
-PAGE_W_MM = 70
-PAGE_H_MM = 50
-MARGIN_MM = 5
-FONT_TTF = "arial.ttf"  # optional bundled font
-FONT_NAME = "Helvetica"
-FONT_NAME1 = "Helvetica-Bold"
-if os.path.exists(FONT_TTF):
-    try:
-        pdfmetrics.registerFont(TTFont("AppFont", FONT_TTF))
-        FONT_NAME = "AppFont"
-    except:
-        FONT_NAME = "Helvetica"
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
 
-def create_pdf_80x50_left(order_id, customer, box_qty):
-    """Create PDF file ORDER_<order_id>.pdf with box_qty pages."""
-    pagesize = (PAGE_W_MM * mm, PAGE_H_MM * mm)
-    filename = f"ORDER_{order_id}.pdf"
-    try:
-        c = canvas.Canvas(filename, pagesize=pagesize)
-        margin = MARGIN_MM * mm
-        width, height = pagesize
-        usable_h = height - 2 * margin
-        part_h = usable_h / 3.0
-        left_x = margin
-        for i in range(int(box_qty)):
-            order_font = max(10, min(int(part_h * 0.8), 48))
-            other_font = max(8, min(int(part_h * 0.45), 30))
-            y1 = height - margin - (part_h * 0.3)
-            c.setFont(FONT_NAME1, order_font)
-            text1 = str(order_id)
-            max_chars_line = int((width - 2.5 * margin) / (order_font * 0.6)) if order_font > 0 else 40
-            if len(text1) > max_chars_line:
-                text1 = text1[:max_chars_line]
-            c.drawString(left_x, y1, text1)
-            y2 = height - margin - part_h - (part_h * 0.3)
-            c.setFont(FONT_NAME, other_font)
-            text2 = str(customer)
-            max_chars_line2 = int((width - 2.5 * margin) / (other_font * 0.5)) if other_font > 0 else 40
-            if len(text2) > max_chars_line2:
-                text2 = text2[:max_chars_line2]
-            c.drawString(left_x, y2, text2)
-            y3 = height - margin - part_h * 2.5 - (part_h * 0.3)
-            c.setFont(FONT_NAME, other_font)
-            text3 = f"BOX: # {i + 1} / {box_qty}"
-            c.drawString(left_x, y3, text3)
-            c.showPage()
-        c.save()
-        return filename
-    except Exception:
-        try:
-            if os.path.exists(filename):
-                os.remove(filename)
-        except:
-            pass
-        raise
+def make_print_server(addr=SERVER_ADDR, printer=None):
+    """ThreadingHTTPServer for the job API on host:port (not started)."""
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
-# ---------- OPEN PDF (Desktop) ----------
-def open_pdf_by_platform(path):
-    """Open PDF using OS default application (desktop only)."""
-    abs_path = os.path.abspath(path)
-    try:
-        if platform == "win":
-            os.startfile(abs_path)
-        elif platform == "macosx":
-            subprocess.call(["open", abs_path])
-        else:
-            # linux
-            subprocess.call(["xdg-open", abs_path])
-    except Exception as e:
-        print("open_pdf error:", e)
+    class Handler(BaseHTTPRequestHandler):
+        server_version = "OrderPrinter/1.0"
 
-# ---------- Platform helper ----------
-def is_android():
-    """Return True when running on Android (Kivy/p4a)."""
-    return platform == "android"
+        def log_message(self, fmt, *args):
+            pass  # one line per request would swamp the console at WMS rates
 
-# ---------- ESC/POS bytes builder ----------
-def escpos_bytes_for_label(order_id, customer, box_index, box_total, encoding='utf-8'):
-    """
-    Build ESC/POS bytes for a label.
-    Basic format:
-      - reset
-      - enlarge order_id
-      - normal customer
-      - BOX line
-      - feeds + cut
-    NOTE: Each printer differs; adjust sequences to your printer manual.
-    """
-    b = bytearray()
-    b += b'\x1b\x40'  # reset
-    # Order ID
-    b += b'\x1d\x21\x11'
-    b += order_id.encode(encoding, errors='replace') + b'\n'
-    # Customer
-    b += b'\x1d\x21\x00'
-    b += customer.encode(encoding, errors='replace') + b'\n'
-    # Box info
-    b += f"BOX: #{box_index}/{box_total}\n".encode(encoding)
-    b += b'\n\n'
-    b += b'\x1d\x56\x00'
-    return bytes(b)
+        def _send(self, code, body):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
 
-# ---------- pyjnius Bluetooth helpers (Android) ----------
-def find_paired_printers_pyjnius():
-    """Return list of (name, mac) for bonded devices. Best-effort."""
-    try:
-        from jnius import autoclass
-        BluetoothAdapter = autoclass('android.bluetooth.BluetoothAdapter')
-        adapter = BluetoothAdapter.getDefaultAdapter()
-        if adapter is None:
-            return []
-        paired = adapter.getBondedDevices()
-        devices = []
-        # paired could be a Java Set - try toArray then iterate
-        try:
-            arr = paired.toArray()
-            for dev in arr:
+        def _job(self):
+            parts = self.path.rstrip("/").split("/")
+            if len(parts) == 3 and parts[1] == "jobs" and parts[2].isdigit():
+                return self.server.print_server.get(int(parts[2]))
+            return None
+
+        def do_GET(self):
+            ps = self.server.print_server
+            if self.path == "/health":
+                self._send(200, {"ok": True, "printer": ps.printer, "active": len(ps.print_queue.active_jobs())})
+            elif self.path.rstrip("/") == "/jobs":
+                self._send(200, {"jobs": [job_status(j) for j in ps.print_queue.active_jobs()]})
+            elif self.path.startswith("/history?"):
+                from urllib.parse import urlsplit, parse_qs
+                query = parse_qs(urlsplit(self.path).query)
                 try:
-                    devices.append((dev.getName(), dev.getAddress()))
-                except:
-                    continue
-        except:
+                    limit = max(1, min(int(query.get("limit", [SEARCH_LIMIT])[0]), 1000))
+                except ValueError:
+                    limit = SEARCH_LIMIT
+                self._send(200, {"results": search_history(query.get("q", [""])[0], limit)})
+            else:
+                job = self._job()
+                if job is None:
+                    self._send(404, {"error": "not found"})
+                else:
+                    self._send(200, job_status(job))
+
+        def do_POST(self):
+            if self.path.rstrip("/") != "/jobs":
+                self._send(404, {"error": "not found"})
+                return
             try:
-                it = paired.iterator()
-                while it.hasNext():
-                    dev = it.next()
-                    try:
-                        devices.append((dev.getName(), dev.getAddress()))
-                    except:
-                        continue
-            except Exception:
-                pass
-        return devices
-    except Exception as e:
-        print("find_paired_printers_pyjnius error:", e)
-        return []
+                length = int(self.headers.get("Content-Length") or 0)
+            except ValueError:
+                length = -1
+            if length < 0 or length > SERVER_MAX_BODY:
+                self.close_connection = True  # the body is left unread
+                if length < 0:
+                    self._send(400, {"error": "invalid Content-Length"})
+                else:
+                    self._send(413, {"error": "request too large"})
+                return
+            try:
+                payload = json.loads(self.rfile.read(length).decode("utf-8"))
+            except ValueError as e:
+                self._send(400, {"error": f"invalid JSON: {e}"})
+                return
+            statuses, errors = self.server.print_server.submit(payload)
+            if statuses:
+                code = 202
+            elif errors and all(e.get("duplicate") for e in errors):
+                code = 409
+            else:
+                code = 400
+            self._send(code, {"jobs": statuses, "errors": errors})
 
-def print_via_bluetooth_pyjnius(mac_addr, payload_bytes, timeout=10):
-    """Connect via RFCOMM SPP UUID and send bytes. Returns (True, None) or (False, error)."""
+        def do_DELETE(self):
+            job = self._job()
+            if job is None:
+                self._send(404, {"error": "not found"})
+                return
+            job.cancel()
+            self._send(200, job_status(job))
+
+    host, _, port = addr.rpartition(":")
+    httpd = ThreadingHTTPServer((host or "127.0.0.1", int(port)), Handler)
+    httpd.print_server = PrintServer(printer)
+    return httpd
+
+def serve(addr=SERVER_ADDR, printer=None):
+    """Run the job API until interrupted (blocks)."""
+    global HEADLESS
+    HEADLESS = True
+    if printer is None:
+        remembered = PRINTERS.default()
+        printer = NET_PRINTER or (remembered[1] if remembered else None)
+    httpd = make_print_server(addr, printer)
+    host, port = httpd.server_address[:2]
+    def reaper():
+        while True:
+            time.sleep(15)
+            reap_idle_printer_sessions()
+    threading.Thread(target=reaper, name="session-reaper", daemon=True).start()
+    print(f"Print server on http://{host}:{port}/ (printer: {printer or 'PDF'})", flush=True)
     try:
-        from jnius import autoclass
-        UUID = autoclass('java.util.UUID')
-        BluetoothAdapter = autoclass('android.bluetooth.BluetoothAdapter')
-        adapter = BluetoothAdapter.getDefaultAdapter()
-        if adapter is None:
-            return False, "Bluetooth adapter not available"
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        close_printer_sessions()
 
-        device = adapter.getRemoteDevice(mac_addr)
-        spp_uuid = UUID.fromString("00001101-0000-1000-8000-00805F9B34FB")
-        socket = device.createRfcommSocketToServiceRecord(spp_uuid)
-        try:
-            if adapter.isDiscovering():
-                adapter.cancelDiscovery()
-        except:
-            pass
-        socket.connect()
-        out = socket.getOutputStream()
-        out.write(payload_bytes)
-        out.flush()
-        try:
-            out.close()
-        except:
-            pass
-        try:
-            socket.close()
-        except:
-            pass
-        return True, None
-    except Exception as e:
-        # fallback reflection trick for some devices
-        try:
-            from jnius import autoclass
-            BluetoothAdapter = autoclass('android.bluetooth.BluetoothAdapter')
-            adapter = BluetoothAdapter.getDefaultAdapter()
-            device = adapter.getRemoteDevice(mac_addr)
-            klass = device.getClass()
-            Integer = autoclass('java.lang.Integer')
-            m = klass.getMethod("createRfcommSocket", [Integer.TYPE])
-            sock = m.invoke(device, 1)
-            sock.connect()
-            out = sock.getOutputStream()
-            out.write(payload_bytes)
-            out.flush()
-            out.close()
-            sock.close()
-            return True, None
-        except Exception as e2:
-            return False, f"{e} ; fallback: {e2}"
+def serve_main(argv):
+    import argparse
+    ap = argparse.ArgumentParser(description="Order printer headless job server")
+    ap.add_argument("--serve", nargs="?", const=SERVER_ADDR, default=SERVER_ADDR, metavar="HOST:PORT")
+    ap.add_argument("--printer", help="Bluetooth MAC or host[:port] (default: station printer, else PDF)")
+    args = ap.parse_args(argv)
+    serve(args.serve, args.printer)
+    return 0
 
 # ---------- Best-effort runtime permission request (Android) ----------
 def request_android_permissions():
@@ -259,66 +3925,132 @@ def request_android_permissions():
     """
     if not is_android():
         return False, "not android"
-    try:
-        from jnius import autoclass
-        PythonActivity = autoclass('org.kivy.android.PythonActivity')
-        activity = PythonActivity.mActivity
-        Build = autoclass('android.os.Build')
-        sdk = int(Build.VERSION.SDK)
-        if sdk >= 23:
-            Manifest = autoclass('android.Manifest$permission')
-            perms = []
-            # include common ones; some may not exist on older SDKs
-            try:
-                perms.append(Manifest.BLUETOOTH)
-                perms.append(Manifest.BLUETOOTH_ADMIN)
-            except:
-                pass
-            try:
-                perms.append(Manifest.BLUETOOTH_CONNECT)
-                perms.append(Manifest.BLUETOOTH_SCAN)
-            except:
-                pass
-            try:
-                perms.append(Manifest.ACCESS_FINE_LOCATION)
-            except:
-                pass
-            # build Java string array
-            String = autoclass('java.lang.String')
-            StringArray = autoclass('[Ljava.lang.String;')
-            jarr = StringArray(len(perms))
-            for i, p in enumerate(perms):
-                jarr[i] = p
-            activity.requestPermissions(jarr, 0)
-        return True, None
-    except Exception as e:
-        print("request_android_permissions error:", e)
-        return False, str(e)
+    with METRICS.span("permission"):
+        try:
+            PythonActivity = jclass('org.kivy.android.PythonActivity')
+            activity = PythonActivity.mActivity
+            Build = jclass('android.os.Build')
+            sdk = int(Build.VERSION.SDK)
+            if sdk >= 23:
+                Manifest = jclass('android.Manifest$permission')
+                perms = []
+                # include common ones; some may not exist on older SDKs
+                try:
+                    perms.append(Manifest.BLUETOOTH)
+                    perms.append(Manifest.BLUETOOTH_ADMIN)
+                except:
+                    pass
+                try:
+                    perms.append(Manifest.BLUETOOTH_CONNECT)
+                    perms.append(Manifest.BLUETOOTH_SCAN)
+                except:
+                    pass
+                try:
+                    perms.append(Manifest.ACCESS_FINE_LOCATION)
+                except:
+                    pass
+                # build Java string array
+                String = jclass('java.lang.String')
+                StringArray = jclass('[Ljava.lang.String;')
+                jarr = StringArray(len(perms))
+                for i, p in enumerate(perms):
+                    jarr[i] = p
+                activity.requestPermissions(jarr, 0)
+            return True, None
+        except Exception as e:
+            print("request_android_permissions error:", e)
+            return False, str(e)
 
 # ---------- UI SCREENS ----------
 class HomeScreen(Screen):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         layout = BoxLayout(orientation='vertical', padding=dp(12), spacing=dp(12))
-        inner = BoxLayout(orientation='vertical', size_hint=(.8, None), height=dp(420), spacing=dp(12),
-                          pos_hint={'center_x': 0.5, 'center_y': 0.5})
+        # scrolls on short screens; the side padding keeps the old 80% column width
+        scroll = ScrollView(do_scroll_x=False)
+        inner = BoxLayout(orientation='vertical', size_hint=(1, None), spacing=dp(12))
+        inner.bind(minimum_height=inner.setter('height'),
+                   width=lambda w, width: setattr(w, 'padding', [width * .1, 0]))
+        from kivy.uix.textinput import TextInput  # imports (creates) the Window; keep out of module import
+        self.entry_search = TextInput(hint_text="Tra cứu đơn đã in (mã đơn / tên khách)", font_size=dp(18),
+                                      size_hint_y=None, height=dp(50), multiline=False)
+        self.entry_search.bind(text=self.on_search_text)
+        self.search_result = Label(text="", size_hint_y=None, height=dp(100), font_size=dp(15), color=[0, 0, 0.5, 1])
+        self._search_ev = None
         self.entry_order = TextInput(hint_text="Mã đơn hàng", font_size=dp(20), size_hint_y=None, height=dp(50))
         self.entry_customer = TextInput(hint_text="Tên khách", font_size=dp(20), size_hint_y=None, height=dp(50))
         self.entry_box = TextInput(hint_text="Số BOX", font_size=dp(20), size_hint_y=None, height=dp(50), input_filter='int')
         btn_print = Button(text="Xem & In", size_hint_y=None, height=dp(60), font_size=dp(20), background_color=[0.3, 0.6, 1, 1])
         btn_print.bind(on_release=self.on_print)
         btn_history = Button(text="Lịch sử đơn đã in", size_hint_y=None, height=dp(60), font_size=dp(20), background_color=[0.3, 1, 0.5, 1])
-        btn_history.bind(on_release=lambda *_: setattr(self.manager, "current", "history"))
+        btn_history.bind(on_release=lambda *_: App.get_running_app().show_screen("history"))
         btn_dupes = Button(text="Đơn bị in trùng", size_hint_y=None, height=dp(60), font_size=dp(20), background_color=[1, 0.5, 0.3, 1])
-        btn_dupes.bind(on_release=lambda *_: setattr(self.manager, "current", "dupes"))
+        btn_dupes.bind(on_release=lambda *_: App.get_running_app().show_screen("dupes"))
+        btn_batch = Button(text="In theo danh sách (CSV/XLSX)", size_hint_y=None, height=dp(60), font_size=dp(20), background_color=[0.7, 0.5, 1, 1])
+        btn_batch.bind(on_release=lambda *_: show_batch_import_popup())
+        self.btn_spool = Button(text="Đơn in dở", size_hint_y=None, height=dp(60), font_size=dp(20), background_color=[1, 0.8, 0.2, 1])
+        self.btn_spool.bind(on_release=lambda *_: show_unfinished_jobs_popup(self.refresh_spool))
+        btn_diag = Button(text="Chẩn đoán in", size_hint_y=None, height=dp(60), font_size=dp(20), background_color=[0.6, 0.6, 0.6, 1])
+        btn_diag.bind(on_release=lambda *_: App.get_running_app().show_screen("diagnostics"))
+        inner.add_widget(self.entry_search)
+        inner.add_widget(self.search_result)
         inner.add_widget(self.entry_order)
         inner.add_widget(self.entry_customer)
         inner.add_widget(self.entry_box)
         inner.add_widget(btn_print)
         inner.add_widget(btn_history)
         inner.add_widget(btn_dupes)
-        layout.add_widget(inner)
+        inner.add_widget(btn_batch)
+        inner.add_widget(self.btn_spool)
+        inner.add_widget(btn_diag)
+        self.queue_status = Label(text="", size_hint_y=None, height=dp(30), font_size=dp(16), color=[0, 0, 0.5, 1])
+        inner.add_widget(self.queue_status)
+        scroll.add_widget(inner)
+        layout.add_widget(scroll)
         self.add_widget(layout)
+        PRINT_QUEUE.listeners.append(self.on_queue_change)
+        self.refresh_spool()
+
+    def on_search_text(self, _, text):
+        if self._search_ev is not None:
+            self._search_ev.cancel()
+        self._search_ev = Clock.schedule_once(lambda dt: self.run_search(text.strip()), 0.3)
+
+    def run_search(self, q):
+        """Up to 4 printed orders matching q, searched off the UI thread (first search builds the index)."""
+        if not q:
+            self.search_result.text = ""
+            return
+        def work():
+            rows = search_history(q, limit=4)
+            def done(dt):
+                if self.entry_search.text.strip() != q:
+                    return  # typed on meanwhile
+                if not rows:
+                    self.search_result.text = f"Chưa in đơn nào khớp \"{q}\""
+                    return
+                self.search_result.text = "\n".join(
+                    f"{it.get('order_id')} | {it.get('customer')} | in {it.get('count')} lần | "
+                    f"{str(it.get('timestamp'))[:10]}" + (" (lưu trữ)" if it.get("archived") else "")
+                    for it in rows)
+            Clock.schedule_once(done)
+        threading.Thread(target=work, name="home-search", daemon=True).start()
+
+    def refresh_spool(self, *_):
+        n = sum(1 for u in SPOOL.unfinished() if u["pending"])
+        self.btn_spool.text = f"Đơn in dở ({n})" if n else "Đơn in dở"
+
+    def on_queue_change(self, print_queue):
+        self.refresh_spool()
+        jobs = print_queue.active_jobs()
+        printing = [j for j in jobs if j.state == "printing"]
+        waiting = len(jobs) - len(printing)
+        if not jobs:
+            self.queue_status.text = ""
+        elif printing:
+            self.queue_status.text = f"Đang in {printing[0].order_id}, {waiting} đơn chờ"
+        else:
+            self.queue_status.text = f"{waiting} đơn chờ in"
 
     def on_print(self, *_):
         oid = self.entry_order.text.strip()
@@ -328,13 +4060,11 @@ class HomeScreen(Screen):
             from kivy.uix.popup import Popup
             Popup(title="Thiếu thông tin", content=Label(text="Vui lòng nhập đầy đủ thông tin!"), size_hint=(.8, .4)).open()
             return
-        try:
-            box_n = int(box)
-            if box_n <= 0:
-                raise ValueError
-        except:
+        box_n = parse_box_qty(box)
+        if box_n is None:
             from kivy.uix.popup import Popup
-            Popup(title="Sai định dạng", content=Label(text="Số BOX phải là số nguyên dương"), size_hint=(.8, .4)).open()
+            Popup(title="Sai định dạng", content=Label(text=f"Số BOX phải là số nguyên từ 1 đến {MAX_BOX_QTY}"),
+                  size_hint=(.8, .4)).open()
             return
         if has_been_printed(oid):
             from kivy.uix.popup import Popup
@@ -361,11 +4091,21 @@ class HomeScreen(Screen):
     def do_print(self, oid, cust, box_n):
         """
         Main dispatcher:
+        - If desktop with a network printer (NET_PRINTER) -> queue raw ESC/POS over TCP.
         - If desktop -> create PDF, save history, open file.
         - If Android -> request permissions + show preview popup which drives printing.
         """
         try:
-            if not is_android():
+            if not is_android() and NET_PRINTER:
+                # Desktop + LAN printer: same print queue/session path as Bluetooth, over TCP 9100
+                from kivy.uix.popup import Popup
+                def on_done(job):
+                    msg = f"{job.success_count}/{job.box_qty} nhãn đã in tới {NET_PRINTER}."
+                    if job.fail_count or job.error:
+                        msg += "\n" + str(job.error or next((e for ok, e in job.results if not ok), ""))
+                    Popup(title="Hoàn tất" if job.success_count else "Lỗi", content=Label(text=msg), size_hint=(.8, .4)).open()
+                PRINT_QUEUE.submit(PrintJob(oid, cust, box_n, NET_PRINTER, on_done=on_done))
+            elif not is_android():
                 # Desktop behavior: create PDF, save history, open
                 pdf_path = create_pdf_80x50_left(oid, cust, box_n)
                 add_history_entry(oid, cust, box_n)
@@ -389,206 +4129,705 @@ class HomeScreen(Screen):
             from kivy.uix.popup import Popup
             Popup(title="Lỗi", content=Label(text=str(e)), size_hint=(.8, .4)).open()
 
+HISTORY_PAGE_SIZE = 100
+
+def recycled_list(row_height=40):
+    """RecycleView of Labels (widgets only for visible rows); fill it through .data."""
+    rv = RecycleView()
+    lm = RecycleBoxLayout(orientation='vertical', size_hint_y=None, spacing=dp(4),
+                          default_size=(None, dp(row_height)), default_size_hint=(1, None))
+    lm.bind(minimum_height=lm.setter('height'))
+    rv.add_widget(lm)
+    rv.viewclass = Label
+    return rv
+
 class HistoryScreen(Screen):
+    """
+    Newest-first history of the active segment, paged HISTORY_PAGE_SIZE rows at a time.
+    Revisits only read the entries appended since the last visit. With a search
+    text the list shows HISTORY.search() results instead (archived months included).
+    """
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        root = BoxLayout(orientation='vertical', padding=dp(12))
-        scroll = ScrollView()
-        self.container = GridLayout(cols=1, spacing=dp(4), size_hint_y=None)
-        self.container.bind(minimum_height=self.container.setter('height'))
-        scroll.add_widget(self.container)
+        root = BoxLayout(orientation='vertical', padding=dp(12), spacing=dp(8))
+        from kivy.uix.textinput import TextInput
+        self.search = TextInput(hint_text="Tìm mã đơn / tên khách", font_size=dp(18), size_hint_y=None, height=dp(46), multiline=False)
+        self.search.bind(text=self.on_search_text)
+        self.rv = recycled_list()
+        self.btn_more = Button(text="Tải thêm", size_hint_y=None, height=dp(44), font_size=dp(16))
+        self.btn_more.bind(on_release=lambda *_: self.load_more())
         btn_back = Button(text="Về trang chủ", size_hint_y=None, height=dp(50), font_size=dp(18), background_color=[0.6, 0.6, 0.6, 1])
         btn_back.bind(on_release=lambda *_: setattr(self.manager, "current", "home"))
-        root.add_widget(scroll)
+        root.add_widget(self.search)
+        root.add_widget(self.rv)
+        root.add_widget(self.btn_more)
         root.add_widget(btn_back)
         self.add_widget(root)
+        self._seen = 0          # len(HISTORY) when the list was last brought up to date
+        self._generation = None  # HISTORY.generation (journal rotated -> rebuild)
+        self._version = None    # HISTORY.version at that time
+        self._older = None      # newest-first generator for the next pages
+        self._row_oids = []     # order_id of each row in rv.data
+        self._filter = ""
+        self._search_limit = HISTORY_PAGE_SIZE
+        self._search_ev = None
 
     def on_enter(self, *args):
         self.refresh_history()
 
-    def refresh_history(self):
-        self.container.clear_widgets()
-        data = load_history()
-        counts = {}
-        for it in data:
-            oid = it.get("order_id")
-            counts[oid] = counts.get(oid, 0) + 1
-        for it in reversed(data):
-            oid = it.get("order_id")
-            color = [1, 0, 0, 1] if counts.get(oid, 0) > 1 else [0, 0, 0.5, 1]
-            lbl = Label(text=f"{it.get('order_id')} | {it.get('customer')} | BOX {it.get('box_qty')} | {it.get('timestamp')}",
-                        size_hint_y=None, height=dp(40), color=color, font_size=dp(18))
-            self.container.add_widget(lbl)
+    def on_search_text(self, _, text):
+        if self._search_ev is not None:
+            self._search_ev.cancel()
+        def apply(dt):
+            self._filter = text.strip()
+            self._search_limit = HISTORY_PAGE_SIZE
+            self.refresh_history(reset=True)
+        self._search_ev = Clock.schedule_once(apply, 0.3)
+
+    def _row(self, it):
+        oid = it.get("order_id")
+        count = it["count"] if "count" in it else HISTORY.total_count(oid)
+        color = [1, 0, 0, 1] if count > 1 else [0, 0, 0.5, 1]
+        boxes = it.get("boxes")
+        box = f"BOX {boxes}/{it.get('box_qty')}" if boxes and boxes != f"1-{it.get('box_qty')}" else f"BOX {it.get('box_qty')}"
+        text = f"{it.get('order_id')} | {it.get('customer')} | {box} | {it.get('timestamp')}"
+        if it.get("archived"):
+            text += f" | lưu trữ {it['archived']}"
+        return {"text": text, "color": color, "font_size": dp(18)}
+
+    def _run_search(self):
+        """Search results in place of the pages; searched off the UI thread (first search builds the index)."""
+        q, limit = self._filter, self._search_limit
+        self._version = HISTORY.version
+        self._row_oids = []
+        def work():
+            rows = search_history(q, limit)
+            def done(dt):
+                if q != self._filter or limit != self._search_limit:
+                    return  # superseded
+                self.rv.data = [self._row(it) for it in rows]
+                self.btn_more.disabled = len(rows) < limit
+            Clock.schedule_once(done)
+        threading.Thread(target=work, name="history-search", daemon=True).start()
+
+    def load_more(self):
+        if self._filter:
+            self._search_limit += HISTORY_PAGE_SIZE
+            self._run_search()
+            return
+        rows = []
+        oids = []
+        for it in self._older:
+            rows.append(self._row(it))
+            oids.append(it.get("order_id"))
+            if len(rows) >= HISTORY_PAGE_SIZE:
+                break
+        else:
+            self.btn_more.disabled = True
+        self._row_oids.extend(oids)
+        self.rv.data.extend(rows)
+
+    def refresh_history(self, reset=False):
+        if self._filter:
+            if reset or HISTORY.version != self._version:
+                self._older = None  # pages rebuild when the search is cleared
+                self._run_search()
+            return
+        total = len(HISTORY)
+        if not reset and self._older is not None and HISTORY.version == self._version:
+            return
+        if reset or self._older is None or total < self._seen or self._generation != HISTORY.generation:
+            self._generation = HISTORY.generation
+            self._seen = total
+            self._version = HISTORY.version
+            self._older = (it for _, it in HISTORY.iter_newest(before=total))
+            self._row_oids = []
+            self.rv.data = []
+            self.btn_more.disabled = False
+            self.load_more()
+            return
+        # incremental: only entries appended since the last visit
+        new = list(reversed(HISTORY.entries(self._seen, total)))
+        self._seen = total
+        self._version = HISTORY.version
+        new_oids = {it.get("order_id") for it in new}
+        data = self.rv.data
+        for row, oid in zip(data, self._row_oids):
+            if oid in new_oids and HISTORY.total_count(oid) > 1:
+                row["color"] = [1, 0, 0, 1]  # became a duplicate
+        self._row_oids = [it.get("order_id") for it in new] + self._row_oids
+        self.rv.data = [self._row(it) for it in new] + list(data)
 
 class DupesScreen(Screen):
+    """
+    Orders printed more than once, from HISTORY's maintained duplicate counter
+    (active segment); "Gồm cả lưu trữ" merges the archived segments in the background.
+    """
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        root = BoxLayout(orientation='vertical', padding=dp(12))
-        scroll = ScrollView()
-        self.container = GridLayout(cols=1, spacing=dp(4), size_hint_y=None)
-        self.container.bind(minimum_height=self.container.setter('height'))
-        scroll.add_widget(self.container)
+        root = BoxLayout(orientation='vertical', padding=dp(12), spacing=dp(8))
+        from kivy.uix.textinput import TextInput
+        self.search = TextInput(hint_text="Tìm mã đơn", font_size=dp(18), size_hint_y=None, height=dp(46), multiline=False)
+        self.search.bind(text=lambda *_: self.refresh_dupes(force=True))
+        self.rv = recycled_list()
+        from kivy.uix.togglebutton import ToggleButton
+        self.btn_archive = ToggleButton(text="Gồm cả lưu trữ", size_hint_y=None, height=dp(50), font_size=dp(18))
+        self.btn_archive.bind(state=lambda *_: self.refresh_dupes(force=True))
         btn_back = Button(text="Về trang chủ", size_hint_y=None, height=dp(50), font_size=dp(18), background_color=[0.6, 0.6, 0.6, 1])
         btn_back.bind(on_release=lambda *_: setattr(self.manager, "current", "home"))
-        root.add_widget(scroll)
+        root.add_widget(self.search)
+        root.add_widget(self.rv)
+        root.add_widget(self.btn_archive)
         root.add_widget(btn_back)
         self.add_widget(root)
+        self._version = None
+        self._all = None  # (HISTORY.version, all_dupes()) once loaded
 
     def on_enter(self, *args):
         self.refresh_dupes()
 
-    def refresh_dupes(self):
-        self.container.clear_widgets()
-        data = load_history()
-        counts = {}
-        for it in data:
-            oid = it.get("order_id")
-            counts[oid] = counts.get(oid, 0) + 1
-        for oid, cnt in counts.items():
-            if cnt > 1:
-                lbl = Label(text=f"{oid} | số lần in: {cnt}", size_hint_y=None, height=dp(40), color=[1, 0, 0, 1], font_size=dp(18))
-                self.container.add_widget(lbl)
+    def refresh_dupes(self, force=False):
+        if not force and HISTORY.version == self._version:
+            return
+        self._version = HISTORY.version
+        if self.btn_archive.state == "down":
+            if self._all is None or self._all[0] != HISTORY.version:
+                self._load_all()
+                return
+            source = self._all[1]
+        else:
+            source = HISTORY.dupes()
+        q = self.search.text.strip().lower()
+        dupes = sorted(source.items(), key=lambda kv: -kv[1])
+        self.rv.data = [{"text": f"{oid} | số lần in: {cnt}", "color": [1, 0, 0, 1], "font_size": dp(18)}
+                        for oid, cnt in dupes if not q or q in str(oid).lower()]
+
+    def _load_all(self):
+        self.rv.data = [{"text": "Đang đọc lưu trữ...", "color": [0, 0, 0.5, 1], "font_size": dp(18)}]
+        version = HISTORY.version
+        def work():
+            try:
+                result = HISTORY.all_dupes()
+            except Exception as e:
+                print("Warning: cannot read history archives:", e)
+                result = HISTORY.dupes()
+            def done(dt):
+                self._all = (version, result)
+                self.refresh_dupes(force=True)
+            Clock.schedule_once(done)
+        threading.Thread(target=work, name="dupes-archive", daemon=True).start()
+
+class DiagnosticsScreen(Screen):
+    """p50 / p95 per print-path phase (and per printer) from the metrics log."""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        root = BoxLayout(orientation='vertical', padding=dp(12), spacing=dp(8))
+        self.rv = recycled_list()
+        btn_refresh = Button(text="Làm mới", size_hint_y=None, height=dp(50), font_size=dp(18), background_color=[0.3, 0.6, 1, 1])
+        btn_refresh.bind(on_release=lambda *_: self.refresh_metrics())
+        btn_back = Button(text="Về trang chủ", size_hint_y=None, height=dp(50), font_size=dp(18), background_color=[0.6, 0.6, 0.6, 1])
+        btn_back.bind(on_release=lambda *_: setattr(self.manager, "current", "home"))
+        root.add_widget(self.rv)
+        root.add_widget(btn_refresh)
+        root.add_widget(btn_back)
+        self.add_widget(root)
+
+    def on_enter(self, *args):
+        self.refresh_metrics()
+
+    def refresh_metrics(self):
+        """Summarize the metrics log on a worker thread (it can hold a few MB of spans)."""
+        if getattr(self, "_loading", False):
+            return
+        self._loading = True
+        if not self.rv.data:
+            self.rv.data = [{"text": "Đang tải...", "color": [0, 0, 0.5, 1], "font_size": dp(16)}]
+        def work():
+            try:
+                summary = METRICS.summary()
+            except Exception as e:
+                print("Warning: cannot read metrics:", e)
+                summary = {"phase": {}, "printer": {}}
+            Clock.schedule_once(lambda dt: self._show_summary(summary))
+        threading.Thread(target=work, name="metrics-summary", daemon=True).start()
+
+    def _show_summary(self, summary):
+        self._loading = False
+        rows = [{"text": "giai đoạn | máy in | n | p50 ms | p95 ms | lỗi", "color": [0, 0, 0, 1], "font_size": dp(16)}]
+        def row(phase, printer, st):
+            return {"text": f"{phase} | {printer} | {st['n']} | {st['p50']:.0f} | {st['p95']:.0f} | {st['fail']}",
+                    "color": [1, 0, 0, 1] if st["fail"] else [0, 0, 0.5, 1], "font_size": dp(16)}
+        for phase, st in sorted(summary["phase"].items(), key=lambda kv: str(kv[0])):
+            rows.append(row(phase, "*", st))
+        for (phase, printer), st in sorted(summary["printer"].items(), key=lambda kv: (str(kv[0][0]), kv[0][1])):
+            rows.append(row(phase, printer, st))
+        if len(rows) == 1:
+            rows.append({"text": "Chưa có số liệu", "color": [0, 0, 0.5, 1], "font_size": dp(16)})
+        self.rv.data = rows
 
 # ---------- Android preview & print UI ----------
+PREVIEW_SUMMARY_THRESHOLD = 20  # above this, preview opens as "Box 1 ... Box N"
+PRINTER_STATUS_TEXT = {
+    "paper_out": "Máy in hết giấy",
+    "cover_open": "Nắp máy in đang mở",
+    "error": "Máy in báo lỗi",
+    "offline": "Máy in đang offline",
+    "no_reply": "Máy in không phản hồi",
+}
+
+def printer_status_text(status):
+    """Operator message for a paused job (PrintJob.on_status)."""
+    return f"{PRINTER_STATUS_TEXT.get(status, status)} - đã tạm dừng, sẽ in tiếp khi máy in sẵn sàng."
+
+class LabelPreviewRow(BoxLayout):
+    """One label preview row; recycled by the RecycleView in the print preview."""
+    order_text = StringProperty("")
+    customer_text = StringProperty("")
+    box_text = StringProperty("")
+
+    def __init__(self, **kwargs):
+        super().__init__(orientation='vertical', padding=dp(8), spacing=dp(4), **kwargs)
+        lbl_order = Label(font_size=28, size_hint_y=None, height=dp(40), halign='left', valign='middle')
+        lbl_cust = Label(font_size=18, size_hint_y=None, height=dp(36), halign='left', valign='middle')
+        lbl_box = Label(font_size=18, size_hint_y=None, height=dp(36), halign='left', valign='middle')
+        for lbl in (lbl_order, lbl_cust, lbl_box):
+            lbl.bind(size=lbl.setter('text_size'))
+            self.add_widget(lbl)
+        self.bind(order_text=lbl_order.setter('text'),
+                  customer_text=lbl_cust.setter('text'),
+                  box_text=lbl_box.setter('text'))
+
+def preview_rows(oid, cust, box_n, summary=False):
+    """RecycleView data for the preview: every box, or first/last with a gap row when summary."""
+    def row(i):
+        return {"order_text": oid, "customer_text": cust, "box_text": f"BOX: #{i} / {box_n}"}
+    if summary and box_n > 2:
+        gap = {"order_text": "…", "customer_text": f"{box_n - 2} nhãn giống nhau", "box_text": f"BOX: #2 … #{box_n - 1}"}
+        return [row(1), gap, row(box_n)]
+    return [row(i + 1) for i in range(box_n)]
+
+def choose_printer(host, status, on_chosen, use_default=True):
+    """
+    Pick a printer and call on_chosen(mac):
+    - station's remembered printer (use_default) -> used directly, no discovery
+    - no paired printer -> MAC input row added to `host`
+    - several -> chooser popup
+    - one -> used directly
+    """
+    from kivy.uix.popup import Popup
+    remembered = PRINTERS.default() if use_default else None
+    if remembered:
+        status.text = f"In tới: {remembered[0]} [{remembered[1]}] (máy in mặc định)..."
+        on_chosen(remembered[1])
+        return
+    # Get paired devices
+    printers = find_paired_printers_pyjnius()
+    if not printers:
+        status.text = "Không tìm thấy máy in đã ghép đôi. Nhập MAC hoặc ghép đôi trước."
+        mac_box = BoxLayout(size_hint_y=None, height=dp(48), spacing=dp(6))
+        from kivy.uix.textinput import TextInput
+        mac_input = TextInput(hint_text="MAC máy in (ví dụ: 00:11:22:33:44:55)", size_hint_x=0.8)
+        mac_btn = Button(text="OK", size_hint_x=0.2)
+        def mac_ok(*__):
+            mac = mac_input.text.strip()
+            if mac:
+                try:
+                    host.remove_widget(mac_box)
+                except:
+                    pass
+                status.text = "Bắt đầu in..."
+                on_chosen(mac)
+            else:
+                status.text = "MAC rỗng"
+        mac_btn.bind(on_release=mac_ok)
+        mac_box.add_widget(mac_input)
+        mac_box.add_widget(mac_btn)
+        host.add_widget(mac_box)
+        return
+
+    # If multiple printers, let user choose; otherwise use the only one
+    if len(printers) > 1:
+        sel_box = BoxLayout(orientation='vertical', spacing=dp(8), padding=dp(8))
+        from kivy.core.window import Window
+        sel_scroll = ScrollView(size_hint=(1, None), size=(Window.width * 0.9, dp(200)))
+        sel_container = BoxLayout(orientation='vertical', size_hint_y=None)
+        sel_container.bind(minimum_height=sel_container.setter('height'))
+        choose_popup = None
+        def make_choice_button(name, mac):
+            btn = Button(text=f"{name} [{mac}]", size_hint_y=None, height=dp(48))
+            def on_choose(_):
+                if choose_popup:
+                    choose_popup.dismiss()
+                status.text = f"In tới {mac}..."
+                on_chosen(mac)
+            btn.bind(on_release=on_choose)
+            return btn
+        for name, mac in printers:
+            sel_container.add_widget(make_choice_button(name or "Unknown", mac))
+        sel_scroll.add_widget(sel_container)
+        sel_box.add_widget(sel_scroll)
+        choose_popup = Popup(title="Chọn máy in", content=sel_box, size_hint=(0.9, 0.6))
+        choose_popup.open()
+        return
+
+    chosen = printers[0]
+    status.text = f"In tới: {chosen[0]} [{chosen[1]}]..."
+    on_chosen(chosen[1])
+
+def choose_printers(host, status, on_chosen):
+    """
+    Pick several paired printers for a fan-out job and call on_chosen([mac, ...]).
+    With fewer than two paired printers this is choose_printer() (one MAC).
+    """
+    printers = find_paired_printers_pyjnius()
+    if len(printers) < 2:
+        choose_printer(host, status, lambda mac: on_chosen([mac]), use_default=False)
+        return
+    from kivy.uix.popup import Popup
+    from kivy.uix.togglebutton import ToggleButton
+    remembered = PRINTERS.default()
+    sel_box = BoxLayout(orientation='vertical', spacing=dp(8), padding=dp(8))
+    toggles = []
+    for name, mac in printers:
+        tb = ToggleButton(text=f"{name or 'Unknown'} [{mac}]", size_hint_y=None, height=dp(48),
+                          state="down" if remembered and remembered[1] == mac else "normal")
+        tb.mac = mac
+        toggles.append(tb)
+        sel_box.add_widget(tb)
+    btn_ok = Button(text="In trên các máy đã chọn", size_hint_y=None, height=dp(48))
+    popup = Popup(title="Chọn nhiều máy in", content=sel_box, size_hint=(0.9, 0.7))
+    def on_ok(*_):
+        macs = [tb.mac for tb in toggles if tb.state == "down"]
+        if not macs:
+            status.text = "Chưa chọn máy in"
+            return
+        popup.dismiss()
+        status.text = f"In trên {len(macs)} máy in..."
+        on_chosen(macs)
+    btn_ok.bind(on_release=on_ok)
+    sel_box.add_widget(btn_ok)
+    popup.open()
+
 def android_show_print_review_and_print(self, oid, cust, box_n):
     """
     On Android:
-    - Show scrollable previews for all BOXes (one preview per BOX).
-    - Buttons: In (choose paired printer or enter MAC) / Hủy.
-    - On In: send ESC/POS bytes for each BOX via Bluetooth using pyjnius helpers.
+    - Show a recycled preview list (one row per BOX, widgets only for visible rows);
+      large orders open in summary mode (Box 1 ... Box N) with a toggle to expand.
+    - Buttons: In (choose paired printer or enter MAC) / Máy in khác / Nhiều máy in
+      (spread the boxes over several printers) / Dừng in / Đóng.
+    - On In: queue the order on PRINT_QUEUE; the worker streams ESC/POS over Bluetooth
+      and reports progress back here. Closing the popup does not stop the job.
     - Save history only if >=1 success.
     """
     from kivy.uix.popup import Popup
     from kivy.uix.boxlayout import BoxLayout
     from kivy.uix.label import Label
     from kivy.uix.button import Button
-    from kivy.uix.scrollview import ScrollView
-    from kivy.uix.textinput import TextInput
 
     root = BoxLayout(orientation='vertical', spacing=dp(8), padding=dp(8))
-    scroll = ScrollView(size_hint=(1, None), size=(Window.width * 0.9, Window.height * 0.6))
-    container = BoxLayout(orientation='vertical', size_hint_y=None, spacing=dp(6), padding=dp(6))
-    container.bind(minimum_height=container.setter('height'))
-
-    for i in range(box_n):
-        preview = BoxLayout(orientation='vertical', size_hint_y=None, height=dp(120), padding=dp(8), spacing=dp(4))
-        lbl_order = Label(text=oid, font_size=28, size_hint_y=None, height=dp(40), halign='left', valign='middle')
-        lbl_order.bind(size=lbl_order.setter('text_size'))
-        lbl_cust = Label(text=cust, font_size=18, size_hint_y=None, height=dp(36), halign='left', valign='middle')
-        lbl_cust.bind(size=lbl_cust.setter('text_size'))
-        lbl_box = Label(text=f"BOX: #{i+1} / {box_n}", font_size=18, size_hint_y=None, height=dp(36), halign='left', valign='middle')
-        lbl_box.bind(size=lbl_box.setter('text_size'))
-        preview.add_widget(lbl_order)
-        preview.add_widget(lbl_cust)
-        preview.add_widget(lbl_box)
-        container.add_widget(preview)
-
-    scroll.add_widget(container)
-    root.add_widget(scroll)
+    # Recycled list: only the rows on screen get widgets, whatever box_n is.
+    from kivy.core.window import Window
+    rv = RecycleView(size_hint=(1, None), size=(Window.width * 0.9, Window.height * 0.6))
+    rv_layout = RecycleBoxLayout(orientation='vertical', size_hint_y=None, spacing=dp(6), padding=dp(6),
+                                 default_size=(None, dp(120)), default_size_hint=(1, None))
+    rv_layout.bind(minimum_height=rv_layout.setter('height'))
+    rv.add_widget(rv_layout)
+    rv.viewclass = LabelPreviewRow
+    rv.data = preview_rows(oid, cust, box_n, summary=box_n > PREVIEW_SUMMARY_THRESHOLD)
+    root.add_widget(rv)
+
+    if box_n > PREVIEW_SUMMARY_THRESHOLD:
+        btn_expand = Button(text=f"Xem tất cả {box_n} nhãn", size_hint_y=None, height=dp(40), font_size=16)
+        def toggle_summary(*_):
+            summary = len(rv.data) == box_n
+            rv.data = preview_rows(oid, cust, box_n, summary=summary)
+            btn_expand.text = f"Xem tất cả {box_n} nhãn" if summary else "Thu gọn"
+        btn_expand.bind(on_release=toggle_summary)
+        root.add_widget(btn_expand)
 
     status = Label(text="", size_hint_y=None, height=dp(30))
     root.add_widget(status)
 
     btn_row = BoxLayout(size_hint_y=None, height=dp(56), spacing=dp(8))
     btn_print = Button(text="In", font_size=18)
-    btn_cancel = Button(text="Hủy", font_size=18)
+    btn_stop = Button(text="Dừng in", font_size=18, disabled=True)
+    btn_other = Button(text="Máy in khác", font_size=18)
+    btn_multi = Button(text="Nhiều máy in", font_size=18)
+    btn_cancel = Button(text="Đóng", font_size=18)
     btn_row.add_widget(btn_print)
+    btn_row.add_widget(btn_other)
+    btn_row.add_widget(btn_multi)
+    btn_row.add_widget(btn_stop)
     btn_row.add_widget(btn_cancel)
     root.add_widget(btn_row)
 
     popup = Popup(title="Xem trước nhãn", content=root, size_hint=(0.95, 0.9))
 
     def do_print_action(*_):
-        # Get paired devices
-        printers = find_paired_printers_pyjnius()
-        if not printers:
-            status.text = "Không tìm thấy máy in đã ghép đôi. Nhập MAC hoặc ghép đôi trước."
-            mac_box = BoxLayout(size_hint_y=None, height=dp(48), spacing=dp(6))
-            mac_input = TextInput(hint_text="MAC máy in (ví dụ: 00:11:22:33:44:55)", size_hint_x=0.8)
-            mac_btn = Button(text="OK", size_hint_x=0.2)
-            def mac_ok(*__):
-                mac = mac_input.text.strip()
-                if mac:
-                    try:
-                        popup.content.remove_widget(mac_box)
-                    except:
-                        pass
-                    status.text = "Bắt đầu in..."
-                    _print_sequence(mac)
-                else:
-                    status.text = "MAC rỗng"
-            mac_btn.bind(on_release=mac_ok)
-            mac_box.add_widget(mac_input)
-            mac_box.add_widget(mac_btn)
-            popup.content.add_widget(mac_box)
-            return
+        choose_printer(popup.content, status, _print_sequence)
 
-        # If multiple printers, let user choose; otherwise use the only one
-        if len(printers) > 1:
-            sel_box = BoxLayout(orientation='vertical', spacing=dp(8), padding=dp(8))
-            sel_scroll = ScrollView(size_hint=(1, None), size=(Window.width * 0.9, dp(200)))
-            sel_container = BoxLayout(orientation='vertical', size_hint_y=None)
-            sel_container.bind(minimum_height=sel_container.setter('height'))
-            choose_popup = None
-            def make_choice_button(name, mac):
-                btn = Button(text=f"{name} [{mac}]", size_hint_y=None, height=dp(48))
-                def on_choose(_):
-                    if choose_popup:
-                        choose_popup.dismiss()
-                    status.text = f"In tới {mac}..."
-                    _print_sequence(mac)
-                btn.bind(on_release=on_choose)
-                return btn
-            for name, mac in printers:
-                sel_container.add_widget(make_choice_button(name or "Unknown", mac))
-            sel_scroll.add_widget(sel_container)
-            sel_box.add_widget(sel_scroll)
-            choose_popup = Popup(title="Chọn máy in", content=sel_box, size_hint=(0.9, 0.6))
-            choose_popup.open()
-            return
+    def change_printer(*_):
+        choose_printer(popup.content, status, _print_sequence, use_default=False)
 
-        chosen = printers[0]
-        status.text = f"In tới: {chosen[0]} [{chosen[1]}]..."
-        _print_sequence(chosen[1])
+    def multi_printer(*_):
+        choose_printers(popup.content, status, _print_fan_out)
 
-    def _print_sequence(mac):
-        success_count = 0
-        fail_count = 0
-        err_msgs = []
-        for i in range(box_n):
-            payload = escpos_bytes_for_label(oid, cust, i + 1, box_n)
-            ok, err = print_via_bluetooth_pyjnius(mac, payload)
-            time.sleep(0.15)  # small gap
-            if ok:
-                success_count += 1
-            else:
-                fail_count += 1
-                err_msgs.append(f"#{i+1}: {err}")
-        if success_count > 0:
-            add_history_entry(oid, cust, box_n)
-        res = f"In xong: {success_count} thành công, {fail_count} lỗi."
+    current_job = [None]
+    # order left unfinished by an earlier run (link dropped, app closed): offer to resume it
+    earlier = next((u for u in SPOOL.unfinished() if u["order_id"] == str(oid) and u["pending"]), None)
+    if earlier:
+        status.text = f"Đơn còn {len(earlier['pending'])} BOX chưa in (từ BOX {earlier['pending'][0]})."
+        btn_print.text = "In tiếp"
+
+    def on_progress(job, i, ok, err):
+        status.text = f"Đang in {len(job.results)}/{len(job.boxes)}" + ("" if ok else f" (lỗi #{i+1})")
+
+    def on_status(job, printer_status):
+        if job.state != "printing":
+            return
+        if printer_status == "ok":
+            status.text = f"Đang in {len(job.results)}/{len(job.boxes)}"
+        else:
+            status.text = printer_status_text(printer_status)
+
+    def on_done(job):
+        unprinted = job.unprinted
+        if job.cancelled:
+            res = f"Đã dừng: {job.success_count} thành công, {len(unprinted)} chưa in."
+        else:
+            res = f"In xong: {job.success_count} thành công, {job.fail_count} lỗi."
+        if unprinted:
+            res += f" Bấm \"In tiếp\" để in từ BOX {unprinted[0]}."
+            btn_print.text = "In tiếp"
+        else:
+            btn_print.text = "In"
+        err_msgs = [f"#{b}: {err}" for b, (ok, err) in sorted(job.box_results.items()) if not ok and err != "cancelled"]
+        if job.error:
+            err_msgs.append(job.error)
         if err_msgs:
             res += "\n" + "\n".join(err_msgs[:5])
         status.text = res
+        btn_stop.disabled = True
+
+    def _resumable():
+        job = current_job[0]
+        if job is not None and job.state in ("queued", "printing"):
+            return None
+        key = job.spool_key if job is not None else earlier and earlier["key"]
+        spooled = SPOOL.job(key) if key else None
+        return spooled if spooled and spooled["pending"] else None
+
+    def _print_sequence(mac):
+        spooled = _resumable()
+        if spooled:
+            # resume: only the boxes the last run did not print, on the printer now chosen
+            _submit(PrintJob.resume(spooled, mac, on_progress=on_progress, on_done=on_done, on_status=on_status))
+        else:
+            _submit(PrintJob(oid, cust, box_n, mac, on_progress=on_progress, on_done=on_done, on_status=on_status))
+
+    def _print_fan_out(macs):
+        if len(macs) == 1:
+            _print_sequence(macs[0])
+            return
+        spooled = _resumable()
+        _submit(FanOutPrintJob(oid, cust, box_n, macs, on_progress=on_progress, on_done=on_done, on_status=on_status,
+                               boxes=spooled["pending"] if spooled else None,
+                               spool_key=spooled["key"] if spooled else None))
+
+    def _submit(job):
+        # queue the order on the print worker; the popup can be closed while it prints
+        current_job[0] = job
+        btn_stop.disabled = False
+        btn_print.text = "In"
+        queued = len(PRINT_QUEUE.active_jobs())
+        status.text = f"Đang chờ in ({queued} đơn trước)..." if queued else "Bắt đầu in..."
+        PRINT_QUEUE.submit(job)
+
+    def stop(*_):
+        if current_job[0] is not None:
+            current_job[0].cancel()
+            status.text = "Đang dừng..."
 
     def cancel(*_):
         popup.dismiss()
 
     btn_print.bind(on_release=do_print_action)
+    btn_stop.bind(on_release=stop)
+    btn_other.bind(on_release=change_printer)
+    btn_multi.bind(on_release=multi_printer)
     btn_cancel.bind(on_release=cancel)
     popup.open()
 
+def show_unfinished_jobs_popup(on_change=None):
+    """Orders with unprinted boxes in SPOOL: resume each on its printer, or drop it."""
+    from kivy.uix.popup import Popup
+    root = BoxLayout(orientation='vertical', spacing=dp(8), padding=dp(8))
+    scroll = ScrollView()
+    rows = BoxLayout(orientation='vertical', size_hint_y=None, spacing=dp(6))
+    rows.bind(minimum_height=rows.setter('height'))
+    scroll.add_widget(rows)
+    root.add_widget(scroll)
+    btn_close = Button(text="Đóng", size_hint_y=None, height=dp(50), font_size=dp(18))
+    root.add_widget(btn_close)
+    popup = Popup(title="Đơn in dở", content=root, size_hint=(0.95, 0.8))
+    btn_close.bind(on_release=lambda *_: popup.dismiss())
+
+    def fill():
+        rows.clear_widgets()
+        unfinished = [u for u in SPOOL.unfinished() if u["pending"]]
+        active = {j.spool_key for j in PRINT_QUEUE.active_jobs()}
+        if not unfinished:
+            rows.add_widget(Label(text="Không có đơn in dở", size_hint_y=None, height=dp(40)))
+        for u in unfinished:
+            row = BoxLayout(size_hint_y=None, height=dp(56), spacing=dp(6))
+            row.add_widget(Label(text=f"{u['order_id']} | {u['customer']} | còn {len(u['pending'])}/{u['box_qty']} BOX "
+                                      f"(từ #{u['pending'][0]})", size_hint_x=0.6))
+            busy = u["key"] in active
+            btn_resume = Button(text="Đang in" if busy else "In tiếp", size_hint_x=0.2, disabled=busy or not u["printer"])
+            btn_drop = Button(text="Bỏ", size_hint_x=0.2, disabled=busy)
+            btn_resume.bind(on_release=lambda _, u=u: resume(u))
+            btn_drop.bind(on_release=lambda _, u=u: drop(u))
+            row.add_widget(btn_resume)
+            row.add_widget(btn_drop)
+            rows.add_widget(row)
+
+    def changed():
+        fill()
+        if on_change:
+            on_change()
+
+    def resume(u):
+        PRINT_QUEUE.submit(PrintJob.resume(u, on_done=lambda job: changed()))
+        changed()
+
+    def drop(u):
+        SPOOL.close(u["key"])
+        changed()
+
+    fill()
+    popup.open()
+
+# ---------- Batch import UI ----------
+def show_batch_import_popup():
+    """
+    Pick a CSV/XLSX manifest and run it as one BatchJob on the print worker:
+    PDFs on desktop, ESC/POS to a chosen printer on Android. Shows a running
+    summary and writes <manifest>_report.csv when done.
+    """
+    from kivy.uix.popup import Popup
+    from kivy.uix.filechooser import FileChooserListView
+
+    start_dir = os.getcwd()
+    if is_android() and os.path.isdir("/sdcard/Download"):
+        start_dir = "/sdcard/Download"
+    root = BoxLayout(orientation='vertical', spacing=dp(8), padding=dp(8))
+    chooser = FileChooserListView(path=start_dir, filters=["*.csv", "*.CSV", "*.xlsx", "*.XLSX"])
+    root.add_widget(chooser)
+    status = Label(text="Chọn file danh sách đơn (CSV/XLSX)", size_hint_y=None, height=dp(60))
+    root.add_widget(status)
+    btn_row = BoxLayout(size_hint_y=None, height=dp(56), spacing=dp(8))
+    btn_start = Button(text="Bắt đầu", font_size=18)
+    btn_stop = Button(text="Dừng", font_size=18, disabled=True)
+    btn_close = Button(text="Đóng", font_size=18)
+    btn_row.add_widget(btn_start)
+    btn_row.add_widget(btn_stop)
+    btn_row.add_widget(btn_close)
+    root.add_widget(btn_row)
+    popup = Popup(title="In theo danh sách", content=root, size_hint=(0.95, 0.9))
+    current = [None]
+
+    def on_progress(job, report):
+        status.text = f"{job.order_id}: {report.summary()}"
+
+    def on_status(job, printer_status):
+        if printer_status != "ok" and job.state == "printing":
+            status.text = printer_status_text(printer_status)
+
+    def on_done(job):
+        btn_start.disabled = False
+        btn_stop.disabled = True
+        if job.report is None:
+            status.text = f"Lỗi: {job.error}"
+            return
+        status.text = job.report.summary() + ("\nĐã dừng." if job.cancelled else "") + \
+            f"\nBáo cáo: {os.path.splitext(os.path.basename(job.path))[0]}_report.csv"
+        if job.output:
+            open_pdf_by_platform(job.output)
+
+    def start(*_):
+        if not chooser.selection:
+            status.text = "Chưa chọn file"
+            return
+        path = chooser.selection[0]
+        def submit(mac):
+            btn_start.disabled = True
+            btn_stop.disabled = False
+            current[0] = PRINT_QUEUE.submit(BatchJob(path, mac=mac, on_progress=on_progress, on_done=on_done,
+                                                       on_status=on_status))
+            status.text = "Đang xử lý..."
+        if is_android():
+            try:
+                request_android_permissions()
+            except:
+                pass
+            choose_printer(root, status, submit)
+        else:
+            submit(None)
+
+    def stop(*_):
+        if current[0] is not None:
+            current[0].cancel()
+            status.text = "Đang dừng..."
+
+    btn_start.bind(on_release=start)
+    btn_stop.bind(on_release=stop)
+    btn_close.bind(on_release=lambda *_: popup.dismiss())
+    popup.open()
+
 # ---------- App ----------
 class OrderPrinterApp(App):
+    # secondary screens are built on first visit, not before the first frame
+    LAZY_SCREENS = {"history": HistoryScreen, "dupes": DupesScreen, "diagnostics": DiagnosticsScreen}
+
     def build(self):
+        from kivy.core.window import Window
+        mark_startup("window")
         Window.clearcolor = (1, 1, 1, 1)
         sm = ScreenManager()
         sm.add_widget(HomeScreen(name="home"))
-        sm.add_widget(HistoryScreen(name="history"))
-        sm.add_widget(DupesScreen(name="dupes"))
+        Clock.schedule_interval(reap_idle_printer_sessions, 15)
+        mark_startup("build")
+        Window.bind(on_flip=self._on_first_frame)
         return sm
 
+    def _on_first_frame(self, window, *args):
+        window.unbind(on_flip=self._on_first_frame)
+        mark_startup("first_frame")
+        report_startup()
+        # warm the history index off the UI thread so the first print doesn't pay for it
+        threading.Thread(target=len, args=(HISTORY,), name="history-index", daemon=True).start()
+        if is_android() and PRINTER_PRECONNECT:
+            PRINTERS.preconnect()
+
+    def show_screen(self, name):
+        sm = self.root
+        if not sm.has_screen(name):
+            sm.add_widget(self.LAZY_SCREENS[name](name=name))
+        sm.current = name
+
+    def on_pause(self):
+        # don't hold the printer's only SPP slot while in background
+        close_printer_sessions()
+        return True
+
+    def on_stop(self):
+        close_printer_sessions()
+
+mark_startup("module")
+
 if __name__ == "__main__":
+    if "--serve" in sys.argv:
+        sys.exit(serve_main(sys.argv[1:]))
     OrderPrinterApp().run()
 
 # ---------- BUILD / PERMISSIONS NOTES (copy to buildozer.spec) ----------
@@ -603,6 +4842,60 @@ if __name__ == "__main__":
 #
 # ESC/POS:
 # - If your printer needs different commands (size/cut), adjust escpos_bytes_for_label().
-# - If printing fails regularly, try increasing delay between jobs or splitting into single sends with small sleeps.
+# - Orders are streamed as one job in ESCPOS_CHUNK_SIZE writes, paced by the printer's real-time status
+#   (DLE EOT every STATUS_WINDOW_BYTES): paper out / cover open pauses the job until the printer is ready
+#   again (up to STATUS_PAUSE_TIMEOUT) instead of failing boxes. Printers that do not answer DLE EOT fall back
+#   to PRINTER_BUFFER_BYTES / PRINTER_DRAIN_BPS (BufferPacer) if a printer without flow control drops data.
+# - LAN printers: any printer address of the form host:port / a.b.c.d / tcp://host goes over raw TCP
+#   (TcpTransport, port 9100 by default) instead of Bluetooth. On desktop set ORDER_PRINTER_NET=host[:port]
+#   to print labels directly instead of creating a PDF.
+# - Labels carry the order id as a Code 128 (layout line {"barcode": ...}); set ESCPOS_BARCODE_MODE = "raster"
+#   for printers without GS k / GS ( k. Raster QR needs the qrcode package (or reportlab) - else a Code 128
+#   bitmap is printed. PDF labels draw PDF_BARCODE ("code128" / "qr" / None) as vector graphics.
+# - ESCPOS_LABEL_MODE = "raster" prints the PDF label layout as GS v 0 bitmaps drawn with FONT_TTF (needs pillow
+#   in requirements and the font bundled): any Vietnamese name prints correctly, at ~10 KB per label instead of
+#   ~100 bytes, so keep "text" for printers whose code page handles the customer names.
+# - "Nhiều máy in" spreads one order's boxes over several paired printers (FanOutPrintJob); a printer
+#   that fails is dropped and its remaining boxes go to the others.
+#
+# Benchmarks:
+# - python benchmarks.py [--quick] [--save FILE | --compare FILE] runs the label / PDF / history /
+#   print-sequencing benchmarks headless and saves or checks JSON baselines (desktop only).
+#
+# Metrics:
+# - Print-path spans (connect, write, flush, history_write, pdf_render, ...) go to print_metrics.jsonl
+#   (rotated at METRICS_MAX_BYTES, METRICS_BACKUPS kept); the "Chẩn đoán in" screen shows p50/p95
+#   per phase and per printer. ORDER_PRINTER_METRICS=0 turns recording off.
+#
+# Render cache:
+# - ORDER_<id>.pdf files and ESC/POS label streams are kept in render_cache/ under a hash of order, customer,
+#   box count and layout settings; reprints copy them back. LRU-evicted past RENDER_CACHE_MAX_BYTES and after
+#   RENDER_CACHE_MAX_AGE; bump RENDER_CACHE_VERSION when changing how labels are drawn or encoded.
+#
+# History:
+# - Search (home screen box, history screen, GET /history?q=) matches the start of any word / code segment of
+#   the order id or customer, ignoring diacritics and case ("huong", "000123"). The journal's index is built on
+#   the first search; archived months keep a sorted <month>.sidx next to their .idx.
+# - print_history.jsonl holds the current month (HISTORY_SEGMENT_FORMAT); older months are moved to
+#   history_archive/<month>.jsonl.gz with a sorted <month>.idx. Duplicate checks look up the archive
+#   indexes only when the order is not in the current month; the dupes screen can include them.
+#
+# Print spool:
+# - Every printer job is journaled per box in print_spool.jsonl (fsync'ed). Failed boxes get SPOOL_RETRIES
+#   more passes with backoff; whatever is still unprinted can be resumed from the preview ("In tiếp")
+#   or from "Đơn in dở" on the home screen, also after a restart. History entries list the printed boxes.
+#
+# Print server:
+# - python main.py --serve [HOST:PORT] [--printer ADDR] runs the headless job API (default 127.0.0.1:8765):
+#   POST /jobs with {"order_id", "customer", "box_qty"} or a list, GET /jobs/<id> for status,
+#   GET /history?q=<partial order code or customer>[&limit=N] to look up printed orders.
+#   Listen on localhost only unless the network is trusted - the API has no authentication.
+#
+# Batch import:
+# - Manifest = CSV (',' ';' or tab) or XLSX with a header row; column names are matched via MANIFEST_HEADERS
+#   (e.g. order_id / customer / box_qty or "Mã đơn" / "Tên khách" / "Số BOX").
+# - XLSX needs openpyxl (desktop: pip install openpyxl; Android: add it to requirements) - CSV needs nothing.
+# - Desktop batches render on a process pool (PDF_WORKERS) into <manifest>_labels.pdf; merging the
+#   per-worker parts needs pypdf (pip install pypdf), without it the merged file is drawn in one process.
 #
 # Done.
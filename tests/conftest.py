@@ -0,0 +1,29 @@
+import os
+import sys
+
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+os.environ.setdefault("KIVY_NO_CONSOLELOG", "1")
+os.environ.setdefault("KIVY_NO_FILELOG", "1")
+os.environ.setdefault("ORDER_PRINTER_METRICS", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+import main  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """Every test runs in its own directory with fresh history / spool / prefs."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, "HISTORY", main.HistoryStore(
+        str(tmp_path / "print_history.jsonl"), str(tmp_path / "print_history.json"),
+        str(tmp_path / "history_archive")))
+    monkeypatch.setattr(main, "SPOOL", main.PrintSpool(str(tmp_path / "print_spool.jsonl")))
+    monkeypatch.setattr(main, "PRINTERS", main.PrinterRegistry(str(tmp_path / "printer_prefs.json")))
+    monkeypatch.setattr(main, "SPOOL_BACKOFF", 0.0)
+    monkeypatch.setattr(main, "PRINTER_STATUS_PACING", False)
+    monkeypatch.setattr(main.RENDER_CACHE, "enabled", False)
+    monkeypatch.setattr(main, "HEADLESS", True)
+    yield tmp_path
+    main.close_printer_sessions()
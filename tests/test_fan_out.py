@@ -0,0 +1,84 @@
+import main
+
+MACS = ["AA:BB:CC:DD:EE:11", "AA:BB:CC:DD:EE:12", "AA:BB:CC:DD:EE:13"]
+
+
+class DyingTransport(main.MemoryTransport):
+    """Printer that goes away for good at the write that would take it past `labels` cuts."""
+    def __init__(self, labels, **kw):
+        super().__init__(**kw)
+        self.left = labels
+
+    def connect(self):
+        if self.left <= 0:
+            raise IOError("printer gone")
+        super().connect()
+
+    def write(self, data):
+        self.left -= data.count(main.ESC_CUT)
+        if self.left < 0:
+            self.left = 0
+            self._connected = False
+            raise IOError("broken pipe")
+        super().write(data)
+
+
+def fan_out(transports, n=12, **kw):
+    header, labels = main.escpos_job_labels("SO-1", "Khách", n)
+    sessions = {mac: main.PrinterSession(lambda t=t: t) for mac, t in zip(MACS, transports)}
+    return main.fan_out_label_job(sessions, header, labels, **kw)
+
+
+def box_counts(transports, n=12):
+    """How often each box label came out across all printers."""
+    return [sum(bytes(t.data).count(b"BOX: #%d/%d\n" % (b, n)) for t in transports) for b in range(1, n + 1)]
+
+
+def test_numbering_across_printers():
+    transports = [main.MemoryTransport(write_delay_per_kb=0.5) for _ in range(3)]
+    results, printed = fan_out(transports)
+    assert results == [(True, None)] * 12
+    assert box_counts(transports) == [1] * 12
+    assert sum(printed.values()) == 12 and all(printed.values())
+    for t in transports:  # job header once per printer, before its first label
+        assert bytes(t.data).startswith(main.ESC_RESET)
+
+
+def test_dead_printer_is_routed_around():
+    dead = DyingTransport(0)
+    transports = [dead, main.MemoryTransport(), main.MemoryTransport()]
+    seen = []
+    results, printed = fan_out(transports, on_label=lambda i, ok, err, mac: seen.append((i, ok, mac)))
+    assert results == [(True, None)] * 12
+    assert printed[MACS[0]] == 0
+    assert box_counts(transports) == [1] * 12
+    assert all(ok and mac != MACS[0] for _, ok, mac in seen)
+
+
+def test_printer_failing_mid_job_hands_its_boxes_on():
+    flaky = DyingTransport(3, write_delay_per_kb=0.5)
+    transports = [flaky, main.MemoryTransport(write_delay_per_kb=0.5)]
+    results, printed = fan_out(transports)
+    assert results == [(True, None)] * 12
+    assert printed[MACS[0]] == 3
+    assert printed[MACS[1]] == 9
+    assert box_counts(transports) == [1] * 12
+
+
+def test_every_printer_failing_reports_the_remaining_labels():
+    results, printed = fan_out([DyingTransport(2), DyingTransport(0)])
+    assert results[:2] == [(True, None)] * 2
+    assert all(not ok and err for ok, err in results[2:])
+    assert printed == {MACS[0]: 2, MACS[1]: 0}
+
+
+def test_fan_out_job_records_one_history_entry():
+    transports = [DyingTransport(2), main.MemoryTransport()]
+    for mac, t in zip(MACS, transports):
+        main.get_printer_session(mac, lambda t=t: t)
+    job = main.FanOutPrintJob("SO-1", "Khách", 12, MACS[:2])
+    job.run()
+    assert job.unprinted == []
+    assert main.HISTORY.count("SO-1") == 1
+    assert main.HISTORY.load()[-1]["boxes"] == "1-12"
+    assert main.PRINTERS.default()[1] == MACS[1]  # printed the most
@@ -0,0 +1,154 @@
+import json
+import os
+
+import pytest
+
+import main
+
+AWKWARD = ["", "A", "A\"", "A\\", "A\tB", "A B", "a", "SO-1", "SO-10", "SO-1\n2", "Đơn-ÄÖ", "雪", "\x00", "z" * 300]
+
+
+def entry(oid, ts, customer="Khách", box=1, **kw):
+    return dict(order_id=oid, customer=customer, box_qty=box, timestamp=ts, **kw)
+
+
+def store(tmp_path):
+    return main.HistoryStore(str(tmp_path / "print_history.jsonl"), str(tmp_path / "print_history.json"),
+                             str(tmp_path / "history_archive"))
+
+
+def test_legacy_json_is_migrated_once(tmp_path):
+    legacy = [entry("SO-1", "2025-01-02T10:00:00"), entry("SO-1", "2025-01-03T10:00:00"), "junk"]
+    (tmp_path / "print_history.json").write_text(json.dumps(legacy), encoding="utf-8")
+    h = store(tmp_path)
+    assert len(h) == 2
+    assert h.count("SO-1") == 2
+    assert h.dupes() == {"SO-1": 2}
+    assert not (tmp_path / "print_history.json").exists()
+    assert (tmp_path / "print_history.json.migrated").exists()
+    h.add(entry("SO-2", "2025-01-04T10:00:00"))
+    assert len(store(tmp_path)) == 3  # reopened: journal kept, legacy not imported again
+
+
+def test_torn_last_line_is_skipped(tmp_path):
+    with open(tmp_path / "print_history.jsonl", "w", encoding="utf-8") as f:
+        f.write(json.dumps(entry("SO-1", "2025-01-02T10:00:00")) + "\n{\"order_id\": \"SO-")
+    h = store(tmp_path)
+    assert len(h) == 1
+    assert h.count("SO-1") == 1
+
+
+def test_new_month_rotates_journal_into_archive(tmp_path):
+    h = store(tmp_path)
+    h.add(entry("SO-1", "2025-01-30T10:00:00"))
+    h.add(entry("SO-1", "2025-01-31T10:00:00"))
+    h.add(entry("SO-2", "2025-01-31T11:00:00"))
+    generation = h.generation
+    h.add(entry("SO-3", "2025-02-01T08:00:00"))
+    assert h.generation == generation + 1
+    assert [it["order_id"] for it in h.load()] == ["SO-3"]
+    assert sorted(os.listdir(tmp_path / "history_archive")) == ["2025-01.idx", "2025-01.jsonl.gz", "2025-01.sidx"]
+    assert h.count("SO-1") == 0
+    assert h.archived_count("SO-1") == 2
+    assert h.archived_count("SO-9") == 0
+    h.add(entry("SO-1", "2025-02-02T08:00:00"))
+    assert h.all_dupes() == {"SO-1": 3}
+    reopened = store(tmp_path)
+    assert reopened.archived_count("SO-2") == 1
+    assert len(reopened) == 2
+
+
+def test_resumed_entries_are_not_reprints(tmp_path):
+    h = store(tmp_path)
+    h.add(entry("SO-1", "2025-01-30T10:00:00", boxes="1-5"))
+    h.add(entry("SO-1", "2025-01-30T10:05:00", boxes="6-9", resumed=True))
+    assert h.count("SO-1") == 1
+    assert h.dupes() == {}
+
+
+def test_unsegmented_journal_is_split_on_open(tmp_path):
+    with open(tmp_path / "print_history.jsonl", "w", encoding="utf-8") as f:
+        for oid, ts in (("SO-1", "2024-11-05T10:00:00"), ("SO-2", "2024-12-05T10:00:00"),
+                        ("SO-1", "2025-01-05T10:00:00")):
+            f.write(json.dumps(entry(oid, ts)) + "\n")
+    h = store(tmp_path)
+    assert len(h) == 1
+    assert sorted(h.archives()) == ["2024-11", "2024-12"]
+    assert h.all_dupes() == {"SO-1": 2}
+
+
+def test_search_spans_journal_and_archives(tmp_path):
+    h = store(tmp_path)
+    h.add(entry("SO-2025-0001", "2025-01-30T10:00:00", customer="Nguyễn Văn An"))
+    h.add(entry("SO-2025-0002", "2025-02-01T10:00:00", customer="Trần Thị Bình"))
+    assert [r["order_id"] for r in h.search("binh")] == ["SO-2025-0002"]
+    archived = h.search("nguyen van")
+    assert [(r["order_id"], r["archived"]) for r in archived] == [("SO-2025-0001", "2025-01")]
+    assert [r["order_id"] for r in h.search("so-2025")] == ["SO-2025-0002", "SO-2025-0001"]
+
+
+def test_counts_span_journal_and_archives(tmp_path):
+    h = store(tmp_path)
+    h.add(entry("SO-1", "2025-01-30T10:00:00", customer="An"))
+    h.add(entry("SO-1", "2025-02-01T10:00:00", customer="An"))
+    assert (h.count("SO-1"), h.archived_count("SO-1"), h.total_count("SO-1")) == (1, 1, 2)
+    assert [(r.get("archived"), r["count"]) for r in h.search("an")] == [(None, 2), ("2025-01", 2)]
+
+
+@pytest.fixture
+def awkward_index(tmp_path):
+    path = str(tmp_path / "awkward.idx")
+    main.SortedCountIndex.write(path, {k: i + 1 for i, k in enumerate(AWKWARD)})
+    ix = main.SortedCountIndex(path)
+    yield ix
+    ix.close()
+
+
+def test_sorted_count_index_awkward_keys(awkward_index):
+    for i, k in enumerate(AWKWARD):
+        assert awkward_index.get(k) == i + 1, k
+    for missing in ("B", "A\"B", "SO-", "SO-100", "a\t", "雪雪", "\\"):
+        assert awkward_index.get(missing) == 0, missing
+    assert dict(awkward_index) == {k: i + 1 for i, k in enumerate(AWKWARD)}
+
+
+def test_sorted_count_index_merges_on_rewrite(tmp_path):
+    path = str(tmp_path / "merge.idx")
+    main.SortedCountIndex.write(path, {"A\tB": 1, "SO-1": 2})
+    main.SortedCountIndex.write(path, {"A\tB": 3, "Đơn": 1})
+    ix = main.SortedCountIndex(path)
+    assert (ix.get("A\tB"), ix.get("SO-1"), ix.get("Đơn")) == (4, 2, 1)
+    ix.close()
+
+
+def test_sorted_count_index_stream_survives_rewrite(tmp_path):
+    path = str(tmp_path / "stream.idx")
+    main.SortedCountIndex.write(path, {"SO-1": 1, "SO-2": 1})
+    stream = main.SortedCountIndex(path).stream()
+    main.SortedCountIndex.write(path, {"SO-1": 5, "SO-3": 1})
+    assert list(stream) == [("SO-1", 1), ("SO-2", 1)]
+
+
+def test_sorted_count_index_empty_file(tmp_path):
+    path = str(tmp_path / "empty.idx")
+    main.SortedCountIndex.write(path, {})
+    assert main.SortedCountIndex(path).get("SO-1") == 0
+
+
+def test_search_returns_newest_across_all_matching_keys(tmp_path):
+    h = store(tmp_path)
+    for i in range(1500):
+        h.add(entry("SO-%04d" % (1499 - i), "2025-01-02T10:00:00", customer="Khách %d" % i))
+    assert [r["order_id"] for r in h.search("so", limit=3, archived=False)] == ["SO-0000", "SO-0001", "SO-0002"]
+    h.add(entry("SO-9999", "2025-01-03T10:00:00"))
+    assert h.search("s", limit=1, archived=False)[0]["order_id"] == "SO-9999"
+
+
+def test_prefix_index_newest():
+    ix = main.PrefixIndex()
+    ix.extend([("AB", 1), ("AB", 5), ("AC", 3), ("AD", 9), ("B", 10)])
+    ix.add("AE", 7)
+    ix.add("AB", 8)
+    assert ix.newest(ix.prefixed("A"), 3) == [9, 8, 7]
+    assert ix.newest(ix.prefixed("A"), 0) == []
+    assert ix.newest(ix.prefixed("Z"), 3) == []
@@ -0,0 +1,65 @@
+import json
+from datetime import datetime
+
+import pytest
+
+import main
+
+LONG_ID = "SO-2025-000123-KHO-HCM-07"
+
+
+@pytest.mark.parametrize("barcode", [None, "code128", "qr"])
+def test_pdf_label_never_cuts_order_id(monkeypatch, barcode):
+    pypdf = pytest.importorskip("pypdf")
+    monkeypatch.setattr(main, "PDF_BARCODE", barcode)
+    path = main.create_pdf_80x50_left(LONG_ID, "Nguyễn Thị Thanh Hương", 2)
+    assert LONG_ID in pypdf.PdfReader(path).pages[0].extract_text()
+
+
+def test_fit_font_size_shrinks_to_width():
+    main.ensure_pdf_backend()
+    size = main.fit_font_size(LONG_ID, main.FONT_NAME1, 40, 100)
+    assert size < 40
+    assert main.text_width(LONG_ID, main.FONT_NAME1, size) == pytest.approx(100)
+    assert main.fit_font_size("SO-1", main.FONT_NAME1, 12, 100) == 12
+
+
+def test_raster_order_id_fits_beside_qr():
+    if main.raster_backend() is None:
+        pytest.skip("no Pillow / TTF font")
+    r = main.raster_geometry(main.PAGE_W_MM, main.PAGE_H_MM, "qr", main.ESCPOS_DOTS_PER_MM)
+    px = main.raster_fit_size(LONG_ID, r["order_px"], r["max_w"])
+    assert 1 <= px < r["order_px"]
+    assert main.raster_font(px).getlength(LONG_ID) <= r["max_w"]
+
+
+def write_layout(tmp_path, layout):
+    (tmp_path / main.LABEL_LAYOUT_FILE).write_text(layout if isinstance(layout, str) else json.dumps(layout),
+                                                   encoding="utf-8")
+
+
+def test_layout_extra_fields_and_unknown_placeholders(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "LABEL_EXTRA_FIELDS", {"warehouse": "KHO-7"})
+    write_layout(tmp_path, [{"text": "{order_id} {warehouse} {date} [{nope}]"}, {"text": "{box}/{total} {lot}"}])
+    header, labels = main.escpos_job_labels("SO-1", "A", 2, extra={"lot": "L9"})
+    today = datetime.now().strftime(main.LABEL_DATE_FORMAT).encode()
+    assert b"SO-1 KHO-7 " + today + b" []\n" in labels[0]
+    assert b"2/2 L9\n" in labels[1]
+    assert b"KHO-7" in main.escpos_bytes_for_label("SO-1", "A", 1, 1)
+
+
+@pytest.mark.parametrize("layout", [
+    "not json", {"text": "x"}, [], ["x"], [{"text": "a", "size": 2}], [{"text": "a", "size": [1, "2"]}],
+    [{"text": "a", "align": "middle"}], [{"text": "{order_id:%d}"}], [{"text": "{box.x}"}], [{"feed": "2"}],
+    [{"size": [1, 1]}], [{"barcode": "{order_id}", "height": 1.5}],
+])
+def test_malformed_layout_falls_back_to_default(tmp_path, layout, capsys):
+    write_layout(tmp_path, layout)
+    assert main.load_label_layout() is main.DEFAULT_LABEL_LAYOUT
+    assert "Warning: cannot load label layout" in capsys.readouterr().out
+    assert main.escpos_bytes_for_label("SO-1", "A", 1, 1)
+
+
+def test_extra_fields_only_key_layouts_that_use_them():
+    assert main.label_extra_fields(layout=main.DEFAULT_LABEL_LAYOUT) == {}
+    assert set(main.label_extra_fields(layout=[{"text": "{date} {station.x}"}])) == {"date", "station"}
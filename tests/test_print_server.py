@@ -0,0 +1,118 @@
+import http.client
+import json
+import threading
+import time
+
+import pytest
+
+import main
+
+
+class ListQueue:
+    """PRINT_QUEUE stand-in that only records submitted jobs."""
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, job):
+        self.jobs.append(job)
+        return job
+
+    def active_jobs(self):
+        return list(self.jobs)
+
+
+@pytest.fixture
+def server():
+    httpd = main.make_print_server("127.0.0.1:0")
+    httpd.print_server = main.PrintServer(None, print_queue=ListQueue())
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def request(httpd, method, path, body=None, headers=None):
+    conn = http.client.HTTPConnection(*httpd.server_address[:2], timeout=5)
+    data = body if isinstance(body, (bytes, type(None))) else json.dumps(body).encode()
+    conn.request(method, path, body=data, headers=headers or {})
+    resp = conn.getresponse()
+    out = resp.status, json.loads(resp.read() or b"null")
+    conn.close()
+    return out
+
+
+@pytest.mark.parametrize("value, expected", [
+    (3, 3), ("3", 3), (" 12 ", 12), (3.0, 3), ("3.0", 3), (main.MAX_BOX_QTY, main.MAX_BOX_QTY),
+    ("2.7", None), (2.7, None), (0, None), (-1, None), ("-1", None), (main.MAX_BOX_QTY + 1, None),
+    ("1e3", None), (True, None), ("", None), (None, None), ("٣", None),
+])
+def test_parse_box_qty(value, expected):
+    assert main.parse_box_qty(value) == expected
+
+
+def test_post_queues_order(server):
+    code, body = request(server, "POST", "/jobs", {"order_id": "SO-1", "customer": "A", "box_qty": 2})
+    assert code == 202
+    assert [j["order_id"] for j in body["jobs"]] == ["SO-1"]
+
+
+def test_post_rejects_bad_box_qty(server):
+    code, body = request(server, "POST", "/jobs", [
+        {"order_id": "SO-1", "customer": "A", "box_qty": "2.7"},
+        {"order_id": "SO-2", "customer": "A", "box_qty": 10 ** 9},
+    ])
+    assert code == 400
+    assert [e["row"] for e in body["errors"]] == [1, 2]
+    assert server.print_server.print_queue.jobs == []
+
+
+def test_post_refuses_duplicates(server):
+    main.add_history_entry("SO-1", "A", 1)
+    code, body = request(server, "POST", "/jobs", {"order_id": "SO-1", "customer": "A", "box_qty": 1})
+    assert code == 409
+    assert body["errors"][0]["duplicate"] is True
+    code, body = request(server, "POST", "/jobs", [{"order_id": "SO-2", "customer": "A", "box_qty": 1}] * 2)
+    assert code == 202
+    assert len(body["jobs"]) == 1 and body["errors"][0]["row"] == 2
+    code, _ = request(server, "POST", "/jobs", {"order_id": "SO-2", "customer": "A", "box_qty": 1})
+    assert code == 409  # still queued
+    code, _ = request(server, "POST", "/jobs", {"order_id": "SO-1", "customer": "A", "box_qty": 1, "reprint": True})
+    assert code == 202
+
+
+def test_concurrent_posts_queue_an_order_once(server):
+    jobs = server.print_server.print_queue.jobs
+    server.print_server.print_queue.active_jobs = lambda: time.sleep(0.01) or list(jobs)  # widen the race
+    codes = []
+    threads = [threading.Thread(target=lambda: codes.append(request(
+        server, "POST", "/jobs", {"order_id": "SO-7", "customer": "A", "box_qty": 1})[0])) for _ in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(codes) == [202] + [409] * 15
+    assert [j.order_id for j in jobs] == ["SO-7"]
+
+
+def test_job_ids_are_unique_across_threads():
+    ids = []
+
+    def make():
+        ids.extend(main.PrintJob("SO-1", "A", 1, None).id for _ in range(500))
+    threads = [threading.Thread(target=make) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set(ids)) == len(ids)
+
+
+@pytest.mark.parametrize("length, expected", [("-5", 400), ("abc", 400), (str(main.SERVER_MAX_BODY + 1), 413)])
+def test_post_validates_content_length(server, length, expected):
+    code, _ = request(server, "POST", "/jobs", b"{}", headers={"Content-Length": length})
+    assert code == expected
+
+
+def test_post_invalid_json(server):
+    code, body = request(server, "POST", "/jobs", b"{nope")
+    assert code == 400 and "invalid JSON" in body["error"]
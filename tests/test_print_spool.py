@@ -0,0 +1,115 @@
+import main
+
+MAC = "AA:BB:CC:DD:EE:01"
+
+
+class DyingTransport(main.MemoryTransport):
+    """Printer that goes away for good at the write that would take it past `labels` cuts."""
+    def __init__(self, labels):
+        super().__init__()
+        self.left = labels
+
+    def connect(self):
+        if self.left <= 0:
+            raise IOError("printer gone")
+        super().connect()
+
+    def write(self, data):
+        self.left -= data.count(main.ESC_CUT)
+        if self.left < 0:
+            self.left = 0
+            self._connected = False
+            raise IOError("broken pipe")
+        super().write(data)
+
+
+def test_box_ranges_round_trip():
+    assert main.format_box_ranges([5, 1, 2, 3, 7, 8, 8]) == "1-3,5,7-8"
+    assert main.parse_box_ranges("1-3,5,7-8") == [1, 2, 3, 5, 7, 8]
+    assert main.parse_box_ranges("") == []
+
+
+def test_spool_survives_restart(tmp_path):
+    path = str(tmp_path / "spool.jsonl")
+    spool = main.PrintSpool(path)
+    key = spool.open("SO-1", "Khách", 5, MAC, [1, 2, 3, 4, 5])
+    spool.mark(key, 1, True)
+    spool.mark(key, 2, True, sync=False)
+    spool.mark(key, 3, False, "broken pipe", sync=False)
+    spool.flush()
+    done = spool.open("SO-2", "Khách", 1, MAC, [1])
+    spool.mark(done, 1, True)
+    spool.close(done)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"job": "%s", "box": 4, "o' % key)  # torn line from a crash
+    reopened = main.PrintSpool(path)
+    [job] = reopened.unfinished()
+    assert job["key"] == key
+    assert job["pending"] == [3, 4, 5]
+    assert job["failed"] == {3: "broken pipe"}
+
+
+def test_unflushed_marks_are_not_on_disk(tmp_path):
+    path = str(tmp_path / "spool.jsonl")
+    spool = main.PrintSpool(path)
+    key = spool.open("SO-1", "Khách", 2, MAC, [1, 2])
+    spool.mark(key, 1, True, sync=False)
+    assert spool.job(key)["pending"] == [2]
+    assert main.PrintSpool(path).job(key)["pending"] == [1, 2]
+    spool.flush()
+    assert main.PrintSpool(path).job(key)["pending"] == [2]
+
+
+def test_spool_compacts_to_open_jobs(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "SPOOL_COMPACT_BYTES", 0)
+    path = str(tmp_path / "spool.jsonl")
+    spool = main.PrintSpool(path)
+    keep = spool.open("SO-1", "Khách", 3, MAC, [1, 2, 3])
+    spool.mark(keep, 1, True)
+    gone = spool.open("SO-2", "Khách", 1, MAC, [1])
+    spool.close(gone)
+    with open(path, encoding="utf-8") as f:
+        assert "SO-2" not in f.read()
+    assert main.PrintSpool(path).job(keep)["pending"] == [2, 3]
+
+
+def test_interrupted_job_resumes_at_first_unprinted_box():
+    dying = DyingTransport(4)
+    main.get_printer_session(MAC, lambda: dying)
+    job = main.PrintJob("SO-1", "Khách", 10, MAC)
+    job.run()
+    out = bytes(dying.data).count(main.ESC_CUT)
+    assert 0 < out < 10
+    assert job.unprinted == list(range(out + 1, 11))
+    [spooled] = main.SPOOL.unfinished()
+    assert spooled["pending"] == job.unprinted
+    main.close_printer_sessions()
+
+    t = main.MemoryTransport()
+    main.get_printer_session(MAC, lambda: t)
+    resumed = main.PrintJob.resume(spooled)
+    resumed.run()
+    assert resumed.unprinted == []
+    assert main.SPOOL.unfinished() == []
+    assert bytes(t.data).count(main.ESC_CUT) == 10 - out
+    entries = main.HISTORY.load()
+    assert [(e["boxes"], e.get("resumed", False)) for e in entries] == \
+        [(main.format_box_ranges(range(1, out + 1)), False), (main.format_box_ranges(range(out + 1, 11)), True)]
+    assert main.HISTORY.count("SO-1") == 1
+
+
+def test_batch_keeps_unprinted_boxes_in_spool(tmp_path):
+    manifest = tmp_path / "orders.csv"
+    manifest.write_text("order_id,customer,box_qty\nSO-1,A,2\nSO-2,B,6\nSO-3,C,2\nSO-3,C,2\n", encoding="utf-8")
+    dying = DyingTransport(5)
+    main.get_printer_session(MAC, lambda: dying)
+    report = main.run_batch(str(manifest), main.escpos_batch_sink(MAC))
+    assert [oid for _, oid, _ in report.printed] == ["SO-1"]
+    # first label of a job goes alone, the chunk with the rest of SO-2 breaks the link
+    assert [(oid, d) for _, oid, d in report.partial] == [("SO-2", "1/6 nhãn, chưa in BOX 2-6")]
+    assert [oid for _, oid, _ in report.failed] == ["SO-3", "SO-3"]  # retried, not skipped as printed
+    assert report.skipped == []
+    [spooled] = main.SPOOL.unfinished()
+    assert (spooled["order_id"], spooled["pending"]) == ("SO-2", [2, 3, 4, 5, 6])
+    assert [(e["order_id"], e["boxes"]) for e in main.HISTORY.load()] == [("SO-1", "1-2"), ("SO-2", "1")]
+    assert "in dở: 1" in report.summary()
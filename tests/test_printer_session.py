@@ -0,0 +1,176 @@
+import main
+
+
+def make_labels(n, size=150):
+    return [b"L%03d" % i + b"x" * size + main.ESC_CUT for i in range(n)]
+
+
+class RecordingTransport(main.MemoryTransport):
+    """MemoryTransport that keeps every write and can drop the link on chosen writes."""
+    def __init__(self, drop_on=(), **kw):
+        super().__init__(**kw)
+        self.drop_on = set(drop_on)
+        self.writes = []
+
+    def write(self, data):
+        if not self._connected:
+            raise IOError("not connected")
+        if len(self.writes) in self.drop_on:
+            self.drop_on.discard(len(self.writes))
+            self._connected = False
+            raise IOError("broken pipe")
+        self.writes.append(bytes(data))
+        super().write(data)
+
+
+def printed(transport, labels):
+    """How many times each label reached the printer."""
+    data = bytes(transport.data)
+    return [data.count(lb) for lb in labels]
+
+
+def test_session_reuses_connection():
+    t = main.MemoryTransport()
+    s = main.PrinterSession(lambda: t)
+    s.send(b"a")
+    s.send(b"b")
+    assert t.connect_count == 1
+    assert bytes(t.data) == b"ab"
+
+
+def test_session_reconnects_stale_link_once():
+    t = main.MemoryTransport()
+    s = main.PrinterSession(lambda: t)
+    s.send(b"a")
+    t.fail_writes = 1
+    assert s.send(b"b") is True
+    assert t.connect_count == 2
+    assert bytes(t.data) == b"ab"
+
+
+def test_session_does_not_resend_when_told_not_to():
+    t = main.MemoryTransport()
+    s = main.PrinterSession(lambda: t)
+    s.send(b"a")
+    t.fail_writes = 1
+    try:
+        s.send(b"b", retry_stale=False)
+    except IOError:
+        pass
+    else:
+        raise AssertionError("write should have failed")
+    assert bytes(t.data) == b"a"
+
+
+def test_session_reconnects_after_idle_timeout():
+    t = main.MemoryTransport()
+    s = main.PrinterSession(lambda: t, idle_timeout=0.0)
+    s.send(b"a")
+    s.send(b"b")
+    assert t.connect_count == 2
+
+
+def test_stream_writes_every_label_once():
+    labels = make_labels(20)
+    t = main.MemoryTransport()
+    results = main.stream_label_job(main.PrinterSession(lambda: t), labels)
+    assert results == [(True, None)] * 20
+    assert printed(t, labels) == [1] * 20
+
+
+def test_stream_fails_only_labels_of_the_broken_write():
+    labels = make_labels(12)
+    t = RecordingTransport(drop_on={2})
+    seen = []
+    results = main.stream_label_job(main.PrinterSession(lambda: t), labels,
+                                    on_label=lambda i, ok, err: seen.append((i, ok)))
+    failed = [i for i, (ok, _) in enumerate(results) if not ok]
+    assert failed and failed == list(range(failed[0], failed[-1] + 1))
+    assert all(results[i] == (False, "broken pipe") for i in failed)
+    assert [i for i, _ in seen] == list(range(12))
+    counts = printed(t, labels)
+    assert all(counts[i] == 0 for i in failed)
+    assert all(counts[i] == 1 for i in range(12) if i not in failed)
+    assert main.ESC_RESET in t.writes  # fresh ESC @ on the reconnected link
+
+
+def test_stream_writes_one_label_per_write_after_reconnect():
+    labels = make_labels(12)
+    t = RecordingTransport(drop_on={2})
+    main.stream_label_job(main.PrinterSession(lambda: t), labels)
+    after = t.writes[t.writes.index(main.ESC_RESET) + 1:]
+    assert after and all(sum(w.count(lb) for lb in labels) == 1 for w in after)
+
+
+def test_stream_stale_link_resends_first_label_only():
+    labels = make_labels(8)
+    t = RecordingTransport()
+    s = main.PrinterSession(lambda: t)
+    s.send(b"")
+    t.drop_on = {1}  # the job's first write finds the link dead
+    results = main.stream_label_job(s, labels)
+    assert results == [(True, None)] * 8
+    assert printed(t, labels) == [1] * 8
+
+
+def test_stream_cancel_reports_remaining_labels():
+    labels = make_labels(6)
+    calls = []
+
+    def cancel():
+        calls.append(1)
+        return len(calls) > 2
+
+    results = main.stream_label_job(main.PrinterSession(main.MemoryTransport), labels, cancel=cancel)
+    assert results[-1] == (False, "cancelled")
+    assert results[0] == (True, None)
+
+
+def test_print_job_retries_failed_boxes():
+    t = main.MemoryTransport(fail_writes=0)
+    main.get_printer_session("AA:BB:CC:DD:EE:01", lambda: t)
+    t.connect()
+    t.fail_writes = 2
+    job = main.PrintJob("SO-1", "Khách", 5, "AA:BB:CC:DD:EE:01")
+    job.run()
+    assert job.unprinted == []
+    assert main.HISTORY.count("SO-1") == 1
+
+
+class UnreachableTransport(main.MemoryTransport):
+    def connect(self):
+        raise IOError("host is down")
+
+
+def test_unreachable_default_printer_is_forgotten():
+    main.PRINTERS.remember("AA:BB:CC:DD:EE:02", "P2")
+    main.get_printer_session("AA:BB:CC:DD:EE:02", UnreachableTransport)
+    job = main.PrintJob("SO-1", "Khách", 2, "AA:BB:CC:DD:EE:02")
+    job.run()
+    assert job.unprinted == [1, 2]
+    assert main.PRINTERS.default() is None
+
+
+def test_default_printer_kept_when_it_connects_but_fails():
+    main.PRINTERS.remember("AA:BB:CC:DD:EE:03", "P3")
+    main.get_printer_session("AA:BB:CC:DD:EE:03", lambda: main.MemoryTransport(fail_writes=100))
+    job = main.PrintJob("SO-1", "Khách", 2, "AA:BB:CC:DD:EE:03")
+    job.run()
+    assert job.unprinted == [1, 2]
+    assert main.PRINTERS.default() == ("P3", "AA:BB:CC:DD:EE:03")
+    assert not main.PRINTERS.forget("AA:BB:CC:DD:EE:99")  # someone else's printer
+
+
+def test_forget_replaces_prefs_file_atomically(tmp_path, monkeypatch):
+    path = tmp_path / "prefs.json"
+    reg = main.PrinterRegistry(str(path), station="A")
+    reg.remember("AA:BB", "P1")
+    main.PrinterRegistry(str(path), station="B").remember("CC:DD", "P2")
+    with monkeypatch.context() as m:
+        m.setattr(main.os, "replace", lambda *a: (_ for _ in ()).throw(OSError("disk full")))
+        main.PrinterRegistry(str(path), station="A").forget()
+    assert main.PrinterRegistry(str(path), station="A").default() == ("P1", "AA:BB")  # untouched on failure
+    main.PrinterRegistry(str(path), station="A").forget()
+    assert main.PrinterRegistry(str(path), station="A").default() is None
+    assert main.PrinterRegistry(str(path), station="B").default() == ("P2", "CC:DD")
+    assert not (tmp_path / "prefs.json.tmp").exists()
@@ -0,0 +1,43 @@
+import os
+import time
+
+import main
+
+
+def test_evicts_least_recently_used_by_tracked_size(tmp_path, monkeypatch):
+    cache = main.RenderCache(str(tmp_path / "cache"), max_bytes=250)
+    for name in "abc":
+        cache.put_bytes(name, "bin", b"x" * 100)
+        time.sleep(0.01)
+    assert cache.get("a", "bin") is None  # over 250 bytes: the oldest went
+    assert cache.get("b", "bin") and cache.get("c", "bin")
+    monkeypatch.setattr(os, "scandir", None)  # puts must not list the directory again
+    cache.get("b", "bin")
+    cache.put_bytes("d", "bin", b"x" * 100)
+    assert cache.get("c", "bin") is None
+    assert cache.get("b", "bin") and cache.get("d", "bin")
+
+
+def test_startup_scan_drops_stale_entries(tmp_path):
+    d = tmp_path / "cache"
+    d.mkdir()
+    (d / "old.bin").write_bytes(b"x")
+    (d / "new.bin").write_bytes(b"yy")
+    os.utime(d / "old.bin", (0, 0))
+    cache = main.RenderCache(str(d), max_age=3600)
+    cache.put_bytes("other", "bin", b"z")
+    assert sorted(os.listdir(d)) == ["new.bin", "other.bin"]
+    assert cache._total == 3
+
+
+def test_escpos_labels_reuse_the_cached_list(monkeypatch, tmp_path):
+    monkeypatch.setattr(main.RENDER_CACHE, "path", str(tmp_path / "render_cache"))
+    monkeypatch.setattr(main.RENDER_CACHE, "_files", None)
+    monkeypatch.setattr(main.RENDER_CACHE, "enabled", True)
+    header, labels = main.escpos_job_labels("SO-1", "Khách", 3)
+    again = main.escpos_job_labels("SO-1", "Khách", 3)
+    assert again[1] is labels
+    monkeypatch.setattr(main, "_escpos_labels_memo", {})
+    monkeypatch.setattr(main, "_escpos_labels_memo_bytes", 0)
+    from_disk = main.escpos_job_labels("SO-1", "Khách", 3)
+    assert from_disk == (header, labels)
@@ -0,0 +1,59 @@
+import threading
+import time
+
+import pytest
+
+import main
+
+MAC = "AA:BB:CC:DD:EE:07"
+
+
+def make_labels(n, size=150):
+    return [b"L%03d" % i + b"x" * size + main.ESC_CUT for i in range(n)]
+
+
+@pytest.fixture
+def pacing(monkeypatch):
+    monkeypatch.setattr(main, "PRINTER_STATUS_PACING", True)
+    monkeypatch.setattr(main, "STATUS_POLL_INTERVAL", 0.01)
+    monkeypatch.setattr(main, "STATUS_PAUSE_TIMEOUT", 0.2)
+
+
+def test_stream_waits_for_printer_to_recover(pacing):
+    t = main.MemoryTransport(status=True)
+    t.paper_out = True
+    seen = []
+    session = main.PrinterSession(lambda: t)
+    pacer = main.default_pacer(session, on_status=seen.append)
+    threading.Timer(0.05, lambda: setattr(t, "paper_out", False)).start()
+    results = main.stream_label_job(session, make_labels(3), pacer=pacer)
+    assert results == [(True, None)] * 3
+    assert seen == ["paper_out", "ok"]
+
+
+def test_stopped_printer_fails_remaining_labels_after_one_timeout(pacing):
+    t = main.MemoryTransport(status=True)
+    session = main.PrinterSession(lambda: t)
+    pacer = main.default_pacer(session)
+    labels = make_labels(10, size=600)  # several status checks per job
+    t0 = time.monotonic()
+    results = main.stream_label_job(session, labels, pacer=pacer,
+                                    on_label=lambda i, ok, err: i == 1 and setattr(t, "paper_out", True))
+    assert time.monotonic() - t0 < 1.0
+    assert results[:2] == [(True, None)] * 2
+    assert results[2:] == [(False, "printer stopped: paper_out")] * 8
+    assert pacer.stopped == "paper_out"
+    assert pacer.unacked is None
+
+
+def test_stopped_printer_leaves_job_in_spool_without_retries(pacing):
+    t = main.MemoryTransport(status=True)
+    t.cover_open = True
+    main.get_printer_session(MAC, lambda: t)
+    job = main.PrintJob("SO-1", "Khách", 40, MAC)
+    t0 = time.monotonic()
+    job.run()
+    assert time.monotonic() - t0 < 1.0  # one timeout, not one per box and pass
+    assert job.unprinted == list(range(1, 41))
+    assert main.SPOOL.job(job.spool_key)["pending"] == list(range(1, 41))
+    assert main.HISTORY.count("SO-1") == 0
@@ -0,0 +1,116 @@
+import socket
+import threading
+
+import pytest
+
+import main
+
+
+class FakePrinter:
+    """Local 9100 listener that records what it receives and answers DLE EOT."""
+    def __init__(self, status=0x12):
+        self.status = status
+        self.received = bytearray()
+        self.connections = 0
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(4)
+        self.addr = "127.0.0.1:%d" % self.sock.getsockname()[1]
+        self._conns = []
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                c, _ = self.sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            self._conns.append(c)
+            threading.Thread(target=self._handle, args=(c,), daemon=True).start()
+
+    def _handle(self, c):
+        with c:
+            while True:
+                try:
+                    data = c.recv(65536)
+                except OSError:
+                    return
+                if not data:
+                    return
+                self.received += data
+                if main.DLE_EOT in data:
+                    c.sendall(bytes((self.status,)))
+
+    def drop_clients(self):
+        for c in self._conns:
+            try:
+                c.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._conns = []
+
+    def close(self):
+        self.drop_clients()
+        self.sock.close()
+
+
+@pytest.fixture
+def printer():
+    p = FakePrinter()
+    yield p
+    main.close_net_printer_pools()
+    p.close()
+
+
+def wait_for(cond, timeout=2.0):
+    import time
+    deadline = time.monotonic() + timeout
+    while not cond() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return cond()
+
+
+def test_parse_net_printer():
+    assert main.parse_net_printer("tcp://10.0.0.5") == ("10.0.0.5", main.NET_PRINTER_PORT)
+    assert main.parse_net_printer("10.0.0.5:9101") == ("10.0.0.5", 9101)
+    assert main.parse_net_printer("AA:BB:CC:DD:EE:FF") is None
+
+
+def test_tcp_transport_streams_job(printer):
+    labels = [b"BOX%02d" % i + b"." * 200 for i in range(10)]
+    session = main.PrinterSession(lambda: main.TcpTransport(printer.addr))
+    results = main.stream_label_job(session, labels)
+    session.close()
+    assert results == [(True, None)] * 10
+    assert wait_for(lambda: len(printer.received) == sum(map(len, labels)))
+    assert bytes(printer.received) == b"".join(labels)
+
+
+def test_tcp_pool_reuses_connection(printer):
+    for _ in range(3):
+        session = main.PrinterSession(lambda: main.TcpTransport(printer.addr))
+        session.send(b"x")
+        session.close()
+    assert wait_for(lambda: len(printer.received) == 3)
+    assert printer.connections == 1
+
+
+def test_tcp_status_query(printer):
+    session = main.PrinterSession(lambda: main.TcpTransport(printer.addr))
+    assert session.printer_status() == "ok"
+    printer.status = 0x12 | 0x08 | 0x20  # stopped (DLE EOT 1), paper out (DLE EOT 2)
+    assert session.printer_status() == "paper_out"
+    session.close()
+
+
+def test_tcp_reconnects_after_printer_drops_link(printer):
+    session = main.PrinterSession(lambda: main.TcpTransport(printer.addr))
+    session.send(b"a")
+    assert wait_for(lambda: printer.received == b"a")
+    printer.drop_clients()
+    assert wait_for(lambda: not session.transport.is_connected())
+    session.send(b"b")
+    assert wait_for(lambda: bytes(printer.received) == b"ab")
+    assert printer.connections == 2
+    session.close()